@@ -1,16 +1,14 @@
 import torch
 import diffusers
-from PIL import Image
-import numpy as np
+
+from src.oracle.assets import MaskRegistry
 
 prompt = "a 3D wizard wearing a wizard hat, red and black, with a book in his hand, reading glasses, steampunk style, upper bust, ultra realistic, 4k, frontal view"
 
-char_mask = torch.from_numpy(np.array(Image.open("/home/andrea/Documenti/Computer Science/Blockchain/project/MetaFusion/data/masks/test_3.png"))[:, :, :3]).to("cuda").unsqueeze(0).permute(0, 3, 1, 2).half() / 255.0
-hat_mask = torch.from_numpy(np.array(Image.open("/home/andrea/Documenti/Computer Science/Blockchain/project/MetaFusion/data/masks/hat.png"))[:, :, :3]).to("cuda").unsqueeze(0).permute(0, 3, 1, 2).half() / 255.0
-handoff_mask = torch.from_numpy(np.array(Image.open("/home/andrea/Documenti/Computer Science/Blockchain/project/MetaFusion/data/masks/handoff.png"))[:, :, :3]).to("cuda").unsqueeze(0).permute(0, 3, 1, 2).half() / 255.0
-glasses_mask = torch.from_numpy(np.array(Image.open("/home/andrea/Documenti/Computer Science/Blockchain/project/MetaFusion/data/masks/glasses.png"))[:, :, :3]).to("cuda").unsqueeze(0).permute(0, 3, 1, 2).half() / 255.0
+masks = MaskRegistry("data/masks")
 
-final_mask = char_mask# + hat_mask + handoff_mask + glasses_mask
+final_mask = masks.get("test_3", "cuda", torch.float16)
+# final_mask = masks.get(["test_3", "hat", "handoff", "glasses"], "cuda", torch.float16, resolution=(512, 512))
 print(final_mask.shape)
 
 model = diffusers.AutoPipelineForText2Image.from_pretrained("stabilityai/sdxl-turbo", cache_dir = "./cache/models/", torch_dtype=torch.float16).to("cuda")
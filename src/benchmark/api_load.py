@@ -0,0 +1,195 @@
+'''
+Load benchmark of the web API.
+
+Fill a temporary database with a synthetic event stream, serve the API with
+uvicorn in a child process and run `clients` concurrent keep-alive clients
+against it, each sending `requests` GETs drawn from a mix of endpoints,
+`think_time` seconds apart on average.
+Every mode in `modes` is measured on the same database:
+"inline" runs the queries on the event loop, like the endpoints did before
+AsyncData, "threads" runs them with AsyncData.
+
+run from the root directory with:
+python3 -m src.benchmark.api_load
+python3 -m src.benchmark.api_load api_load.clients=200 api_load.modes=[threads]
+'''
+
+import asyncio
+import hydra
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import time
+
+from ..db.data import Data
+from ..db.async_data import AsyncData
+from .streams import EventStreamGenerator, FakeIPFSClient
+from .tracker_replay import replay, percentile
+
+logger = logging.getLogger(__name__)
+
+
+class InlineData(object):
+    '''
+    Await the methods of Data without leaving the event loop.
+    '''
+
+    def __init__(self, data: Data):
+        self.data = data
+
+    def __getattr__(self, name):
+        method = getattr(self.data, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+def fillDatabase(bench_cfg, database):
+    '''
+    Replay the event stream in database and return the paths the clients request, by endpoint.
+    '''
+    IPFSClient = FakeIPFSClient()
+    generator = EventStreamGenerator(IPFSClient, seed=bench_cfg.seed, users=bench_cfg.users, collections=bench_cfg.collections,
+                                     events_per_block=bench_cfg.events_per_block, image_size=8)
+    events = generator.generate(bench_cfg.events)
+    data = Data(create_db=True, wipe_db=True, database=database)
+    event_logger = logging.getLogger("api_load.events")
+    event_logger.setLevel(logging.WARNING)
+    replay(events, data, IPFSClient, 1, event_logger)
+
+    paths = {
+        "/user/{publicKey}": [f"/user/{user}" for user in generator.users],
+        "/user/{userId}/name": [f"/user/{user}/name" for user in generator.users],
+        "/packets/": ["/packets/"],
+        "/prompts/": ["/prompts/"],
+        "/cards/": ["/cards/"],
+        "/packet/{packetid}": [], "/prompt/{promptid}": [], "/card/{cardid}": [],
+    }
+    for user in generator.users:
+        packets, prompts, cards, _ = data.get_user(user)
+        paths["/packet/{packetid}"] += [f"/packet/{packet['id']}" for packet in packets]
+        paths["/prompt/{promptid}"] += [f"/prompt/{prompt['id']}" for prompt in prompts]
+        paths["/card/{cardid}"] += [f"/card/{card['id']}" for card in cards]
+    data.con.close()
+    return {endpoint: endpoint_paths for endpoint, endpoint_paths in paths.items() if endpoint_paths}
+
+def serve(database, mode, readers, port):
+    '''
+    Run the API on database, in the child process.
+    '''
+    import uvicorn
+    from hydra.core.global_hydra import GlobalHydra
+    # the api composes its own config when it is imported
+    GlobalHydra.instance().clear()
+    # and opens the database of conf/db/data.yaml when it is imported, in the working directory
+    os.chdir(os.path.dirname(database))
+    from ..web_api import api
+    data = Data(database=database)
+    api.database = InlineData(data) if mode == "inline" else AsyncData(data, readers=readers)
+    uvicorn.run(api.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+def freePort() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def waitForServer(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1.0):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"the API did not start on port {port}")
+
+async def get(reader, writer, path):
+    '''
+    Send a GET on a keep-alive connection and read the response, return its status.
+    '''
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode("ascii"))
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            await reader.readexactly(int(line.split(b":", 1)[1]))
+    return status
+
+async def client(port, paths, requests, think_time, seed, latencies, errors):
+    rng = random.Random(seed)
+    endpoints = list(paths)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        for _ in range(requests):
+            if think_time > 0:
+                await asyncio.sleep(rng.expovariate(1.0 / think_time))
+            endpoint = rng.choice(endpoints)
+            path = rng.choice(paths[endpoint])
+            begin = time.perf_counter()
+            try:
+                status = await get(reader, writer, path)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # uvicorn closes the connections idle for more than timeout_keep_alive
+                writer.close()
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                status = await get(reader, writer, path)
+            latencies.setdefault(endpoint, []).append(time.perf_counter() - begin)
+            if status >= 500:
+                errors.append(status)
+    finally:
+        writer.close()
+
+async def load(port, paths, clients, requests, think_time, seed):
+    '''
+    Run the clients together, return the latencies by endpoint, the errors and the elapsed time.
+    '''
+    latencies, errors = {}, []
+    begin = time.perf_counter()
+    await asyncio.gather(*[client(port, paths, requests, think_time, seed + i, latencies, errors) for i in range(clients)])
+    return latencies, errors, time.perf_counter() - begin
+
+def report(mode, latencies, errors, total_time):
+    every = [latency for values in latencies.values() for latency in values]
+    lines = [
+        f"mode: {mode}",
+        f"requests: {len(every)}, errors: {len(errors)}",
+        f"throughput: {len(every) / total_time:.1f} requests/s",
+        f"{'endpoint':<22}{'count':>8}{'p50 (ms)':>12}{'p99 (ms)':>12}",
+    ]
+    for name, values in sorted(latencies.items()) + [("all", every)]:
+        lines.append(f"{name:<22}{len(values):>8}{percentile(values, 0.5) * 1000:>12.3f}{percentile(values, 0.99) * 1000:>12.3f}")
+    return "\n".join(lines)
+
+
+@hydra.main(config_path="../../conf", config_name="benchmark_config")
+def main(cfg):
+    bench_cfg = cfg.api_load
+    workdir = tempfile.TemporaryDirectory()
+    database = os.path.join(workdir.name, "tracker.db")
+    paths = fillDatabase(bench_cfg, database)
+
+    for mode in bench_cfg.modes:
+        port = freePort()
+        server = multiprocessing.Process(target=serve, args=(database, mode, bench_cfg.readers, port), daemon=True)
+        server.start()
+        try:
+            waitForServer(port)
+            # warm up the connections and the page cache
+            asyncio.run(load(port, paths, bench_cfg.readers, 10, 0, bench_cfg.seed))
+            latencies, errors, total_time = asyncio.run(load(port, paths, bench_cfg.clients, bench_cfg.requests,
+                                                            bench_cfg.think_time, bench_cfg.seed))
+            print(report(mode, latencies, errors, total_time))
+        finally:
+            server.terminate()
+            server.join()
+
+    workdir.cleanup()
+
+if __name__ == "__main__":
+    main()
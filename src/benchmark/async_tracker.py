@@ -0,0 +1,291 @@
+'''
+Check of the asyncio tracker against a stand-in node.
+
+A local JSON-RPC node (HTTP with aiohttp, websocket with websockets) mines a
+block of the synthetic event stream every `block_time` seconds and sends a
+newHeads notification to its subscribers. The tracker (async_tracker.run) is
+pointed at it with a temporary database. After `outage_after` blocks the
+websocket server is stopped for `outage` seconds: the tracker must fall back
+to HTTP polling, keep up with the chain, and subscribe again with its backoff
+once the server is back.
+
+It reports how long every block took to be applied after it was mined,
+before, during and after the outage, and checks that every block and every
+event was applied and that the subscription was opened again.
+
+The ABI is read from the hardhat artifacts (npx hardhat compile).
+
+run from the root directory with:
+python3 -m src.benchmark.async_tracker
+python3 -m src.benchmark.async_tracker async_tracker.blocks=100 async_tracker.outage=10.0
+'''
+
+import asyncio
+import hydra
+import json
+import logging
+import os
+import tempfile
+import time
+import websockets
+from aiohttp import web
+from omegaconf import OmegaConf
+from web3 import Web3
+
+from ..db.data import Data
+from ..tracker import async_tracker
+from ..tracker.enrichment import EnrichmentQueue
+from .api_load import freePort
+from .decoding import encodeLog
+from .streams import EventStreamGenerator, FakeIPFSClient
+from .tracker_replay import percentile
+
+logger = logging.getLogger(__name__)
+
+CONTRACT_ADDRESS = "0x5FbDB2315678afecb367f032d93F642f64180aa3"
+
+
+def toJson(value):
+    '''
+    The hex form of the values of a block or a log, as sent by a node.
+    '''
+    if isinstance(value, (bytes, bytearray)):
+        return Web3.to_hex(value)
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return hex(value)
+    if isinstance(value, (list, tuple)):
+        return [toJson(item) for item in value]
+    if isinstance(value, dict):
+        return {key: toJson(item) for key, item in value.items()}
+    return value
+
+
+class StandInNode(object):
+    '''
+    A chain that grows by one block every mine(), served over HTTP and websocket.
+    logs: the raw logs of every block number.
+    '''
+
+    def __init__(self, logs, http_port: int, websocket_port: int):
+        self.logs = logs
+        self.http_port = http_port
+        self.websocket_port = websocket_port
+        self.blocks = [self.block(0)]
+        self.mined_at = {0: time.perf_counter()}
+        self.subscribers = {}
+        self.subscriptions = 0
+        self.websocket_server = None
+        self.http_runner = None
+
+    def block(self, number: int):
+        return {
+            "number": number,
+            "hash": number.to_bytes(32, "big"),
+            "parentHash": max(number - 1, 0).to_bytes(32, "big"),
+            "timestamp": int(time.time()),
+            "transactions": [],
+        }
+
+    @property
+    def head(self) -> int:
+        return self.blocks[-1]["number"]
+
+    async def mine(self):
+        block = self.block(self.head + 1)
+        self.blocks.append(block)
+        self.mined_at[block["number"]] = time.perf_counter()
+        header = toJson({key: value for key, value in block.items() if key != "transactions"})
+        for websocket, subscription in list(self.subscribers.items()):
+            try:
+                await websocket.send(json.dumps({"jsonrpc": "2.0", "method": "eth_subscription",
+                                                 "params": {"subscription": subscription, "result": header}}))
+            except websockets.ConnectionClosed:
+                self.subscribers.pop(websocket, None)
+
+    def get_logs(self, log_filter):
+        from_block = int(log_filter.get("fromBlock", "0x0"), 16)
+        to_block = min(int(log_filter.get("toBlock", hex(self.head)), 16), self.head)
+        topics = log_filter.get("topics") or [None]
+        return [toJson(dict(log)) for number in range(from_block, to_block + 1) for log in self.logs.get(number, [])
+                if topics[0] is None or Web3.to_hex(log["topics"][0]) in topics[0]]
+
+    def call(self, method: str, params):
+        if method == "eth_chainId":
+            return "0x7a69"
+        if method == "eth_blockNumber":
+            return hex(self.head)
+        if method == "eth_getBlockByNumber":
+            number = self.head if params[0] == "latest" else int(params[0], 16)
+            return toJson(self.blocks[number]) if number <= self.head else None
+        if method == "eth_getLogs":
+            return self.get_logs(params[0])
+        raise ValueError(f"method {method} is not supported by the stand-in node")
+
+    def answer(self, request):
+        try:
+            return {"jsonrpc": "2.0", "id": request["id"], "result": self.call(request["method"], request.get("params", []))}
+        except Exception as e:
+            return {"jsonrpc": "2.0", "id": request["id"], "error": {"code": -32000, "message": str(e)}}
+
+    async def http(self, request):
+        return web.json_response(self.answer(await request.json()))
+
+    async def websocket(self, websocket):
+        try:
+            async for message in websocket:
+                request = json.loads(message)
+                if request["method"] == "eth_subscribe":
+                    self.subscriptions += 1
+                    subscription = hex(self.subscriptions)
+                    self.subscribers[websocket] = subscription
+                    await websocket.send(json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": subscription}))
+                else:
+                    await websocket.send(json.dumps(self.answer(request)))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.subscribers.pop(websocket, None)
+
+    async def start_http(self):
+        app = web.Application()
+        app.router.add_post("/", self.http)
+        self.http_runner = web.AppRunner(app)
+        await self.http_runner.setup()
+        await web.TCPSite(self.http_runner, "127.0.0.1", self.http_port).start()
+
+    async def start_websocket(self):
+        self.websocket_server = await websockets.serve(self.websocket, "127.0.0.1", self.websocket_port)
+
+    async def stop_websocket(self):
+        self.websocket_server.close()
+        await self.websocket_server.wait_closed()
+        self.subscribers.clear()
+
+    async def stop(self):
+        await self.stop_websocket()
+        await self.http_runner.cleanup()
+
+
+def trackerConfig(bench_cfg, node: StandInNode):
+    '''
+    The settings of conf/tracker_config.yaml used by async_tracker.run, pointed at the node.
+    '''
+    return OmegaConf.create({
+        "contract": {"contract_address": CONTRACT_ADDRESS},
+        "start_block": 1,
+        "chunk_size": 2000,
+        "confirmations": 0,
+        "journal_blocks": 128,
+        "blocks_per_transaction": 1,
+        "async_tracker": {
+            "websocket": {"_target_": "web3.providers.WebsocketProviderV2", "endpoint_uri": f"ws://127.0.0.1:{node.websocket_port}"},
+            "http": {"_target_": "web3.AsyncHTTPProvider", "endpoint_uri": f"http://127.0.0.1:{node.http_port}"},
+            "min_poll_interval": bench_cfg.min_poll_interval,
+            "max_poll_interval": bench_cfg.max_poll_interval,
+        },
+    })
+
+async def watch(node: StandInNode, data, applied_at, stopped: asyncio.Event):
+    '''
+    Record when the checkpoint of the tracker reaches every block.
+    '''
+    while not stopped.is_set():
+        checkpoint = data.get_checkpoint() or 0
+        for number in range(len(applied_at) + 1, checkpoint + 1):
+            applied_at[number] = time.perf_counter()
+        await asyncio.sleep(0.005)
+
+async def check(bench_cfg, abi, events, IPFSClient, data):
+    node = StandInNode({}, freePort(), freePort())
+    abi_by_name = {entry["name"]: entry for entry in abi if entry.get("type") == "event"}
+    for event in events:
+        node.logs.setdefault(event.blockNumber, []).append(encodeLog(event, abi_by_name))
+    await node.start_http()
+    await node.start_websocket()
+
+    enricher = EnrichmentQueue(IPFSClient, data, workers=2)
+    tracker = asyncio.create_task(async_tracker.run(IPFSClient, data, enricher, abi, trackerConfig(bench_cfg, node)))
+    applied_at, stopped = {}, asyncio.Event()
+    watcher = asyncio.create_task(watch(node, data, applied_at, stopped))
+    # blocks mined while the websocket server is up, down and up again
+    phases = {}
+    try:
+        # wait for the first subscription
+        while node.subscriptions == 0:
+            await asyncio.sleep(0.01)
+        last_block = max(node.logs)
+        for number in range(1, last_block + 1):
+            if number == bench_cfg.outage_after + 1:
+                logger.info("Stopping the websocket server.")
+                await node.stop_websocket()
+                outage_end = time.perf_counter() + bench_cfg.outage
+            if number > bench_cfg.outage_after and node.websocket_server is not None and time.perf_counter() >= outage_end \
+                    and not node.websocket_server.is_serving():
+                logger.info("Starting the websocket server again.")
+                await node.start_websocket()
+            phase = "before" if number <= bench_cfg.outage_after else ("outage" if not node.websocket_server.is_serving() else "after")
+            phases[number] = phase
+            await node.mine()
+            await asyncio.sleep(bench_cfg.block_time)
+        deadline = time.perf_counter() + bench_cfg.max_poll_interval + 5.0
+        while len(applied_at) < last_block and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+    finally:
+        stopped.set()
+        await watcher
+        tracker.cancel()
+        try:
+            await tracker
+        except asyncio.CancelledError:
+            pass
+        await node.stop()
+    return node, phases, applied_at
+
+def report(node, phases, applied_at):
+    lines = [f"blocks: {node.head}, applied: {len(applied_at)}, subscriptions: {node.subscriptions}",
+             f"{'phase':<10}{'blocks':>8}{'p50 lag (ms)':>15}{'p99 lag (ms)':>15}"]
+    for phase in ("before", "outage", "after"):
+        lags = [applied_at[number] - node.mined_at[number] for number, block_phase in phases.items()
+                if block_phase == phase and number in applied_at]
+        if lags:
+            lines.append(f"{phase:<10}{len(lags):>8}{percentile(lags, 0.5) * 1000:>15.1f}{percentile(lags, 0.99) * 1000:>15.1f}")
+    return "\n".join(lines)
+
+
+@hydra.main(config_path="../../conf", config_name="benchmark_config")
+def main(cfg):
+    bench_cfg = cfg.async_tracker
+    with open(bench_cfg.abi) as f:
+        abi = json.load(f)["abi"]
+    IPFSClient = FakeIPFSClient()
+    generator = EventStreamGenerator(IPFSClient, seed=bench_cfg.seed, users=bench_cfg.users, collections=bench_cfg.collections,
+                                     events_per_block=bench_cfg.events_per_block, image_size=8)
+    events = generator.generate(bench_cfg.blocks * bench_cfg.events_per_block)
+    events = [event for event in events if event.blockNumber <= bench_cfg.blocks]
+
+    # the handlers and the enrichment queue write the card images in ipfs/image/
+    workdir = tempfile.TemporaryDirectory()
+    os.makedirs(os.path.join(workdir.name, "ipfs", "image"))
+    os.chdir(workdir.name)
+    data = Data(create_db=True, wipe_db=True, database=os.path.join(workdir.name, "tracker.db"))
+    # the handlers log every event and the node every request at info level
+    for name in ("src.tracker.async_tracker", "aiohttp.access", "websockets.server"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    node, phases, applied_at = asyncio.run(check(bench_cfg, abi, events, IPFSClient, data))
+    print(report(node, phases, applied_at))
+
+    applied_events = data.get_cursor().execute("SELECT COUNT(*) FROM ProcessedLogs").fetchone()[0]
+    if len(applied_at) != node.head:
+        raise AssertionError(f"{node.head - len(applied_at)} blocks were not applied.")
+    if applied_events != len(events):
+        raise AssertionError(f"{applied_events} events applied out of {len(events)}.")
+    if node.subscriptions < 2:
+        raise AssertionError("The tracker did not subscribe again after the outage.")
+    print(f"ok: {len(events)} events applied, subscribed again after the outage")
+    workdir.cleanup()
+
+if __name__ == "__main__":
+    main()
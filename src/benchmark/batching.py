@@ -0,0 +1,107 @@
+'''
+Check of the batching stage of the oracle.
+
+Generate the same items, each with its own prompt and seed, once with a
+pipeline call per item and once through a BatchedModel that runs them in a
+single call, and check that every item gets the same image both ways, within
+`tolerance` levels per pixel.
+
+With the stub pipeline (model=stub, the default) the images must be equal.
+With the diffusion model on a GPU they can differ by a few levels: the
+kernels chosen for a batch of N are not the ones chosen for a batch of 1,
+and in float16 they sum in another order. Run the check on the target GPU and
+set `tolerance` to the difference it reports.
+
+run from the root directory with:
+python3 -m src.benchmark.batching
+python3 -m src.benchmark.batching model=sdxl-turbo
+'''
+
+import hydra
+import threading
+import time
+import numpy as np
+import torch
+
+from ..oracle.assets import MaskRegistry
+from ..oracle.batching import BatchedModel
+
+
+class CountingPipeline(object):
+    '''
+    Forward the calls to the pipeline and record the size of every call.
+    '''
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.calls = []
+
+    @property
+    def device(self):
+        return self.pipeline.device
+
+    @property
+    def dtype(self):
+        return self.pipeline.dtype
+
+    def __call__(self, generator, **kwargs):
+        self.calls.append(len(generator) if isinstance(generator, list) else 1)
+        return self.pipeline(generator=generator, **kwargs)
+
+
+def generateSingle(pipeline, mask, items, parameters):
+    return [pipeline(prompt=prompt, image=mask, generator=torch.Generator().manual_seed(seed), **parameters).images[0]
+            for prompt, seed in items]
+
+def generateBatched(model, mask, items, parameters):
+    '''
+    Call the BatchedModel from a thread per item, like the image workers.
+    '''
+    images = [None] * len(items)
+
+    def work(idx, prompt, seed):
+        images[idx] = model(prompt=prompt, image=mask, generator=torch.Generator().manual_seed(seed), **parameters).images[0]
+
+    threads = [threading.Thread(target=work, args=(idx, prompt, seed)) for idx, (prompt, seed) in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return images
+
+
+@hydra.main(config_path="../../conf", config_name="benchmark_config")
+def main(cfg):
+    bench_cfg = cfg.batching
+    pipeline = CountingPipeline(hydra.utils.call(cfg.model.from_pretrained, torch_dtype=getattr(torch, cfg.model.dtype)).to(cfg.model.device))
+    mask = MaskRegistry(bench_cfg.masks).get(bench_cfg.mask, pipeline.device, pipeline.dtype)
+    items = list(zip(bench_cfg.prompts, bench_cfg.seeds))
+    parameters = dict(bench_cfg.parameters)
+
+    begin = time.perf_counter()
+    single = generateSingle(pipeline, mask, items, parameters)
+    single_time = time.perf_counter() - begin
+
+    # max_wait long enough for every thread to join the batch
+    model = BatchedModel(pipeline, max_batch_size=len(items), max_wait=bench_cfg.max_wait)
+    pipeline.calls = []
+    begin = time.perf_counter()
+    batched = generateBatched(model, mask, items, parameters)
+    batched_time = time.perf_counter() - begin
+
+    print(f"items: {len(items)}, pipeline calls of the batched run: {pipeline.calls}")
+    print(f"single: {single_time:.3f}s, batched: {batched_time:.3f}s")
+    print(f"{'seed':>22}{'max diff':>10}{'mean diff':>11}")
+    worst = 0
+    for (_, seed), single_image, batched_image in zip(items, single, batched):
+        difference = np.abs(np.asarray(single_image, dtype=np.int16) - np.asarray(batched_image, dtype=np.int16))
+        worst = max(worst, int(difference.max()))
+        print(f"{seed:>22}{int(difference.max()):>10}{difference.mean():>11.3f}")
+    if len(pipeline.calls) != 1:
+        raise AssertionError(f"The items were not generated in one batch: {pipeline.calls}")
+    if worst > bench_cfg.tolerance:
+        raise AssertionError(f"A batched image differs from its single call by {worst} levels, more than the tolerance of {bench_cfg.tolerance}.")
+    print(f"ok: the batched images match the single calls within {bench_cfg.tolerance} levels")
+
+if __name__ == "__main__":
+    main()
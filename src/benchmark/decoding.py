@@ -0,0 +1,134 @@
+'''
+Micro-benchmark of the log decoding.
+
+Decode a large batch of raw logs into the tracker's event objects with the
+current web3 path (process_log, AttributeDict, get_event_class) and with the
+precompiled decoders of src.utils.decoding, check that both return the same
+objects and report the logs per second of each.
+
+The batch is either a recording of eth_getLogs results (a JSON list of raw
+logs, see recordLogs) or synthesized from the tracker replay event stream.
+The ABI is read from the hardhat artifacts (npx hardhat compile).
+
+run from the root directory with:
+python3 -m src.benchmark.decoding
+python3 -m src.benchmark.decoding decoding.logs=logs.json
+'''
+
+import hydra
+import json
+import time
+from eth_abi import encode
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+from ..tracker.event_handler import TRACKER_EVENTS, initTrackerDecoder
+from ..tracker.events import get_event_class
+from .streams import EventStreamGenerator, FakeIPFSClient
+
+HEX_FIELDS = ["data", "blockHash", "transactionHash"]
+
+
+def encodeLog(event, abi_by_name):
+    '''
+    Encode a decoded event back into the raw log returned by eth_getLogs.
+    '''
+    event_abi = abi_by_name[event.event]
+    topics = [HexBytes(event_abi_to_log_topic(event_abi))]
+    data_types, data_values = [], []
+    for abi_input in event_abi["inputs"]:
+        value = event.args[abi_input["name"]]
+        if abi_input["indexed"]:
+            topics.append(HexBytes(encode([abi_input["type"]], [value])))
+        else:
+            data_types.append(abi_input["type"])
+            data_values.append(value)
+    return AttributeDict({
+        "address": event.address,
+        "topics": topics,
+        "data": HexBytes(encode(data_types, data_values)),
+        "blockNumber": event.blockNumber,
+        "blockHash": HexBytes(event.blockHash),
+        "transactionHash": HexBytes(event.transactionHash),
+        "transactionIndex": event.transactionIndex,
+        "logIndex": event.logIndex,
+        "removed": False,
+    })
+
+def recordLogs(logs, path):
+    with open(path, "w") as f:
+        json.dump([{**log, "topics": [topic.hex() for topic in log["topics"]], **{key: log[key].hex() for key in HEX_FIELDS}} for log in logs], f)
+
+def loadLogs(path):
+    with open(path) as f:
+        logs = json.load(f)
+    return [AttributeDict({**log, "topics": [HexBytes(topic) for topic in log["topics"]], **{key: HexBytes(log[key]) for key in HEX_FIELDS}}) for log in logs]
+
+def synthesizeLogs(bench_cfg, abi):
+    generator = EventStreamGenerator(FakeIPFSClient(), seed=bench_cfg.seed, users=bench_cfg.users, collections=bench_cfg.collections,
+                                     events_per_block=bench_cfg.events_per_block, image_size=1)
+    abi_by_name = {entry["name"]: entry for entry in abi if entry.get("type") == "event"}
+    return [encodeLog(event, abi_by_name) for event in generator.generate(bench_cfg.events)]
+
+def decodeWeb3(logs, events):
+    '''
+    Current path: web3's process_log and the reflection of handle_event.
+    '''
+    objects = []
+    for log in logs:
+        event = AttributeDict.recursive(events[bytes(log["topics"][0])].process_log(log))
+        kwargs = dict(event.args)
+        kwargs['event'] = event.event
+        objects.append(get_event_class(event.event)(**kwargs))
+    return objects
+
+def decodePrecompiled(logs, decoder):
+    return [decoder.decode(log).handler for log in logs]
+
+def lowercase(event_object):
+    return type(event_object)(**{name: value.lower() if isinstance(value, str) and value.startswith("0x") else value
+                                 for name, value in ((name, getattr(event_object, name)) for name in event_object.__dataclass_fields__)})
+
+def timeit(function, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - begin)
+    return best, result
+
+
+@hydra.main(config_path="../../conf", config_name="benchmark_config")
+def main(cfg):
+    bench_cfg = cfg.decoding
+    with open(bench_cfg.abi) as f:
+        abi = json.load(f)["abi"]
+
+    if bench_cfg.logs:
+        logs = loadLogs(bench_cfg.logs)
+    else:
+        logs = synthesizeLogs(bench_cfg, abi)
+        if bench_cfg.record:
+            recordLogs(logs, bench_cfg.record)
+
+    contract = Web3().eth.contract(abi=abi)
+    events = {event_abi_to_log_topic(contract.events[name]().abi): contract.events[name]() for name in TRACKER_EVENTS}
+    decoder = initTrackerDecoder(abi)
+
+    web3_time, web3_objects = timeit(lambda: decodeWeb3(logs, events), bench_cfg.repeats)
+    precompiled_time, precompiled_objects = timeit(lambda: decodePrecompiled(logs, decoder), bench_cfg.repeats)
+
+    # the precompiled decoders of the tracker do not checksum the addresses
+    if [lowercase(event_object) for event_object in web3_objects] != precompiled_objects:
+        raise AssertionError("The precompiled decoders do not match web3's decoding.")
+
+    print(f"logs: {len(logs)} (best of {bench_cfg.repeats})")
+    print(f"{'decoder':<16}{'time (s)':>12}{'logs/s':>14}")
+    print(f"{'web3':<16}{web3_time:>12.3f}{len(logs) / web3_time:>14.1f}")
+    print(f"{'precompiled':<16}{precompiled_time:>12.3f}{len(logs) / precompiled_time:>14.1f}")
+    print(f"speedup: {web3_time / precompiled_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+'''
+Synthetic MetaFusion event streams and in-memory fakes used by the benchmarks.
+
+The generator plays a simple marketplace: users forge and open packets, the
+oracle publishes the prompts and the images, users create and destroy cards,
+list their tokens and buy the listed ones. The ids follow the bit layouts of
+src/utils/utils.py and contracts/MetafusionPresident.sol, so the events can be
+fed to the tracker's handlers as if they came from the chain.
+'''
+
+import hashlib
+import json
+import random
+import numpy as np
+from PIL import Image
+from web3.datastructures import AttributeDict
+
+from ..utils.utils import cidToInt256, int256ToCid
+from ..utils.image_payload import encodeImage, buildManifest
+
+PACKET_SIZE = 8
+NUM_PROMPT_TYPES = 6
+MAX_PACKETS_PER_COLLECTION = 0x1FFF
+
+
+def packetId(packet_number: int, collection: int) -> int:
+    '''
+    id int32: pppp pppp pppp pppp cccc cccc cccc cccc
+    '''
+    return (packet_number << 16) | collection
+
+def promptId(packet_id: int, index: int, type_id: int) -> int:
+    '''
+    Same as _getPromptId in MetafusionPresident.sol.
+    '''
+    return (index << (16 + 13)) | (type_id << 13) | packet_id
+
+def imageId(prompts, seed: int) -> int:
+    '''
+    Merge the prompts like _mergePrompts in MetafusionPresident.sol and add the seed.
+    prompts[i] is the prompt of type i, or 0.
+    '''
+    merged = 0
+    for prompt in prompts:
+        merged = (merged << 32) | prompt
+    return (merged << 64) | (seed & 0xffffffffffffffff)
+
+def fakeCid(content: bytes) -> str:
+    '''
+    CIDv0 with the same multihash format expected by cidToInt256.
+    '''
+    return int256ToCid(int.from_bytes(hashlib.sha256(content).digest(), "big"))
+
+
+class FakeHttpClient(object):
+
+    def __init__(self, store):
+        self.store = store
+
+    def cat(self, cid):
+        return self.store[cid]
+
+    def get_json(self, cid):
+        return json.loads(self.store[cid])
+
+
+class FakeIPFSClient(object):
+    '''
+    In-memory replacement of the ipfs_api module used by the tracker.
+    '''
+
+    def __init__(self):
+        self.store = {}
+        self.http_client = FakeHttpClient(self.store)
+
+    def add(self, content: bytes) -> str:
+        cid = fakeCid(content)
+        self.store[cid] = content
+        return cid
+
+    def unpin(self, cid):
+        pass
+
+
+class EventStreamGenerator(object):
+    '''
+    Generate a realistic stream of tracker events.
+
+    weights: relative frequency of the user actions (forge, open, create, destroy, list, unlist, buy).
+    The oracle events (PromptCreated, ImageCreated) follow the actions that trigger them.
+    image_format: format of the card images, "webp", "png" or "json" for the legacy pixel lists.
+    '''
+
+    default_weights = {
+        "forge": 10,
+        "open": 8,
+        "create": 4,
+        "destroy": 1,
+        "list": 8,
+        "unlist": 2,
+        "buy": 6,
+    }
+
+    def __init__(self, ipfs: FakeIPFSClient, seed=0, users=100, collections=4, events_per_block=20, image_size=8, weights=None, image_format="webp"):
+        self.ipfs = ipfs
+        self.random = random.Random(seed)
+        self.users = ["0x" + self.random.getrandbits(160).to_bytes(20, "big").hex() for _ in range(users)]
+        self.collections = list(range(1, collections + 1))
+        self.events_per_block = events_per_block
+        self.image_size = image_size
+        self.image_format = image_format
+        self.weights = dict(weights or self.default_weights)
+
+        self.packets_per_collection = {collection: 0 for collection in self.collections}
+        # token id -> owner
+        self.packets = {}
+        self.prompts = {}
+        self.images = {}
+        self.frozen = set()
+        # (kind, token id) -> price
+        self.listed = {}
+
+        self.events = []
+        self.block_number = 1
+        self.log_index = 0
+        self.transactions = 0
+
+    def generate(self, count: int):
+        '''
+        Return at least `count` events, ordered by (blockNumber, logIndex).
+        '''
+        actions = list(self.weights)
+        weights = [self.weights[action] for action in actions]
+        while len(self.events) < count:
+            action = self.random.choices(actions, weights)[0]
+            getattr(self, action)()
+        return self.events
+
+    def emit(self, name, **args):
+        if self.log_index >= self.events_per_block:
+            self.block_number += 1
+            self.log_index = 0
+        self.transactions += 1
+        self.events.append(AttributeDict({
+            "event": name,
+            "args": AttributeDict(args),
+            "logIndex": self.log_index,
+            "transactionIndex": 0,
+            "transactionHash": self.transactions.to_bytes(32, "big"),
+            "address": "0x5FbDB2315678afecb367f032d93F642f64180aa3",
+            "blockHash": self.block_number.to_bytes(32, "big"),
+            "blockNumber": self.block_number,
+        }))
+        self.log_index += 1
+
+    def owned(self, tokens, user, exclude=()):
+        return [token for token, owner in tokens.items() if owner == user and token not in exclude]
+
+    def forge(self):
+        collection = self.random.choice(self.collections)
+        number = self.packets_per_collection[collection]
+        if number >= MAX_PACKETS_PER_COLLECTION:
+            return
+        self.packets_per_collection[collection] = number + 1
+        user = self.random.choice(self.users)
+        packet = packetId(number, collection)
+        self.packets[packet] = user
+        self.emit("PacketForged", blacksmith=user, packetId=packet)
+
+    def open(self):
+        unlisted = [packet for packet in self.packets if (0, packet) not in self.listed]
+        if not unlisted:
+            return
+        packet = self.random.choice(unlisted)
+        user = self.packets.pop(packet)
+        prompts = [promptId(packet, index, self.random.randrange(NUM_PROMPT_TYPES)) for index in range(PACKET_SIZE)]
+        self.emit("PacketOpened", opener=user, prompts=prompts)
+
+        # the oracle publishes the prompts
+        for prompt in prompts:
+            self.prompts[prompt] = user
+            content = json.dumps({
+                "name": f"prompt {prompt}",
+                "id": prompt,
+                "collection": prompt & 0x1FFF,
+                "type": (prompt >> 13) & 0x7,
+                "rarity": self.random.choice([1, 5, 10, 20, 100]),
+            }).encode("utf-8")
+            self.emit("PromptCreated", to=user, promptId=prompt, IPFSCid=cidToInt256(self.ipfs.add(content)))
+
+    def create(self):
+        user = self.random.choice(self.users)
+        available = self.owned(self.prompts, user, exclude=self.frozen)
+        by_type = {}
+        for prompt in available:
+            if (1, prompt) not in self.listed:
+                by_type.setdefault((prompt >> 13) & 0x7, prompt)
+        if not by_type:
+            return
+        prompts = [by_type.get(type_id, 0) for type_id in range(NUM_PROMPT_TYPES)]
+        image = imageId(prompts, self.random.getrandbits(64))
+        self.frozen.update(prompt for prompt in prompts if prompt)
+        self.images[image] = user
+        self.emit("CreateImage", creator=user, cardId=image)
+
+        # the oracle publishes the image
+        pixels = [[[self.random.randrange(256) for _ in range(3)] for _ in range(self.image_size)] for _ in range(self.image_size)]
+        if self.image_format == "json":
+            content = json.dumps({"image": json.dumps(pixels), "prompts": f"prompts of {image}"}).encode("utf-8")
+        else:
+            card_image = Image.fromarray(np.array(pixels, dtype="uint8"))
+            image_bytes, image_format = encodeImage(card_image, self.image_format)
+            manifest = buildManifest(self.ipfs.add(image_bytes), image_format, card_image, f"prompts of {image}")
+            content = json.dumps(manifest).encode("utf-8")
+        self.emit("ImageCreated", creator=user, imageId=image, IPFSCid=cidToInt256(self.ipfs.add(content)))
+
+    def destroy(self):
+        if not self.images:
+            return
+        image = self.random.choice(list(self.images))
+        user = self.images.pop(image)
+        self.listed.pop((2, image), None)
+        for shift in range(64, 256, 32):
+            self.frozen.discard((image >> shift) & 0xFFFFFFFF)
+        self.emit("DestroyImage", imageId=image, userId=user)
+
+    def tokens(self, kind):
+        return [self.packets, self.prompts, self.images][kind]
+
+    def list(self):
+        kind = self.random.randrange(3)
+        tokens = self.tokens(kind)
+        candidates = [token for token in tokens if (kind, token) not in self.listed and token not in self.frozen]
+        if not candidates:
+            return
+        token = self.random.choice(candidates)
+        price = self.random.randrange(1, 10 ** 18)
+        self.listed[(kind, token)] = price
+        name = ["UpdateListPacket", "UpdateListPrompt", "UpdateListImage"][kind]
+        self.emit(name, id=token, price=price, isListed=True, tokenOwner=tokens[token])
+
+    def unlist(self):
+        if not self.listed:
+            return
+        kind, token = self.random.choice(list(self.listed))
+        del self.listed[(kind, token)]
+        name = ["UpdateListPacket", "UpdateListPrompt", "UpdateListImage"][kind]
+        self.emit(name, id=token, price=0, isListed=False, tokenOwner=self.tokens(kind)[token])
+
+    def buy(self):
+        if not self.listed:
+            return
+        kind, token = self.random.choice(list(self.listed))
+        price = self.listed.pop((kind, token))
+        tokens = self.tokens(kind)
+        seller = tokens[token]
+        buyer = self.random.choice(self.users)
+        tokens[token] = buyer
+        if kind == 2:
+            # the prompts of a card follow it
+            for shift in range(64, 256, 32):
+                prompt = (token >> shift) & 0xFFFFFFFF
+                if prompt:
+                    self.prompts[prompt] = buyer
+        name = ["PacketTransfered", "PromptTransfered", "CardTransfered"][kind]
+        self.emit(name, buyer=buyer, seller=seller, id=token, value=price)
@@ -0,0 +1,190 @@
+'''
+Check of the transaction submitter of the oracle against a stand-in chain.
+
+The chain keeps a mempool ordered by the nonces of every account and mines
+the executable transactions when mine() is called. Every scenario submits
+`calls` contract calls spread over the signers, then alternates mine() and
+pump() until all the futures are done, and checks that the calls that had to
+succeed were mined, that the others failed, and that no signer is left with a
+nonce gap:
+
+- happy: every call is mined.
+- rejected: the node refuses every send of one call, which fails after
+  max_attempts sends; its nonce is filled and the later calls are mined.
+- dropped: the node accepts one call but drops it from the mempool every time.
+- replaced: another transaction of the signer takes the nonce of one call,
+  which is sent again with a new nonce and mined.
+- replaced_last_attempt: the same, when the call has no attempts left: it
+  fails without taking a new nonce.
+
+run from the root directory with:
+python3 -m src.benchmark.submitter
+python3 -m src.benchmark.submitter submitter.calls=200 submitter.max_attempts=3
+'''
+
+import hydra
+import json
+from types import SimpleNamespace
+from web3 import Web3
+from web3.exceptions import TransactionNotFound
+
+from ..oracle.submitter import TransactionSubmitter
+
+SCENARIOS = ["happy", "rejected", "dropped", "replaced", "replaced_last_attempt"]
+
+
+class StandInAccount(object):
+    '''
+    "Sign" a transaction by serializing it, its hash is the keccak of the serialization.
+    '''
+
+    def sign_transaction(self, tx, private_key):
+        raw = json.dumps(tx, sort_keys=True).encode()
+        return SimpleNamespace(rawTransaction=raw, hash=Web3.keccak(raw))
+
+
+class StandInChain(object):
+    '''
+    The eth module of a provider, with one mempool slot for every account and nonce.
+    rejected: data of the calls whose sends are refused.
+    dropped: data of the calls that are accepted and then dropped by the next mine().
+    '''
+
+    def __init__(self, rejected=(), dropped=()):
+        self.account = StandInAccount()
+        self.rejected = set(rejected)
+        self.dropped = set(dropped)
+        self.mined_nonces = {}
+        self.mempool = {}
+        self.receipts = {}
+        self.mined = []
+
+    def get_transaction_count(self, address, block_identifier):
+        nonce = self.mined_nonces.get(address, 0)
+        if block_identifier == "pending":
+            while (address, nonce) in self.mempool:
+                nonce += 1
+        return nonce
+
+    def send_raw_transaction(self, raw):
+        tx = json.loads(raw)
+        tx_hash = Web3.keccak(raw)
+        key = (tx["from"], tx["nonce"])
+        if tx["nonce"] < self.mined_nonces.get(tx["from"], 0):
+            raise ValueError("nonce too low")
+        if tx.get("data") in self.rejected:
+            raise ValueError("insufficient funds for gas * price + value")
+        if key in self.mempool:
+            current_hash, current = self.mempool[key]
+            if current_hash == tx_hash:
+                raise ValueError("already known")
+            if tx["gasPrice"] < current["gasPrice"] * 1.1:
+                raise ValueError("replacement transaction underpriced")
+        self.mempool[key] = (tx_hash, tx)
+        return tx_hash
+
+    def use_nonce(self, address):
+        '''
+        Mine a transaction of address sent outside of the submitter.
+        '''
+        nonce = self.mined_nonces.get(address, 0)
+        self.mempool.pop((address, nonce), None)
+        self.mined_nonces[address] = nonce + 1
+
+    def mine(self):
+        for key in [key for key, (_, tx) in self.mempool.items() if tx.get("data") in self.dropped]:
+            del self.mempool[key]
+        for address in {address for address, _ in self.mempool}:
+            nonce = self.mined_nonces.get(address, 0)
+            while (address, nonce) in self.mempool:
+                tx_hash, tx = self.mempool.pop((address, nonce))
+                self.receipts[tx_hash] = {"status": 1, "transactionHash": tx_hash}
+                self.mined.append(tx)
+                nonce += 1
+            self.mined_nonces[address] = nonce
+
+    def get_transaction_receipt(self, tx_hash):
+        if tx_hash not in self.receipts:
+            raise TransactionNotFound(f"{tx_hash.hex()} not mined")
+        return self.receipts[tx_hash]
+
+    def get_transaction(self, tx_hash):
+        for known_hash, tx in self.mempool.values():
+            if known_hash == tx_hash:
+                return tx
+        if tx_hash in self.receipts:
+            return self.receipts[tx_hash]
+        raise TransactionNotFound(f"{tx_hash.hex()} not found")
+
+
+class StandInCall(object):
+    '''
+    A contract call, identified by its data.
+    '''
+
+    def __init__(self, data: str):
+        self.data = data
+
+    def build_transaction(self, transaction):
+        return dict(transaction, chainId=31337, to="0x5FbDB2315678afecb367f032d93F642f64180aa3",
+                    data=self.data, gas=100000, gasPrice=10 ** 9, value=0)
+
+
+def runScenario(scenario, bench_cfg):
+    '''
+    Return the calls mined, the calls failed, the number of pumps and the signers left with a nonce gap.
+    '''
+    target = f"0x{bench_cfg.calls // 2:064x}"
+    chain = StandInChain(rejected=[target] if scenario == "rejected" else [],
+                         dropped=[target] if scenario == "dropped" else [])
+    signers = [(f"0x{idx + 1:040x}", "key") for idx in range(bench_cfg.signers)]
+    # every pump resubmits the calls that were not mined by the previous mine()
+    submitter = TransactionSubmitter(SimpleNamespace(eth=chain), signers, resubmit_after=0, max_attempts=bench_cfg.max_attempts)
+
+    futures = {}
+    for idx in range(bench_cfg.calls):
+        data = f"0x{idx:064x}"
+        futures[data] = submitter.submit(StandInCall(data))
+        if scenario.startswith("replaced") and data == target:
+            pending = submitter.pending[-1]
+            if scenario == "replaced_last_attempt":
+                pending.attempts = bench_cfg.max_attempts
+            # the transaction is dropped and, once the previous ones are mined, its nonce is used by another one
+            chain.mempool.pop((pending.signer.address, pending.nonce))
+            chain.mine()
+            chain.use_nonce(pending.signer.address)
+
+    pumps = 0
+    while not all(future.done() for future in futures.values()) or submitter.pending:
+        if pumps > 10 * bench_cfg.max_attempts:
+            raise AssertionError(f"{scenario}: the submitter did not settle after {pumps} pumps.")
+        chain.mine()
+        submitter.pump()
+        pumps += 1
+
+    mined = {data for data, future in futures.items() if future.exception() is None}
+    failed = set(futures) - mined
+    gaps = [signer.address for signer in submitter.signers
+            if signer.nonce != chain.get_transaction_count(signer.address, "latest")]
+    return target, mined, failed, pumps, gaps
+
+def check(scenario, target, mined, failed, gaps):
+    if gaps:
+        raise AssertionError(f"{scenario}: the nonce of {gaps} is ahead of the chain.")
+    expected_failed = {target} if scenario in ("rejected", "dropped", "replaced_last_attempt") else set()
+    if failed != expected_failed:
+        raise AssertionError(f"{scenario}: failed calls {sorted(failed)}, expected {sorted(expected_failed)}.")
+
+
+@hydra.main(config_path="../../conf", config_name="benchmark_config")
+def main(cfg):
+    bench_cfg = cfg.submitter
+    print(f"{'scenario':<24}{'mined':>8}{'failed':>8}{'pumps':>8}")
+    for scenario in SCENARIOS:
+        target, mined, failed, pumps, gaps = runScenario(scenario, bench_cfg)
+        print(f"{scenario:<24}{len(mined):>8}{len(failed):>8}{pumps:>8}")
+        check(scenario, target, mined, failed, gaps)
+    print("ok: the failed calls left no nonce gap")
+
+if __name__ == "__main__":
+    main()
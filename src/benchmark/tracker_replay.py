@@ -0,0 +1,163 @@
+'''
+Replay benchmark of the tracker.
+
+Feed a synthetic event stream through src.tracker.event_handler.applyBlocks
+with a fake IPFS client and a temporary SQLite database, like the tracker
+does with the blocks of its LogPoller: every event goes through the ledger of
+the applied logs and its savepoint, and every block through the undo journal.
+Report the throughput, the p50/p99 latency per event type and per
+transaction, and the size of the database.
+
+run from the root directory with:
+python3 -m src.benchmark.tracker_replay
+python3 -m src.benchmark.tracker_replay tracker_replay.events=100000 tracker_replay.database=bench.db
+'''
+
+import hydra
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import groupby
+from omegaconf import OmegaConf
+from web3 import Web3
+
+from ..db.data import Data
+from ..tracker import event_handler
+from ..tracker.event_handler import applyBlocks
+from ..tracker.enrichment import EnrichmentQueue
+from .streams import EventStreamGenerator, FakeIPFSClient
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def databaseSize(data):
+    cur = data.get_cursor()
+    try:
+        page_count = cur.execute("PRAGMA page_count;").fetchone()[0]
+        page_size = cur.execute("PRAGMA page_size;").fetchone()[0]
+        return page_count * page_size
+    finally:
+        cur.close()
+
+class ReplayedPoller(object):
+    '''
+    Position of a LogPoller that has read the blocks up to last_block, as applyBlocks expects it.
+    '''
+
+    def __init__(self):
+        self.last_block = None
+        self.last_block_hash = None
+
+
+@contextmanager
+def timedHandlers(latencies):
+    '''
+    Record the time of every handle_event call made by handleEvents, by event type.
+    '''
+    handle_event = event_handler.handle_event
+
+    def timed(event, *args):
+        begin = time.perf_counter()
+        handle_event(event, *args)
+        latencies.setdefault(event.event, []).append(time.perf_counter() - begin)
+
+    event_handler.handle_event = timed
+    try:
+        yield
+    finally:
+        event_handler.handle_event = handle_event
+
+def replay(events, data, IPFSClient, blocks_per_transaction, event_logger, journal_blocks=128):
+    '''
+    Apply the events with applyBlocks, one transaction every blocks_per_transaction blocks.
+    Return the latencies in seconds of every event type, and of the transactions.
+    '''
+    cfg = OmegaConf.create({"blocks_per_transaction": blocks_per_transaction, "journal_blocks": journal_blocks})
+    poller = ReplayedPoller()
+    latencies = {"transaction": []}
+    blocks = [list(block) for _, block in groupby(events, key=lambda event: event.blockNumber)]
+    with timedHandlers(latencies):
+        for start in range(0, len(blocks), blocks_per_transaction):
+            batch = [event for block in blocks[start:start + blocks_per_transaction] for event in block]
+            poller.last_block = batch[-1].blockNumber
+            poller.last_block_hash = Web3.to_hex(batch[-1].blockHash)
+            begin = time.perf_counter()
+            applyBlocks(batch, poller, None, None, IPFSClient, data, cfg, event_logger)
+            latencies["transaction"].append(time.perf_counter() - begin)
+    return latencies
+
+def drainEnrichment(IPFSClient, data, workers):
+    '''
+    Run the enrichment queue until it is empty, return the number of jobs and the elapsed time.
+    '''
+    queue = EnrichmentQueue(IPFSClient, data, workers=workers)
+    jobs = len(data.get_due_enrichment_jobs(float("inf"), 2 ** 31))
+    begin = time.perf_counter()
+    queue.pump()
+    while queue.in_flight:
+        time.sleep(0.001)
+        queue.pump()
+    queue.shutdown()
+    return jobs, time.perf_counter() - begin
+
+def report(latencies, total_time, events, db_size):
+    lines = [
+        f"events: {events}",
+        f"total time: {total_time:.3f}s",
+        f"throughput: {events / total_time:.1f} events/s",
+        f"database size: {db_size / 1024:.1f} KiB",
+        f"{'event':<20}{'count':>8}{'p50 (ms)':>12}{'p99 (ms)':>12}{'total (s)':>12}",
+    ]
+    for name, values in sorted(latencies.items()):
+        if not values:
+            continue
+        lines.append(f"{name:<20}{len(values):>8}{percentile(values, 0.5) * 1000:>12.3f}{percentile(values, 0.99) * 1000:>12.3f}{sum(values):>12.3f}")
+    return "\n".join(lines)
+
+
+@hydra.main(config_path="../../conf", config_name="benchmark_config")
+def main(cfg):
+    bench_cfg = cfg.tracker_replay
+    IPFSClient = FakeIPFSClient()
+    generator = EventStreamGenerator(IPFSClient, seed=bench_cfg.seed, users=bench_cfg.users, collections=bench_cfg.collections,
+                                     events_per_block=bench_cfg.events_per_block, image_size=bench_cfg.image_size,
+                                     image_format=bench_cfg.image_format)
+    events = generator.generate(bench_cfg.events)
+
+    # the handlers and the enrichment queue write the card images in ipfs/image/
+    workdir = tempfile.TemporaryDirectory()
+    os.makedirs(os.path.join(workdir.name, "ipfs", "image"))
+    database = bench_cfg.database
+    if database != ":memory:":
+        database = os.path.abspath(database)
+    os.chdir(workdir.name)
+
+    data = Data(create_db=True, wipe_db=True, database=database)
+    # the handlers log every event at info level, keep the formatting cost but not the output
+    event_logger = logging.getLogger("tracker_replay.events")
+    event_logger.setLevel(logging.WARNING)
+
+    begin = time.perf_counter()
+    latencies = replay(events, data, IPFSClient, bench_cfg.blocks_per_transaction, event_logger, bench_cfg.journal_blocks)
+    total_time = time.perf_counter() - begin
+    print(report(latencies, total_time, len(events), databaseSize(data)))
+    # handleEvents logs the failing events and goes on, only the handlers that returned are timed
+    applied = sum(len(values) for name, values in latencies.items() if name != "transaction")
+    if applied != len(events):
+        raise AssertionError(f"{len(events) - applied} events failed, see the warnings above.")
+
+    if bench_cfg.enrichment_workers > 0:
+        jobs, elapsed = drainEnrichment(IPFSClient, data, bench_cfg.enrichment_workers)
+        print(f"enrichment: {jobs} jobs in {elapsed:.3f}s ({jobs / max(elapsed, 1e-9):.1f} jobs/s)")
+        print(f"database size after enrichment: {databaseSize(data) / 1024:.1f} KiB")
+
+    workdir.cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+'''
+Non-blocking access to Data for the web API.
+
+The methods of Data are blocking SQLite calls: awaited on the event loop they
+would stall every other request. AsyncData runs the reads in a pool of
+threads, each with its own read-only connection (see
+DatabaseConnection.reader), and the writes in a single thread, since the
+writer connection is shared.
+'''
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .data import Data
+
+# methods of Data that only read, the others are run one at a time by the writer thread
+READ_METHODS = frozenset([
+	"get_packets_id_of", "get_prompts_id_of", "get_images_id_of",
+	"get_packet", "get_prompt", "get_image",
+	"is_packet_listed", "is_prompt_listed", "is_image_listed",
+	"get_page", "get_all_packets", "get_all_prompts", "get_all_images",
+	"get_token_transfer_events", "get_user_transfer_events",
+	"get_user", "get_username", "get_remainig_number_of_packets",
+	"get_checkpoint", "get_block_hash", "get_journaled_blocks", "get_due_enrichment_jobs",
+])
+
+
+class AsyncData(object):
+	'''
+	`await async_data.get_user(user_id)` runs `data.get_user(user_id)` in a thread.
+	readers: number of threads that run the reads.
+	'''
+
+	def __init__(self, data: Data, readers: int = 4):
+		self.data = data
+		self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+		self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+	def __getattr__(self, name):
+		method = getattr(self.data, name)
+		executor = self.readers if name in READ_METHODS else self.writer
+
+		async def call(*args, **kwargs):
+			return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(method, *args, **kwargs))
+
+		# __getattr__ is not called again for this name
+		setattr(self, name, call)
+		return call
+
+	def shutdown(self):
+		self.readers.shutdown(wait=True)
+		self.writer.shutdown(wait=True)
@@ -1,11 +1,57 @@
 from typing import Dict, List, Tuple
+from contextlib import contextmanager
 import sqlite3
 import base58
+import base64
 import json
 import os
 from ..utils.utils import *
 from .database import CreateDatabase, DatabaseConnection
 
+# sort of the list endpoints -> column; "created" is the order of insertion (the rowid):
+# a row written again with INSERT OR REPLACE, e.g. a card created again after DestroyImage, counts as created then
+LISTING_SORTS = {
+	"created": "rowid",
+	"price": "price",
+	"rarity": "rarity",
+}
+
+def encodeCursor(sort: str, value, rowid: int) -> str:
+	'''
+	Opaque cursor of a page: the sort and the position of its last row.
+	'''
+	return base64.urlsafe_b64encode(json.dumps([sort, value, rowid]).encode("utf-8")).decode("ascii")
+
+def decodeCursor(cursor: str, sort: str):
+	'''
+	Return the sort value and the rowid of a cursor made by encodeCursor for sort.
+	'''
+	try:
+		cursor_sort, value, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+	except Exception:
+		raise ValueError("invalid cursor")
+	if cursor_sort != sort:
+		raise ValueError("the cursor belongs to another sort")
+	key = sort.lstrip("-")
+	# the rarity can be NULL, the price and the rowid of "created" can not
+	if key == "rarity":
+		valid = value is None or isInteger(value, 1 << 63) or isinstance(value, float)
+	else:
+		valid = isInteger(value, 1 << 256 if key == "price" else 1 << 63)
+	if not valid or not isInteger(rowid, 1 << 63):
+		raise ValueError("invalid cursor")
+	return value, rowid
+
+def isInteger(value, bound: int) -> bool:
+	'''
+	True for an int in [0, bound); json gives bools for true and false, and bool is a subclass of int.
+	'''
+	return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < bound
+
+def priceFilters(min_price: int, max_price: int):
+	return [("price >= ?", from_int_to_uint256(min_price) if min_price is not None else None),
+			("price <= ?", from_int_to_uint256(max_price) if max_price is not None else None)]
+
 class Packet:
 
 	def __init__(self):
@@ -15,9 +61,9 @@ class Packet:
 		self.userIdHex: str = ''
 
 	def initWithDb(self, res):
-		self.id = from_str_hex_to_int(res[0])
+		self.id = res[0]
 		self.isListed = res[1]
-		self.price = from_str_hex_to_int(res[2])
+		self.price = from_uint256_to_int(res[2])
 		self.userIdHex = res[3].lower()
 		return self
 	def initWithParams(self, id, userIdHex: str, isListed: bool = False, price: int = 0, data=None):
@@ -30,7 +76,7 @@ class Packet:
 	
 	def writeToDb(self, data):
 		cur = data.get_cursor()
-		cur.execute('INSERT OR REPLACE INTO Packets(id, isListed, price, userHex, collectionId) VALUES (?, ?, ?, ?, ?)', (from_int_to_hex_str(self.id), self.isListed, from_int_to_hex_str(self.price), self.userIdHex, self.getOriginalCollection()))
+		cur.execute('INSERT OR REPLACE INTO Packets(id, isListed, price, userHex, collectionId) VALUES (?, ?, ?, ?, ?)', (self.id, self.isListed, from_int_to_uint256(self.price), self.userIdHex, self.getOriginalCollection()))
 		data.con.commit()
 		cur.close()
 
@@ -60,7 +106,7 @@ class Prompt:
 		self.id = res[0]
 		self.hash = res[1]
 		self.isListed = res[2]
-		self.price = from_str_hex_to_int(res[3])
+		self.price = from_uint256_to_int(res[3])
 		self.isFreezed = res[4]
 		self.userIdHex = res[5].lower()
 		self.name = res[6]
@@ -80,13 +126,22 @@ class Prompt:
 
 	def writeToDb(self, data):
 		cur = data.get_cursor()
-		cur.execute('INSERT OR REPLACE INTO Prompts(id, ipfsHash, isListed, price, isFreezed, userHex, name, collectionId, type, rarity) VALUES (?, ?, ?, ?, ? , ?, ?, ?, ?, ?)', (from_int_to_hex_str(self.id), self.hash, self.isListed, from_int_to_hex_str(self.price), self.isFreezed, self.userIdHex, self.name, self.getOriginalCollection(), self.getType(), self.rarity))
+		cur.execute('INSERT OR REPLACE INTO Prompts(id, ipfsHash, isListed, price, isFreezed, userHex, name, collectionId, type, rarity) VALUES (?, ?, ?, ?, ? , ?, ?, ?, ?, ?)', (self.id, self.hash, self.isListed, from_int_to_uint256(self.price), self.isFreezed, self.userIdHex, self.name, self.getOriginalCollection(), self.getType(), self.rarity))
 		data.con.commit()
 		cur.close()
 
 	def addIPFSHash(self, id, promptCid, name, rarity, data):
 		cur = data.get_cursor()
-		cur.execute('UPDATE Prompts SET ipfsHash=?, name=?, rarity=? WHERE id=?', (promptCid, name, rarity, from_int_to_hex_str(id)))
+		cur.execute("UPDATE Prompts SET ipfsHash=?, name=?, rarity=?, enrichment='done' WHERE id=?", (promptCid, name, rarity, id))
+		data.con.commit()
+		cur.close()
+
+	def setIPFSHash(self, id, promptCid, data):
+		'''
+		Set the IPFS hash only, the name and the rarity are added by the enrichment queue.
+		'''
+		cur = data.get_cursor()
+		cur.execute("UPDATE Prompts SET ipfsHash=?, enrichment='pending' WHERE id=?", (promptCid, id))
 		data.con.commit()
 		cur.close()
 
@@ -119,10 +174,10 @@ class Image:
 		self.prompts: str = ''
 
 	def initWithDb(self, res):
-		self.id = res[0]
+		self.id = from_uint256_to_int(res[0])
 		self.hash = res[1]
 		self.isListed = res[2]
-		self.price = from_str_hex_to_int(res[3])
+		self.price = from_uint256_to_int(res[3])
 		self.userIdHex = res[4].lower()
 		self.prompts = res[5]
 		return self
@@ -139,33 +194,38 @@ class Image:
 
 	def freezePrompts(self, data):
 		_, prompts = getInfoFromImageId(self.id)
-		for prompt in prompts:
-			if prompt != 0:
-				data.freeze_prompt(prompt_id=prompt)
+		data.freeze_prompts([prompt for prompt in prompts if prompt != 0])
 				
 	def unfreezePrompts(self, data):
 		if isinstance(self.id, str):
 			self.id = from_str_hex_to_int(self.id)
 		_, prompts = getInfoFromImageId(self.id)
-		for prompt in prompts:
-			if prompt != 0:
-				data.unfreeze_prompt(prompt_id=prompt)
+		data.unfreeze_prompts([prompt for prompt in prompts if prompt != 0])
 		
 	def writeToDb(self, data):
 		cur = data.get_cursor()
-		cur.execute('INSERT OR REPLACE INTO Images(id, ipfsHash, isListed, price, userHex, collectionId) VALUES (?, ?, ?, ?, ?, ?)', (from_int_to_hex_str(self.id), self.hash, self.isListed, from_int_to_hex_str(self.price), self.userIdHex, self.getOriginalCollection()))
+		cur.execute('INSERT OR REPLACE INTO Images(id, ipfsHash, isListed, price, userHex, collectionId) VALUES (?, ?, ?, ?, ?, ?)', (from_int_to_uint256(self.id), self.hash, self.isListed, from_int_to_uint256(self.price), self.userIdHex, self.getOriginalCollection()))
 		data.con.commit()
 		cur.close()
 	
 	def addIPFSHash(self, id, imageCid, prompts, data):
 		cur = data.get_cursor()
-		cur.execute('UPDATE Images SET ipfsHash=?, prompts=? WHERE id=?', (imageCid, prompts, from_int_to_hex_str(id)))
+		cur.execute("UPDATE Images SET ipfsHash=?, prompts=?, enrichment='done' WHERE id=?", (imageCid, prompts, from_int_to_uint256(id)))
+		data.con.commit()
+		cur.close()
+
+	def setIPFSHash(self, id, imageCid, data):
+		'''
+		Set the IPFS hash only, the image and its prompts are added by the enrichment queue.
+		'''
+		cur = data.get_cursor()
+		cur.execute("UPDATE Images SET ipfsHash=?, enrichment='pending' WHERE id=?", (imageCid, from_int_to_uint256(id)))
 		data.con.commit()
 		cur.close()
 
 	def deleteFromDb(self, data):
 		cur = data.get_cursor()
-		cur.execute('DELETE FROM Images WHERE id=?', (from_int_to_hex_str(self.id),))
+		cur.execute('DELETE FROM Images WHERE id=?', (from_int_to_uint256(self.id),))
 		data.con.commit()
 		cur.close()
 
@@ -196,29 +256,77 @@ class Image:
 
 
 class Data:
-	def __init__(self, create_db: bool = False):
-		self.con = DatabaseConnection(create_db)
+	def __init__(self, create_db: bool = False, wipe_db: bool = None, database: str = "tracker.db", pragmas: dict = None):
+		'''
+		create_db: create the missing tables.
+		wipe_db: delete the database file first. By default it follows create_db.
+		database: path of the SQLite database, ":memory:" for an in-memory one.
+		pragmas: PRAGMA name -> value, see DEFAULT_PRAGMAS.
+		'''
+		if wipe_db is None:
+			wipe_db = create_db
+		self.con = DatabaseConnection(wipe_db, database, pragmas)
 		
 		if create_db:
 			cd = CreateDatabase(self.con)
 			cd.create()
+		elif CreateDatabase(self.con).needs_migration():
+			raise RuntimeError(f"{database} has an older schema, migrate it with: python3 -m src.db.migrate database={database}")
 		
 
 	def get_cursor(self):
-		return self.con().cursor()
+		return self.con.get_cursor()
+
+	def get_read_cursor(self):
+		'''
+		Cursor of the reader of the calling thread, for the methods that only read.
+		'''
+		return self.con.get_read_cursor()
+
+	@contextmanager
+	def unit_of_work(self):
+		'''
+		Run all the writes of the block in a single transaction.
+		The single methods do not commit while a unit of work is open.
+		'''
+		self.con.begin()
+		try:
+			yield self
+		except BaseException:
+			self.con.end(commit=False)
+			raise
+		self.con.end()
+
+	@contextmanager
+	def savepoint(self, name: str = "event"):
+		'''
+		Undo only the writes made in this block if it raises, without aborting the unit of work.
+		'''
+		con = self.con()
+		self.con.begin()
+		con.execute(f'SAVEPOINT {name}')
+		try:
+			yield self
+		except BaseException:
+			con.execute(f'ROLLBACK TO {name}')
+			con.execute(f'RELEASE {name}')
+			self.con.end()
+			raise
+		con.execute(f'RELEASE {name}')
+		self.con.end()
 
 
 	def get_packets_id_of(self, userIdHex: str, tiny=False):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
 			result = []
 			cur.execute('SELECT id, isListed, price, collectionId FROM Packets WHERE userHex=?', (userIdHex,))
 			query_result = cur.fetchall()
 			for row in query_result:
 				result.append({
-					"id": row[0], 
+					"id": from_int_to_hex_str(row[0]), 
 					"isListed": row[1], 
-					"price": from_str_hex_to_int(row[2]), 
+					"price": from_uint256_to_int(row[2]), 
 					"collectionId": row[3],
 					"nft_type": 0})
 			return result
@@ -226,16 +334,16 @@ class Data:
 			cur.close()
 	
 	def get_prompts_id_of(self, userIdHex: str, tiny=False):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
 			result = []
 			cur.execute('SELECT id, isListed, price, isFreezed, name, type, collectionId, rarity FROM Prompts WHERE userHex=?', (userIdHex,))
 			query_result = cur.fetchall()
 			for row in query_result:
 				result.append({
-					"id": row[0], 
+					"id": from_int_to_hex_str(row[0]), 
 					"isListed": row[1], 
-					"price": from_str_hex_to_int(row[2]), 
+					"price": from_uint256_to_int(row[2]), 
 					"isFreezed": row[3], 
 					"name": row[4], 
 					"category": row[5], 
@@ -247,16 +355,16 @@ class Data:
 			cur.close()
 	
 	def get_images_id_of(self, userIdHex: str, tiny=False):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
 			result = []
 			cur.execute('SELECT id, isListed, price, collectionId, prompts FROM Images WHERE userHex=?', (userIdHex,))
 			query_result = cur.fetchall()
 			for row in query_result:
 				result.append({
-					"id": row[0], 
+					"id": from_int_to_hex_str(from_uint256_to_int(row[0])), 
 					"isListed": row[1], 
-					"price": from_str_hex_to_int(row[2]), 
+					"price": from_uint256_to_int(row[2]), 
 					"collectionId": row[3],
 					"prompts": row[4],
 					"nft_type": 2})
@@ -266,18 +374,19 @@ class Data:
 		
 
 	def get_packet(self, packet_id, as_json=False):
-		if isinstance(packet_id, int):
-			packet_id = from_int_to_hex_str(packet_id)
-		cur = self.get_cursor()
+		packet_id = from_id_to_int(packet_id)
+		if packet_id is None:
+			return None
+		cur = self.get_read_cursor()
 		try:
 			cur.execute('SELECT * FROM Packets WHERE id=?', (packet_id,))
 			res = cur.fetchone()
 			if res is not None:
 				if as_json:
 					return {
-						"id": res[0],
+						"id": from_int_to_hex_str(res[0]),
 						"isListed": res[1],
-						"price": from_str_hex_to_int(res[2]),
+						"price": from_uint256_to_int(res[2]),
 						"owner": res[3],
 						"collectionId": res[4],
 						"nft_type": 0
@@ -287,27 +396,27 @@ class Data:
 			cur.close()
 	
 	def get_prompt(self, prompt_id, as_json=False):
-		if isinstance(prompt_id, int):
-			prompt_id = from_int_to_hex_str(prompt_id)
-		if prompt_id == "0x0":
+		prompt_id = from_id_to_int(prompt_id)
+		if not prompt_id:
 			return None
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
 			cur.execute('SELECT * FROM Prompts WHERE id=?', (prompt_id,))
 			res = cur.fetchone()
 			if res is not None:
 				if as_json:
 					return {
-						"id": res[0],
+						"id": from_int_to_hex_str(res[0]),
 						"ipfsCid": res[1],
 						"isListed": res[2],
-						"price": from_str_hex_to_int(res[3]),
+						"price": from_uint256_to_int(res[3]),
 						"isFreezed": res[4],
 						"owner": res[5],
 						"name": res[6],
 						"category": res[7],
 						"collectionId": res[8],
 						"rarity": res[9],
+						"enrichment": res[10],
 						"nft_type": 1
 					}
 				return Prompt().initWithDb(res)
@@ -315,27 +424,29 @@ class Data:
 			cur.close()
 	
 	def get_image(self, image_id: str, as_json=False):
-		if isinstance(image_id, int):
-			image_id = from_int_to_hex_str(image_id)
-		cur = self.get_cursor()
+		image_id = from_id_to_int(image_id)
+		if image_id is None:
+			return None
+		cur = self.get_read_cursor()
 		try:
-			cur.execute('SELECT * FROM Images WHERE id=?', (image_id,))
+			cur.execute('SELECT * FROM Images WHERE id=?', (from_int_to_uint256(image_id),))
 			res = cur.fetchone()
 			if res is not None:
 				# get prompts that are in this image
-				_, prompts = getInfoFromImageId(from_str_hex_to_int(image_id))
+				_, prompts = getInfoFromImageId(image_id)
 
 				if as_json:
 					return {
-						"id": res[0],
+						"id": from_int_to_hex_str(image_id),
 						"ipfsCid": res[1],
 						"isListed": res[2],
-						"price": from_str_hex_to_int(res[3]),
+						"price": from_uint256_to_int(res[3]),
 						"owner": res[4],
 						"collectionId": res[5],
 						"prompts": sorted([
-							self.get_prompt(from_int_to_hex_str(prompt), as_json=True) for prompt in prompts if prompt != 0
+							self.get_prompt(prompt, as_json=True) for prompt in prompts if prompt != 0
 						], key=lambda x: x["category"]),
+						"enrichment": res[7],
 						"nft_type": 2
 					}
 				return Image().initWithDb(res)
@@ -344,9 +455,9 @@ class Data:
 	
 	
 	def is_packet_listed(self, packet_id: int):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
-			cur.execute('SELECT COUNT(DISTINCT ID) as c FROM Packets WHERE isListed=1 and id=?', (from_int_to_hex_str(packet_id),))
+			cur.execute('SELECT COUNT(DISTINCT ID) as c FROM Packets WHERE isListed=1 and id=?', (packet_id,))
 			# cur.execute('SELECT isListed FROM Packets WHERE id=? LIMIT 1', (from_int_to_hex_str(packet_id),))
 			res = cur.fetchone()
 			if res is not None:
@@ -356,9 +467,9 @@ class Data:
 			cur.close()
 	
 	def is_prompt_listed(self, prompt_id: int):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
-			cur.execute('SELECT COUNT(DISTINCT ID) as c FROM Prompts WHERE isListed=1 and id=?', (from_int_to_hex_str(prompt_id),))
+			cur.execute('SELECT COUNT(DISTINCT ID) as c FROM Prompts WHERE isListed=1 and id=?', (prompt_id,))
 			# cur.execute('SELECT isListed FROM Prompts WHERE id=? LIMIT 1', (from_int_to_hex_str(packet_id),))
 			res = cur.fetchone()
 			if res is not None:
@@ -368,9 +479,9 @@ class Data:
 			cur.close()
 	
 	def is_image_listed(self, image_id: int):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
-			cur.execute('SELECT isListed FROM Images WHERE id=?', (from_int_to_hex_str(image_id),))
+			cur.execute('SELECT isListed FROM Images WHERE id=?', (from_int_to_uint256(image_id),))
 			# cur.execute('SELECT isListed FROM Images WHERE id=? LIMIT 1', (from_int_to_hex_str(packet_id),))
 			res = cur.fetchone()
 			if res is not None:
@@ -380,75 +491,145 @@ class Data:
 			cur.close()
 	
 
-	def get_all_packets(self, only_listed=True):
-		cur = self.get_cursor()
+	def get_page(self, table: str, columns: str, sorts, filters, only_listed: bool, sort: str, limit: int, cursor: str):
+		'''
+		Return a page of the rows of table, ordered by sort, and the cursor of the next page (None after the last one).
+		sorts: the keys of LISTING_SORTS allowed for table.
+		filters: list of (condition, parameter); the conditions whose parameter is None are skipped.
+		sort: a key of sorts, descending with a "-" prefix.
+		limit: rows per page, None for all of them.
+		cursor: the cursor of the previous page, None for the first one.
+		Raise ValueError for an unknown sort or an invalid cursor.
+		'''
+		descending = sort.startswith("-")
+		key = sort[1:] if descending else sort
+		if key not in sorts:
+			raise ValueError(f"sort should be one of {list(sorts)}, with an optional - prefix")
+		column = LISTING_SORTS[key]
+		conditions = ["isListed = 1"] if only_listed else []
+		parameters = []
+		for condition, parameter in filters:
+			if parameter is not None:
+				conditions.append(condition)
+				parameters.append(parameter)
+		# keyset pagination: the rows after the last one of the previous page, the rowid breaks the ties
+		comparison = "<" if descending else ">"
+		if cursor is not None:
+			value, rowid = decodeCursor(cursor, sort)
+			if column == "rowid":
+				conditions.append(f"rowid {comparison} ?")
+				parameters.append(rowid)
+			elif value is None:
+				# the NULLs come first in ascending order, last in descending order
+				conditions.append(f"(({column} IS NULL AND rowid {comparison} ?)" + (")" if descending else f" OR {column} IS NOT NULL)"))
+				parameters.append(rowid)
+			else:
+				conditions.append(f"(({column}, rowid) {comparison} (?, ?)" + (f" OR {column} IS NULL)" if descending else ")"))
+				parameters += [from_int_to_uint256(value) if column == "price" else value, rowid]
+		direction = "DESC" if descending else "ASC"
+		order = f"rowid {direction}" if column == "rowid" else f"{column} {direction}, rowid {direction}"
+		query = f"SELECT rowid, {column}, {columns} FROM {table}"
+		if conditions:
+			query += " WHERE " + " AND ".join(conditions)
+		query += f" ORDER BY {order}"
+		if limit is not None:
+			# one more row tells if there is a next page
+			query += " LIMIT ?"
+			parameters.append(limit + 1)
+		cur = self.get_read_cursor()
 		try:
-			cur.execute('SELECT id, isListed, price, collectionId FROM Packets WHERE isListed=1')
-			result = cur.fetchall()
-			response = []
-			if result is not None:
-				for row in result:
-					response.append({
-						"id": row[0], 
-						"isListed": row[1], 
-						"price": from_str_hex_to_int(row[2]), 
-						"collectionId": row[3],
-						"nft_type": 0
-					})
-			return response
+			rows = cur.execute(query, parameters).fetchall()
 		finally:
 			cur.close()
+		next_cursor = None
+		if limit is not None and len(rows) > limit:
+			rows = rows[:limit]
+			last = rows[-1]
+			next_cursor = encodeCursor(sort, from_uint256_to_int(last[1]) if column == "price" else last[1], last[0])
+		return [row[2:] for row in rows], next_cursor
+
+	def get_all_packets(self, only_listed=True, collection_id: int = None, owner: str = None, min_price: int = None, max_price: int = None,
+						sort: str = "-created", limit: int = None, cursor: str = None):
+		'''
+		Return a page of the packets and the cursor of the next page, see get_page.
+		sort: created or price.
+		'''
+		rows, next_cursor = self.get_page("Packets", "id, isListed, price, collectionId", ("created", "price"),
+										  priceFilters(min_price, max_price) + [
+											  ("collectionId = ?", collection_id),
+											  ("userHex = ?", owner.lower() if owner is not None else None),
+										  ], only_listed, sort, limit, cursor)
+		response = []
+		for row in rows:
+			response.append({
+				"id": from_int_to_hex_str(row[0]), 
+				"isListed": row[1], 
+				"price": from_uint256_to_int(row[2]), 
+				"collectionId": row[3],
+				"nft_type": 0
+			})
+		return response, next_cursor
 	
-	def get_all_prompts(self, only_listed=True):
-		cur = self.get_cursor()
-		try:
-			cur.execute('SELECT id, isListed, price, isFreezed, name, type, collectionId, rarity FROM Prompts WHERE isListed=1')
-			res = cur.fetchall()
-			ret = []
-			if res is not None:
-				for row in res:
-					ret.append({
-						"id": row[0],
-						"isListed": row[1],
-						"price": from_str_hex_to_int(row[2]),
-						"isFreezed": row[3],
-						"name": row[4],
-						"category": row[5],
-						"collectionId": row[6],
-						"rarity": row[7],
-						"nft_type": 1
-					})
-			return ret
-		finally:
-			cur.close()
+	def get_all_prompts(self, only_listed=True, collection_id: int = None, owner: str = None, min_price: int = None, max_price: int = None,
+						category: int = None, min_rarity: float = None, max_rarity: float = None,
+						sort: str = "-created", limit: int = None, cursor: str = None):
+		'''
+		Return a page of the prompts and the cursor of the next page, see get_page.
+		sort: created, price or rarity.
+		'''
+		rows, next_cursor = self.get_page("Prompts", "id, isListed, price, isFreezed, name, type, collectionId, rarity", ("created", "price", "rarity"),
+										  priceFilters(min_price, max_price) + [
+											  ("collectionId = ?", collection_id),
+											  ("userHex = ?", owner.lower() if owner is not None else None),
+											  ("type = ?", category),
+											  ("rarity >= ?", min_rarity),
+											  ("rarity <= ?", max_rarity),
+										  ], only_listed, sort, limit, cursor)
+		ret = []
+		for row in rows:
+			ret.append({
+				"id": from_int_to_hex_str(row[0]),
+				"isListed": row[1],
+				"price": from_uint256_to_int(row[2]),
+				"isFreezed": row[3],
+				"name": row[4],
+				"category": row[5],
+				"collectionId": row[6],
+				"rarity": row[7],
+				"nft_type": 1
+			})
+		return ret, next_cursor
 
 	
-	def get_all_images(self, only_listed=True):
-		cur = self.get_cursor()
-		try:
-			cur.execute('SELECT id, isListed, price, collectionId, prompts FROM Images WHERE isListed=1')
-			res = cur.fetchall()
-			ret = []
-			if res is not None:
-				for row in res:
-					ret.append({
-						"id": row[0],
-						"isListed": row[1],
-						"price": from_str_hex_to_int(row[2]),
-						"collectionId": row[3],
-						"prompts": row[4],
-						"nft_type": 2
-					})
-			return ret
-		finally:
-			cur.close()
+	def get_all_images(self, only_listed=True, collection_id: int = None, owner: str = None, min_price: int = None, max_price: int = None,
+					   sort: str = "-created", limit: int = None, cursor: str = None):
+		'''
+		Return a page of the cards and the cursor of the next page, see get_page.
+		sort: created or price.
+		'''
+		rows, next_cursor = self.get_page("Images", "id, isListed, price, collectionId, prompts", ("created", "price"),
+										  priceFilters(min_price, max_price) + [
+											  ("collectionId = ?", collection_id),
+											  ("userHex = ?", owner.lower() if owner is not None else None),
+										  ], only_listed, sort, limit, cursor)
+		ret = []
+		for row in rows:
+			ret.append({
+				"id": from_int_to_hex_str(from_uint256_to_int(row[0])),
+				"isListed": row[1],
+				"price": from_uint256_to_int(row[2]),
+				"collectionId": row[3],
+				"prompts": row[4],
+				"nft_type": 2
+			})
+		return ret, next_cursor
 	
 
 	def list_packet(self, packet_id: int, price: int, token_owner: str):
 		cur = self.get_cursor()
 		try:
 			cur.execute('UPDATE Packets SET isListed = 1, price = ? WHERE id = ? AND userHex = ?', 
-				(from_int_to_hex_str(price), from_int_to_hex_str(packet_id), token_owner))
+				(from_int_to_uint256(price), packet_id, token_owner))
 			self.con.commit()
 			return True
 		finally:
@@ -458,7 +639,7 @@ class Data:
 		cur = self.get_cursor()
 		try:
 			cur.execute('UPDATE Prompts SET isListed = 1, price = ? WHERE id = ? AND userHex = ?', 
-			   (from_int_to_hex_str(price), from_int_to_hex_str(prompt_id), token_owner))
+			   (from_int_to_uint256(price), prompt_id, token_owner))
 			self.con.commit()
 			return True
 		finally:
@@ -468,7 +649,7 @@ class Data:
 		cur = self.get_cursor()
 		try:
 			cur.execute('UPDATE Images SET isListed = 1, price = ? WHERE id = ? AND userHex = ?', 
-			   (from_int_to_hex_str(price), from_int_to_hex_str(image_id), token_owner))
+			   (from_int_to_uint256(price), from_int_to_uint256(image_id), token_owner))
 			self.con.commit()
 			return True
 		finally:
@@ -478,7 +659,7 @@ class Data:
 	def unlist_prompt(self, prompt_id: int, token_owner: str):
 		cur = self.get_cursor()
 		try:
-			cur.execute('UPDATE Prompts SET isListed = 0 WHERE id = ? AND userHex = ?', (from_int_to_hex_str(prompt_id), token_owner))
+			cur.execute('UPDATE Prompts SET isListed = 0 WHERE id = ? AND userHex = ?', (prompt_id, token_owner))
 			self.con.commit()
 			return True
 		finally:
@@ -487,7 +668,7 @@ class Data:
 	def unlist_image(self, image_id: int, token_owner: str):
 		cur = self.get_cursor()
 		try:
-			cur.execute('UPDATE Images SET isListed = 0 WHERE id = ? AND userHex = ?', (from_int_to_hex_str(image_id), token_owner))
+			cur.execute('UPDATE Images SET isListed = 0 WHERE id = ? AND userHex = ?', (from_int_to_uint256(image_id), token_owner))
 			self.con.commit()
 			return True
 		finally:
@@ -496,7 +677,7 @@ class Data:
 	def unlist_packet(self, packet_id: int, token_owner: str):
 		cur = self.get_cursor()
 		try:
-			cur = cur.execute('UPDATE Packets SET isListed = 0 WHERE id = ? AND userHex = ?', (from_int_to_hex_str(packet_id), token_owner))
+			cur = cur.execute('UPDATE Packets SET isListed = 0 WHERE id = ? AND userHex = ?', (packet_id, token_owner))
 			self.con.commit()
 			return True
 		finally:
@@ -505,7 +686,7 @@ class Data:
 	def remove_packet_from(self, packet_id: int, user_id: str):
 		cur = self.get_cursor()
 		try:
-			cur.execute('DELETE FROM Packets WHERE id=?', (from_int_to_hex_str(packet_id),))
+			cur.execute('DELETE FROM Packets WHERE id=?', (packet_id,))
 			self.con.commit()
 			return True
 		finally:
@@ -515,7 +696,7 @@ class Data:
 		cur = self.get_cursor()
 		try:
 			print("FREEZING PROMPT: ", prompt_id, "...")
-			cur.execute('UPDATE Prompts SET isFreezed=1, isListed=0 WHERE id=?', (from_int_to_hex_str(prompt_id),))
+			cur.execute('UPDATE Prompts SET isFreezed=1, isListed=0 WHERE id=?', (prompt_id,))
 			self.con.commit()
 			return True
 		finally:
@@ -523,7 +704,44 @@ class Data:
 	def unfreeze_prompt(self, prompt_id: int):
 		cur = self.get_cursor()
 		try:
-			cur.execute('UPDATE Prompts SET isFreezed=0 WHERE id=?', (from_int_to_hex_str(prompt_id),))
+			cur.execute('UPDATE Prompts SET isFreezed=0 WHERE id=?', (prompt_id,))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def write_prompts(self, prompts: List[Prompt]):
+		'''
+		Insert or replace the prompts with a single statement, in a single transaction.
+		'''
+		with self.unit_of_work():
+			cur = self.get_cursor()
+			try:
+				cur.executemany('INSERT OR REPLACE INTO Prompts(id, ipfsHash, isListed, price, isFreezed, userHex, name, collectionId, type, rarity) VALUES (?, ?, ?, ?, ? , ?, ?, ?, ?, ?)',
+								[(prompt.id, prompt.hash, prompt.isListed, from_int_to_uint256(prompt.price), prompt.isFreezed, prompt.userIdHex, prompt.name,
+								  prompt.getOriginalCollection(), prompt.getType(), prompt.rarity) for prompt in prompts])
+				return True
+			finally:
+				cur.close()
+
+	def freeze_prompts(self, prompt_ids: List[int]):
+		'''
+		Freeze (and unlist) the prompts of a card with a single statement.
+		'''
+		return self.update_prompts('isFreezed=1, isListed=0', (), prompt_ids)
+
+	def unfreeze_prompts(self, prompt_ids: List[int]):
+		return self.update_prompts('isFreezed=0', (), prompt_ids)
+
+	def update_prompts(self, assignments: str, parameters: tuple, prompt_ids: List[int]):
+		'''
+		Run UPDATE Prompts SET assignments WHERE id IN prompt_ids.
+		'''
+		if not prompt_ids:
+			return True
+		cur = self.get_cursor()
+		try:
+			cur.execute(f'UPDATE Prompts SET {assignments} WHERE id IN ({", ".join("?" * len(prompt_ids))})', (*parameters, *prompt_ids))
 			self.con.commit()
 			return True
 		finally:
@@ -534,7 +752,7 @@ class Data:
 		img.unfreezePrompts(self)
 		cur = self.get_cursor()
 		try:
-			cur.execute('DELETE FROM Images WHERE id=? and userHex=?', (from_int_to_hex_str(image_id.id), user_id))
+			cur.execute('DELETE FROM Images WHERE id=? and userHex=?', (from_int_to_uint256(image_id), user_id))
 			self.con.commit()
 			return True
 		finally:
@@ -544,43 +762,46 @@ class Data:
 	def addTransferEvent(self, objId: int, from_user_id: str, to_user_id: str, objType, price: int):
 		obj = None
 		if objType == 0:
-			obj = self.get_packet(from_int_to_hex_str(objId))
+			obj = self.get_packet(objId)
 		elif objType == 1:
-			obj = self.get_prompt(from_int_to_hex_str(objId))
+			obj = self.get_prompt(objId)
 		elif objType == 2:
-			obj = self.get_image(from_int_to_hex_str(objId))
+			obj = self.get_image(objId)
 		if(obj is None):
 			print("[addTransferEvent] INVALID OBJ TYPE!!!")
 			return
 		
 		cur = self.get_cursor()
 		try:
-			cur.execute('INSERT INTO SellEvents(objId, userFromHex, userToHex, price, type) values (?, ?, ?, ?, ?)', (from_int_to_hex_str(objId), from_user_id, to_user_id,from_int_to_hex_str(price), objType))
+			cur.execute('INSERT INTO SellEvents(objId, userFromHex, userToHex, price, type) values (?, ?, ?, ?, ?)', (from_int_to_uint256(objId), from_user_id, to_user_id, from_int_to_uint256(price), objType))
 			self.con.commit()
 			return True
 		finally:
 			cur.close()
 
 	def get_token_transfer_events(self, objId: str):
-		cur = self.get_cursor()
+		objId = from_id_to_int(objId)
+		if objId is None:
+			return []
+		cur = self.get_read_cursor()
 		try:
-			cur.execute('SELECT objId, userFromHex, userToHex, price, type FROM SellEvents WHERE objId=? ORDER BY id', (objId,))
+			cur.execute('SELECT objId, userFromHex, userToHex, price, type FROM SellEvents WHERE objId=? ORDER BY id', (from_int_to_uint256(objId),))
 			result = cur.fetchall()
 			if result is not None:
 				response = []
 				for row in result:
 					response.append({
-						"id": row[0], 
+						"id": from_int_to_hex_str(from_uint256_to_int(row[0])), 
 					  	"seller": row[1], 
 						"buyer": row[2], 
-						"price": from_str_hex_to_int(row[3]), 
+						"price": from_uint256_to_int(row[3]), 
 						"type": row[4]})
 				return response
 		finally:
 			cur.close()
 
 	def get_user_transfer_events(self, user_id: str):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
 			cur.execute('SELECT objId, userFromHex, userToHex, price, type FROM SellEvents WHERE userFromHex=? or userToHex=? ORDER BY id', (user_id, user_id))
 			result = cur.fetchall()
@@ -588,55 +809,79 @@ class Data:
 				response = []
 				for row in result:
 					response.append({
-						"id": row[0], 
+						"id": from_int_to_hex_str(from_uint256_to_int(row[0])), 
 						"seller": row[1], 
 						"buyer": row[2], 
-						"price": from_str_hex_to_int(row[3]), 
+						"price": from_uint256_to_int(row[3]), 
 						"type": row[4]
 						})
 				return response
 		finally:
 			cur.close()
 
-	def transfer_packet(self, packet_id: int, from_user_id: str, to_user_id: str, price: int):
-		cur = self.get_cursor()
-		try:
-			cur.execute('UPDATE Packets SET userHex = ?, isListed = 0 WHERE id = ?', (to_user_id.lower(), from_int_to_hex_str(packet_id)))
-			self.con.commit()
-			self.addTransferEvent(packet_id, from_user_id.lower(), to_user_id.lower(), 0, price)
-			return True
-		finally:
-			cur.close()
+	def add_transfer_events(self, cur, events):
+		'''
+		Insert the (objId, from_user_id, to_user_id, objType, price) of events in SellEvents, without committing.
+		The callers check that the objects exist, from the rows their UPDATE changed.
+		'''
+		cur.executemany('INSERT INTO SellEvents(objId, userFromHex, userToHex, price, type) values (?, ?, ?, ?, ?)',
+						[(from_int_to_uint256(obj_id), from_user_id.lower(), to_user_id.lower(), from_int_to_uint256(price), obj_type)
+						 for obj_id, from_user_id, to_user_id, obj_type, price in events])
 
-	def transfer_prompt(self, prompt_id: int, from_user_id: str, to_user_id: str, price: int, cur = None):
-		has_passed_cursor = True
-		if cur is None:
-			has_passed_cursor = False
+	def transfer_packet(self, packet_id: int, from_user_id: str, to_user_id: str, price: int):
+		with self.unit_of_work():
 			cur = self.get_cursor()
-		try:
-			cur.execute('UPDATE Prompts SET userHex = ?, isListed = 0 WHERE id = ?', (to_user_id.lower(), from_int_to_hex_str(prompt_id)))
-			self.con.commit()
-			self.addTransferEvent(prompt_id, from_user_id.lower(), to_user_id.lower(), 1, price)
+			try:
+				cur.execute('UPDATE Packets SET userHex = ?, isListed = 0 WHERE id = ?', (to_user_id.lower(), packet_id))
+				if cur.rowcount == 0:
+					print("[transfer_packet] INVALID PACKET!!!")
+					return
+				self.add_transfer_events(cur, [(packet_id, from_user_id, to_user_id, 0, price)])
+				return True
+			finally:
+				cur.close()
+
+	def transfer_prompt(self, prompt_id: int, from_user_id: str, to_user_id: str, price: int):
+		return self.transfer_prompts([prompt_id], from_user_id, to_user_id, price)
+
+	def transfer_prompts(self, prompt_ids: List[int], from_user_id: str, to_user_id: str, price: int):
+		'''
+		Transfer the prompts with a single UPDATE, and record a transfer event for each of them.
+		'''
+		if not prompt_ids:
 			return True
-		finally:
-			if not has_passed_cursor:
+		with self.unit_of_work():
+			cur = self.get_cursor()
+			try:
+				placeholders = ", ".join("?" * len(prompt_ids))
+				cur.execute(f'UPDATE Prompts SET userHex = ?, isListed = 0 WHERE id IN ({placeholders})', (to_user_id.lower(), *prompt_ids))
+				transferred = prompt_ids
+				if cur.rowcount < len(set(prompt_ids)):
+					print("[transfer_prompts] INVALID PROMPT!!!")
+					# only on this path the prompts are read again, to record the events of the existing ones
+					existing = {row[0] for row in cur.execute(f'SELECT id FROM Prompts WHERE id IN ({placeholders})', prompt_ids).fetchall()}
+					transferred = [prompt_id for prompt_id in prompt_ids if prompt_id in existing]
+				self.add_transfer_events(cur, [(prompt_id, from_user_id, to_user_id, 1, price) for prompt_id in transferred])
+				return True
+			finally:
 				cur.close()
 
 	def transfer_image(self, image_id: int, from_user_id: str, to_user_id: str, price: int):
-		# TODO transfer prompts
-		cur = self.get_cursor()
-		try:
-			cur.execute('UPDATE Images SET userHex = ?, isListed = 0 WHERE id = ?', (to_user_id.lower(), from_int_to_hex_str(image_id)))
-			self.con.commit()
-			self.addTransferEvent(image_id, from_user_id.lower(), to_user_id.lower(), 2, price)
+		'''
+		Transfer the card and its prompts in a single transaction.
+		'''
+		with self.unit_of_work():
+			cur = self.get_cursor()
+			try:
+				cur.execute('UPDATE Images SET userHex = ?, isListed = 0 WHERE id = ?', (to_user_id.lower(), from_int_to_uint256(image_id)))
+				if cur.rowcount == 0:
+					print("[transfer_image] INVALID CARD!!!")
+				else:
+					self.add_transfer_events(cur, [(image_id, from_user_id, to_user_id, 2, price)])
+			finally:
+				cur.close()
 			prompts_int = getInfoFromImageId(image_id)[1]
-			for prompt in prompts_int:
-				if prompt != 0:
-					print("TRANSFER PROMPT WITH CARD: ", prompt)
-					self.transfer_prompt(prompt, from_user_id, to_user_id, 0, cur=cur)
-			return True
-		finally:
-			cur.close()
+			return self.transfer_prompts([prompt for prompt in prompts_int if prompt != 0], from_user_id, to_user_id, 0)
 
 	def get_user(self, user_id: str):
 		user_packets = self.get_packets_id_of(user_id, tiny=True)
@@ -646,7 +891,7 @@ class Data:
 		return user_packets, user_prompts, user_images, user_transactions
 	
 	def get_username(self, user_id: str):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		try:
 			cur.execute('SELECT username FROM User WHERE userId=?', (user_id.lower(),))
 			result = cur.fetchone()
@@ -666,7 +911,7 @@ class Data:
 			cur.close()
 
 	def get_remainig_number_of_packets(self, collectionId: int):
-		cur = self.get_cursor()
+		cur = self.get_read_cursor()
 		TOT_PACKETS = 750
 		try:
 			cur.execute('SELECT COUNT(ID) as c FROM Packets WHERE collectionId=?', (collectionId,))
@@ -680,6 +925,194 @@ class Data:
 		finally:
 			cur.close()
 		
+	def get_checkpoint(self, name: str = "tracker"):
+		'''
+		Return the last fully applied block, or None if nothing was applied yet.
+		'''
+		cur = self.get_read_cursor()
+		try:
+			cur.execute('SELECT blockNumber FROM Checkpoints WHERE name=?', (name,))
+			result = cur.fetchone()
+			if result is not None:
+				return result[0]
+			return None
+		finally:
+			cur.close()
+
+	def set_checkpoint(self, block_number: int, name: str = "tracker"):
+		cur = self.get_cursor()
+		try:
+			cur.execute('INSERT OR REPLACE INTO Checkpoints(name, blockNumber) values (?, ?)', (name, block_number))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def mark_log_processed(self, transaction_hash: str, log_index: int, block_number: int):
+		'''
+		Add a log to the ledger of the applied logs.
+		Return False if it was already there, i.e. the log must not be applied again.
+		'''
+		cur = self.get_cursor()
+		try:
+			cur.execute('INSERT OR IGNORE INTO ProcessedLogs(transactionHash, logIndex, blockNumber) values (?, ?, ?)', (transaction_hash, log_index, block_number))
+			self.con.commit()
+			return cur.rowcount == 1
+		finally:
+			cur.close()
+
+	def begin_block(self, block_number: int, block_hash: str):
+		'''
+		Record the changes made until end_block() in the undo journal of the block.
+		'''
+		cur = self.get_cursor()
+		try:
+			cur.execute('INSERT OR REPLACE INTO Blocks(blockNumber, blockHash) values (?, ?)', (block_number, block_hash))
+			cur.execute('UPDATE JournalState SET blockNumber = ?', (block_number,))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def end_block(self):
+		cur = self.get_cursor()
+		try:
+			cur.execute('UPDATE JournalState SET blockNumber = NULL')
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def record_block(self, block_number: int, block_hash: str):
+		'''
+		Store the hash of an applied block, used to detect the reorgs.
+		'''
+		cur = self.get_cursor()
+		try:
+			cur.execute('INSERT OR REPLACE INTO Blocks(blockNumber, blockHash) values (?, ?)', (block_number, block_hash))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def get_block_hash(self, block_number: int):
+		cur = self.get_read_cursor()
+		try:
+			cur.execute('SELECT blockHash FROM Blocks WHERE blockNumber=?', (block_number,))
+			result = cur.fetchone()
+			if result is not None:
+				return result[0]
+			return None
+		finally:
+			cur.close()
+
+	def get_journaled_blocks(self):
+		'''
+		Return the (blockNumber, blockHash) of the blocks in the journal, newest first.
+		'''
+		cur = self.get_read_cursor()
+		try:
+			cur.execute('SELECT blockNumber, blockHash FROM Blocks ORDER BY blockNumber DESC')
+			return cur.fetchall()
+		finally:
+			cur.close()
+
+	def rollback_blocks(self, block_number: int):
+		'''
+		Revert every change made by the blocks after block_number and move the checkpoint back to it.
+		'''
+		cur = self.get_cursor()
+		try:
+			cur.execute('UPDATE JournalState SET blockNumber = NULL')
+			cur.execute('SELECT statement FROM UndoLog WHERE blockNumber > ? ORDER BY seq DESC', (block_number,))
+			for (statement,) in cur.fetchall():
+				cur.execute(statement)
+			cur.execute('DELETE FROM UndoLog WHERE blockNumber > ?', (block_number,))
+			cur.execute('DELETE FROM Blocks WHERE blockNumber > ?', (block_number,))
+			self.set_checkpoint(block_number)
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def prune_journal(self, block_number: int):
+		'''
+		Forget the undo journal of the blocks before block_number, and their applied logs:
+		the poller never reads a block older than the journal again.
+		'''
+		cur = self.get_cursor()
+		try:
+			cur.execute('DELETE FROM UndoLog WHERE blockNumber < ?', (block_number,))
+			cur.execute('DELETE FROM Blocks WHERE blockNumber < ?', (block_number,))
+			cur.execute('DELETE FROM ProcessedLogs WHERE blockNumber < ?', (block_number,))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def add_enrichment_job(self, kind: int, obj_id: int, ipfs_hash: str):
+		cur = self.get_cursor()
+		try:
+			cur.execute('INSERT INTO EnrichmentJobs(kind, objId, ipfsHash) values (?, ?, ?)', (kind, from_int_to_uint256(obj_id), ipfs_hash))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def get_due_enrichment_jobs(self, now: float, limit: int, exclude: List[int] = []):
+		'''
+		Return up to limit jobs whose next attempt is due, skipping the ids in exclude.
+		'''
+		cur = self.get_read_cursor()
+		try:
+			placeholders = ", ".join("?" * len(exclude))
+			cur.execute(f'SELECT id, kind, objId, ipfsHash, attempts FROM EnrichmentJobs WHERE nextAttempt <= ? AND id NOT IN ({placeholders}) ORDER BY nextAttempt, id LIMIT ?', (now, *exclude, limit))
+			return [{
+				"id": row[0],
+				"kind": row[1],
+				"objId": from_uint256_to_int(row[2]),
+				"ipfsHash": row[3],
+				"attempts": row[4]
+				} for row in cur.fetchall()]
+		finally:
+			cur.close()
+
+	def retry_enrichment_job(self, job_id: int, next_attempt: float, error: str):
+		cur = self.get_cursor()
+		try:
+			cur.execute('UPDATE EnrichmentJobs SET attempts = attempts + 1, nextAttempt = ?, lastError = ? WHERE id = ?', (next_attempt, error, job_id))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def remove_enrichment_job(self, job_id: int):
+		cur = self.get_cursor()
+		try:
+			cur.execute('DELETE FROM EnrichmentJobs WHERE id = ?', (job_id,))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def set_prompt_enrichment(self, prompt_id: int, status: str):
+		cur = self.get_cursor()
+		try:
+			cur.execute('UPDATE Prompts SET enrichment = ? WHERE id = ?', (status, prompt_id))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
+	def set_image_enrichment(self, image_id: int, status: str):
+		cur = self.get_cursor()
+		try:
+			cur.execute('UPDATE Images SET enrichment = ? WHERE id = ?', (status, from_int_to_uint256(image_id)))
+			self.con.commit()
+			return True
+		finally:
+			cur.close()
+
 	def fromJson(self, data):
 		obj = json.loads(data)
 		for k, v in obj:
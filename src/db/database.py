@@ -1,25 +1,131 @@
 from functools import wraps
 import sqlite3
+import threading
 from typing import Any
 import os
+from urllib.request import pathname2url
+from ..utils.utils import from_str_hex_to_int, from_int_to_uint256
+
+# PRAGMA name -> value of every connection, overridden by the pragmas of conf/db/data.yaml
+DEFAULT_PRAGMAS = {
+	"busy_timeout": 5000,
+	"journal_mode": "wal",
+	"synchronous": "normal",
+	"cache_size": -65536,
+	"mmap_size": 268435456,
+}
+# pragmas that only matter to the connection that writes
+WRITER_PRAGMAS = ("journal_mode", "synchronous")
 
 class DatabaseConnection(object):
-	def __init__(self, wipe_db = False) -> None:
-		if wipe_db and os.path.exists("tracker.db"):
-			os.remove("tracker.db")
-		con = sqlite3.connect("tracker.db")
+	'''
+	A single writer connection and a read-only connection for every thread that reads.
+	In WAL mode the readers see the last committed state and do not wait for the writer.
+	'''
+	def __init__(self, wipe_db = False, database: str = "tracker.db", pragmas: dict = None) -> None:
+		if wipe_db:
+			# a stale write-ahead log would be replayed on the new database
+			for path in (database, database + "-wal", database + "-shm"):
+				if os.path.exists(path):
+					os.remove(path)
+		self.database = database
+		self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+		# the writer is shared: it is used by one thread at a time, not always the one that opened it
+		con = sqlite3.connect(database, check_same_thread=False)
+		# the rows removed by INSERT OR REPLACE must fire the undo journal's delete triggers
+		con.execute("PRAGMA recursive_triggers = ON;")
+		self.set_pragmas(con, writer=True)
 		self.con = con
+		# depth of the open units of work, see begin()
+		self.units_of_work = 0
+		# last thread that wrote: while its transaction is open it reads from the writer, to see its own writes
+		self.writer_thread = None
+		# the read-only connection of each thread, opened on its first read
+		self.readers = threading.local()
 	
 	def __call__(self) -> sqlite3.Connection:
 		return self.con
+
+	def set_pragmas(self, con: sqlite3.Connection, writer: bool):
+		# busy_timeout first: switching to WAL takes a lock, and another process may be opening the file too
+		for name, value in sorted(self.pragmas.items(), key=lambda pragma: pragma[0] != "busy_timeout"):
+			if writer or name not in WRITER_PRAGMAS:
+				con.execute(f"PRAGMA {name} = {value};")
 	
 	def get_cursor(self):
+		self.writer_thread = threading.get_ident()
 		return self.con.cursor()
+
+	def reader(self) -> sqlite3.Connection:
+		'''
+		Return the connection for the reads of the calling thread.
+		'''
+		# an in-memory database can not be opened twice
+		if self.database == ":memory:" or (self.writer_thread == threading.get_ident() and self.con.in_transaction):
+			return self.con
+		con = getattr(self.readers, "con", None)
+		if con is None:
+			con = sqlite3.connect(f"file:{pathname2url(os.path.abspath(self.database))}?mode=ro", uri=True)
+			self.set_pragmas(con, writer=False)
+			self.readers.con = con
+		return con
+
+	def get_read_cursor(self):
+		return self.reader().cursor()
 	
 	def commit(self):
-		self.con.commit()
+		# inside a unit of work the changes are committed when the outermost one ends
+		if self.units_of_work == 0:
+			self.con.commit()
+
+	def begin(self):
+		'''
+		Open a unit of work: commit() does nothing until the matching end().
+		'''
+		self.writer_thread = threading.get_ident()
+		if self.units_of_work == 0 and not self.con.in_transaction:
+			self.con.execute("BEGIN")
+		self.units_of_work += 1
+
+	def end(self, commit: bool = True):
+		'''
+		Close a unit of work. The outermost one commits or rolls back the transaction.
+		'''
+		self.units_of_work -= 1
+		if self.units_of_work == 0:
+			if commit:
+				self.con.commit()
+			else:
+				self.con.rollback()
+
+	def close(self):
+		'''
+		Close the writer and the reader of the calling thread, the other readers are closed with their threads.
+		'''
+		reader = getattr(self.readers, "con", None)
+		if reader is not None:
+			reader.close()
+			self.readers.con = None
+		self.con.close()
 
     
+# tables whose changes are recorded in the undo journal, to roll back the blocks orphaned by a reorg
+JOURNALED_TABLES = ["Packets", "Prompts", "Images", "SellEvents", "EnrichmentJobs", "ProcessedLogs"]
+
+# PRAGMA user_version of the schema
+# 0: ids and prices as hex VARCHAR(67)
+# 1: packet and prompt ids as INTEGER; card ids, prices and the ids of SellEvents and EnrichmentJobs as UINT256:
+#    an INTEGER below 2^63, else a 32 bytes big endian BLOB (see from_int_to_uint256), ordered like the integers
+SCHEMA_VERSION = 1
+# tables whose ids and prices changed in version 1, with the conversion of every column
+NATIVE_ID_COLUMNS = {
+	"Packets": {"id": "int", "price": "uint256"},
+	"Prompts": {"id": "int", "price": "uint256"},
+	"Images": {"id": "uint256", "price": "uint256"},
+	"SellEvents": {"objId": "uint256", "price": "uint256"},
+	"EnrichmentJobs": {"objId": "uint256"},
+}
+
 class CreateDatabase(object):
 	
 	def __init__(self, connection: DatabaseConnection) -> None:
@@ -34,19 +140,140 @@ class CreateDatabase(object):
 		try:
 
 			cur = connection.cursor()
-			cur.execute("CREATE TABLE IF NOT EXISTS Packets(id VARCHAR(67) PRIMARY KEY, isListed BIT DEFAULT 0, price VARCHAR(67), userHex VARCHAR(67) NOT NULL, collectionId INTEGER);")
-			cur.execute("CREATE TABLE IF NOT EXISTS Prompts(id VARCHAR(67) PRIMARY KEY, ipfsHash VARCHAR(47), isListed BIT DEFAULT 0, price VARCHAR(67), isFreezed BIT DEFAULT 0, userHex VARCHAR(67) NOT NULL, name TEXT, type TINYINT DEFAULT 128, collectionId INTEGER, rarity REAL DEFAULT 0);")
-			cur.execute("CREATE TABLE IF NOT EXISTS Images(id VARCHAR(67) PRIMARY KEY, ipfsHash VARCHAR(47), isListed BIT DEFAULT 0, price VARCHAR(67), userHex VARCHAR(67) NOT NULL, collectionId INTEGER, prompts TEXT);")
-			cur.execute("CREATE TABLE IF NOT EXISTS SellEvents(id INTEGER PRIMARY KEY AUTOINCREMENT, objId VARCHAR(67), userFromHex VARCHAR(67) NOT NULL, userToHex VARCHAR(67) NOT NULL, price VARCHAR(67), type TINYINT CHECK(type IN (0, 1, 2)));") # 0 = Packet, 1 = Prompts, 2 = Images
+			legacy = self.needs_migration(cur)
+			if legacy:
+				# the migration is a single transaction
+				if not connection.in_transaction:
+					cur.execute("BEGIN")
+				self.rename_legacy_tables(cur)
+			# INT, not INTEGER, PRIMARY KEY: the ids are not rowid aliases, so the rows keep the insertion order of version 0
+			cur.execute("CREATE TABLE IF NOT EXISTS Packets(id INT PRIMARY KEY, isListed BIT DEFAULT 0, price UINT256, userHex VARCHAR(67) NOT NULL, collectionId INTEGER);")
+			cur.execute("CREATE TABLE IF NOT EXISTS Prompts(id INT PRIMARY KEY, ipfsHash VARCHAR(47), isListed BIT DEFAULT 0, price UINT256, isFreezed BIT DEFAULT 0, userHex VARCHAR(67) NOT NULL, name TEXT, type TINYINT DEFAULT 128, collectionId INTEGER, rarity REAL DEFAULT 0);")
+			cur.execute("CREATE TABLE IF NOT EXISTS Images(id UINT256 PRIMARY KEY, ipfsHash VARCHAR(47), isListed BIT DEFAULT 0, price UINT256, userHex VARCHAR(67) NOT NULL, collectionId INTEGER, prompts TEXT);")
+			cur.execute("CREATE TABLE IF NOT EXISTS SellEvents(id INTEGER PRIMARY KEY AUTOINCREMENT, objId UINT256, userFromHex VARCHAR(67) NOT NULL, userToHex VARCHAR(67) NOT NULL, price UINT256, type TINYINT CHECK(type IN (0, 1, 2)));") # 0 = Packet, 1 = Prompts, 2 = Images
 			cur.execute("CREATE TABLE IF NOT EXISTS User (userId VARCHAR(67) PRIMARY KEY, username TEXT);")
+			cur.execute("CREATE TABLE IF NOT EXISTS Checkpoints(name VARCHAR(32) PRIMARY KEY, blockNumber INTEGER NOT NULL);") # last fully applied block
+			cur.execute("CREATE TABLE IF NOT EXISTS EnrichmentJobs(id INTEGER PRIMARY KEY AUTOINCREMENT, kind TINYINT CHECK(kind IN (1, 2, 3)), objId UINT256, ipfsHash VARCHAR(47), attempts INTEGER DEFAULT 0, nextAttempt REAL DEFAULT 0, lastError TEXT);") # 1 = Prompt, 2 = Image, 3 = Unpin
+			cur.execute("CREATE INDEX IF NOT EXISTS enrichmentJobsIndex ON EnrichmentJobs(nextAttempt);")
+			# 'pending' until the metadata of the row has been fetched from IPFS, then 'done' or 'failed'
+			self.add_column(cur, "Prompts", "enrichment", "VARCHAR(8) DEFAULT 'pending'")
+			self.add_column(cur, "Images", "enrichment", "VARCHAR(8) DEFAULT 'pending'")
+			# ledger of the applied logs, so that a log delivered twice is applied once
+			cur.execute("CREATE TABLE IF NOT EXISTS ProcessedLogs(transactionHash VARCHAR(66) NOT NULL, logIndex INTEGER NOT NULL, blockNumber INTEGER, PRIMARY KEY(transactionHash, logIndex));")
+			cur.execute("CREATE INDEX IF NOT EXISTS processedLogsBlockIndex ON ProcessedLogs(blockNumber);")
+			# undo journal: the hashes of the last applied blocks and the statements that revert them
+			cur.execute("CREATE TABLE IF NOT EXISTS Blocks(blockNumber INTEGER PRIMARY KEY, blockHash VARCHAR(66) NOT NULL);")
+			cur.execute("CREATE TABLE IF NOT EXISTS UndoLog(seq INTEGER PRIMARY KEY AUTOINCREMENT, blockNumber INTEGER NOT NULL, statement TEXT NOT NULL);")
+			cur.execute("CREATE INDEX IF NOT EXISTS undoLogBlockIndex ON UndoLog(blockNumber);")
+			# block being applied, NULL outside of a block
+			cur.execute("CREATE TABLE IF NOT EXISTS JournalState(id INTEGER PRIMARY KEY CHECK(id = 0), blockNumber INTEGER);")
+			cur.execute("INSERT OR IGNORE INTO JournalState(id, blockNumber) VALUES (0, NULL);")
+			for table in JOURNALED_TABLES:
+				self.create_undo_triggers(cur, table)
 			cur.execute("CREATE INDEX IF NOT EXISTS userPacketsIndex ON Packets(userHex);")
 			cur.execute("CREATE INDEX IF NOT EXISTS userPromptsIndex ON Prompts(userHex);")
 			cur.execute("CREATE INDEX IF NOT EXISTS userImagesIndex ON Images(userHex);")
 			cur.execute("CREATE INDEX IF NOT EXISTS sellEventObjIndex ON SellEvents(objId, type);")
+			# the listed rows in the orders of the list endpoints, the implicit last column (rowid) breaks the ties
+			for table in ["Packets", "Prompts", "Images"]:
+				cur.execute(f"CREATE INDEX IF NOT EXISTS listed{table}Index ON {table}(isListed);")
+				cur.execute(f"CREATE INDEX IF NOT EXISTS listed{table}PriceIndex ON {table}(isListed, price);")
+			cur.execute("CREATE INDEX IF NOT EXISTS listedPromptsRarityIndex ON Prompts(isListed, rarity);")
+			if legacy:
+				self.copy_legacy_tables(cur)
+			cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
 			connection.commit()
+		except BaseException:
+			connection.rollback()
+			raise
 		finally:
 			cur.close()
 		self.db_created = True
 
+	def add_column(self, cur, table: str, column: str, definition: str):
+		'''
+		Add a column to a table created by an older version of the tracker.
+		'''
+		cur.execute(f"PRAGMA table_info({table});")
+		if column not in [row[1] for row in cur.fetchall()]:
+			cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
+	def get_schema_version(self, cur) -> int:
+		cur.execute("PRAGMA user_version;")
+		return cur.fetchone()[0]
+
+	def table_exists(self, cur, table: str) -> bool:
+		cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (table,))
+		return cur.fetchone() is not None
+
+	def needs_migration(self, cur=None) -> bool:
+		'''
+		True if the database has the tables of an older schema version.
+		'''
+		cur = cur or self.connection.cursor()
+		return self.get_schema_version(cur) < SCHEMA_VERSION and self.table_exists(cur, "Packets")
+
+	def rename_legacy_tables(self, cur):
+		'''
+		Move the tables of schema version 0 out of the way, with their triggers and indexes.
+		'''
+		for table in NATIVE_ID_COLUMNS:
+			# EnrichmentJobs was added after the first version 0 databases
+			if not self.table_exists(cur, table):
+				continue
+			cur.execute("SELECT type, name FROM sqlite_master WHERE tbl_name=? AND type IN ('index', 'trigger') AND sql IS NOT NULL;", (table,))
+			for kind, name in cur.fetchall():
+				cur.execute(f"DROP {kind.upper()} {name};")
+			cur.execute(f"ALTER TABLE {table} RENAME TO Legacy{table};")
+
+	def copy_legacy_tables(self, cur):
+		'''
+		Copy the rows of the tables of schema version 0, converting the hex ids and prices, then drop them.
+		The undo journal holds hex values too: it is dropped, so a reorg of the blocks applied before the
+		migration can not be rolled back (the tracker stops with REORG_TOO_DEEP).
+		'''
+		conversions = {
+			"int": from_str_hex_to_int,
+			"uint256": lambda value: from_int_to_uint256(from_str_hex_to_int(value)),
+		}
+		for table, converted in NATIVE_ID_COLUMNS.items():
+			if not self.table_exists(cur, f"Legacy{table}"):
+				continue
+			# the columns added after the legacy table was created keep their defaults
+			cur.execute(f"PRAGMA table_info({table});")
+			current_columns = {row[1] for row in cur.fetchall()}
+			cur.execute(f"PRAGMA table_info(Legacy{table});")
+			columns = [row[1] for row in cur.fetchall() if row[1] in current_columns]
+			columns = ["rowid"] + columns
+			rows = cur.execute(f"SELECT {', '.join(columns)} FROM Legacy{table};").fetchall()
+			converters = [conversions[converted[column]] if column in converted else None for column in columns]
+			rows = [tuple(value if converter is None or value is None else converter(value) for converter, value in zip(converters, row))
+					for row in rows]
+			cur.executemany(f"INSERT INTO {table}({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))});", rows)
+			cur.execute(f"DROP TABLE Legacy{table};")
+		cur.execute("DELETE FROM UndoLog;")
+		cur.execute("DELETE FROM Blocks WHERE blockNumber < (SELECT MAX(blockNumber) FROM Blocks);")
+
+	def create_undo_triggers(self, cur, table: str):
+		'''
+		Create the triggers that write the inverse of every change to the table in UndoLog.
+		They are recreated every time, so that they follow the columns of the table.
+		'''
+		cur.execute(f"PRAGMA table_info({table});")
+		columns = [row[1] for row in cur.fetchall()]
+		journal = f"INSERT INTO UndoLog(blockNumber, statement) SELECT blockNumber, "
+		active = "WHEN (SELECT blockNumber FROM JournalState) IS NOT NULL"
+
+		values = " || ',' || ".join(f"quote(OLD.{column})" for column in columns)
+		assignments = " || ',' || ".join(f"'{column}=' || quote(OLD.{column})" for column in columns)
+		triggers = {
+			"insert": f"AFTER INSERT ON {table} {active} BEGIN {journal}'DELETE FROM {table} WHERE rowid=' || NEW.rowid FROM JournalState; END;",
+			"update": f"AFTER UPDATE ON {table} {active} BEGIN {journal}'UPDATE {table} SET ' || {assignments} || ' WHERE rowid=' || OLD.rowid FROM JournalState; END;",
+			"delete": f"AFTER DELETE ON {table} {active} BEGIN {journal}'INSERT INTO {table}(rowid,{','.join(columns)}) VALUES(' || OLD.rowid || ',' || {values} || ')' FROM JournalState; END;",
+		}
+		for operation, body in triggers.items():
+			cur.execute(f"DROP TRIGGER IF EXISTS undo_{table}_{operation};")
+			cur.execute(f"CREATE TRIGGER undo_{table}_{operation} {body}")
+
 	def create(self):
 		self()
\ No newline at end of file
@@ -0,0 +1,46 @@
+'''
+Migrate an existing tracker database to the current schema.
+
+The tracker migrates its database when it starts with resume: true; this tool
+does it offline, after a backup, and compacts the file.
+
+run from the root directory, with the tracker stopped:
+python3 -m src.db.migrate database=tracker.db
+'''
+
+import logging
+import os
+import sqlite3
+import hydra
+from .database import CreateDatabase, DatabaseConnection, SCHEMA_VERSION
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="../../conf", config_name="migrate_config")
+def main(cfg):
+    if not os.path.exists(cfg.database):
+        raise FileNotFoundError(cfg.database)
+    size = os.path.getsize(cfg.database)
+
+    if cfg.backup is not None:
+        source = sqlite3.connect(cfg.database)
+        backup = sqlite3.connect(cfg.backup)
+        source.backup(backup)
+        backup.close()
+        source.close()
+        logger.info(f"Saved a copy of {cfg.database} in {cfg.backup}.")
+
+    connection = DatabaseConnection(database=cfg.database)
+    cur = connection().cursor()
+    version = cur.execute("PRAGMA user_version;").fetchone()[0]
+    CreateDatabase(connection).create()
+    if cfg.vacuum:
+        cur.execute("VACUUM;")
+    cur.close()
+    connection().close()
+    logger.info(f"Migrated {cfg.database} from schema version {version} to {SCHEMA_VERSION}: "
+                f"{size / 1024:.1f} KiB -> {os.path.getsize(cfg.database) / 1024:.1f} KiB.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+'''
+Masks of the oracle, loaded once.
+
+The registry reads every image in data/masks/ at startup and keeps the
+tensors ready for the pipeline, one per (mask, device, dtype, resolution), so
+CreateImage no longer reads and converts a PNG for every card. Composites of
+a base mask and overlays (hat, handoff, glasses) are memoized the same way.
+'''
+
+import hashlib
+import os
+import threading
+import numpy as np
+import torch
+from PIL import Image
+
+
+class MaskRegistry(object):
+    '''
+    masks[name] is the RGBA image of data/masks/{name}.png.
+    '''
+
+    def __init__(self, directory="data/masks"):
+        self.masks = {}
+        for file_name in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(file_name)
+            if extension.lower() == ".png":
+                with Image.open(os.path.join(directory, file_name)) as mask:
+                    self.masks[name] = mask.convert("RGBA")
+        # (names, device, dtype, resolution) -> tensor (1, 3, H, W)
+        self.tensors = {}
+        # (names, resolution) -> sha256 of the pixels
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def image(self, names, resolution=None) -> Image.Image:
+        '''
+        Alpha composite the overlays names[1:] on the base mask names[0].
+        resolution: (width, height), the size of the base mask if None.
+        '''
+        base = self.masks[names[0]]
+        resolution = tuple(resolution) if resolution is not None else base.size
+        composite = base if base.size == resolution else base.resize(resolution, Image.BILINEAR)
+        for name in names[1:]:
+            overlay = self.masks[name]
+            if overlay.size != resolution:
+                overlay = overlay.resize(resolution, Image.BILINEAR)
+            composite = Image.alpha_composite(composite, overlay)
+        return composite
+
+    def get(self, names, device, dtype, resolution=None) -> torch.Tensor:
+        '''
+        Return the mask, or the composite of masks, as a (1, 3, H, W) tensor in [0, 1] on device.
+        names: a mask name, or a list [base, overlay, ...].
+        '''
+        names = (names,) if isinstance(names, str) else tuple(names)
+        key = (names, str(device), dtype, None if resolution is None else tuple(resolution))
+        tensor = self.tensors.get(key)
+        if tensor is None:
+            with self.lock:
+                tensor = self.tensors.get(key)
+                if tensor is None:
+                    pixels = np.array(self.image(names, resolution))[:, :, :3]
+                    tensor = torch.from_numpy(pixels).to(device).unsqueeze(0).permute(0, 3, 1, 2).to(dtype) / 255.0
+                    self.tensors[key] = tensor
+        return tensor
+
+    def digest(self, names, resolution=None) -> str:
+        '''
+        Hash of the pixels of the mask, or of the composite of masks, to identify it in the caches.
+        '''
+        names = (names,) if isinstance(names, str) else tuple(names)
+        key = (names, None if resolution is None else tuple(resolution))
+        digest = self.digests.get(key)
+        if digest is None:
+            image = self.image(names, resolution)
+            digest = hashlib.sha256(f"{image.size}".encode("utf-8") + image.tobytes()).hexdigest()
+            self.digests[key] = digest
+        return digest
@@ -0,0 +1,135 @@
+'''
+Batched inference of the diffusion model.
+
+The image workers call the BatchedModel like the pipeline, with one prompt,
+one mask and one generator. A single thread collects the calls for up to
+max_wait seconds or max_batch_size items and runs one pipeline call with the
+lists of prompts and generators and the stacked masks, then returns to every
+caller its own image.
+
+With a list of generators the pipeline draws the noise of every item from
+its own generator, and encodes every mask on its own, so an item gets the
+same latents it would get alone with the same seed.
+
+With an embedding cache (src/oracle/embeddings.py) the pipeline gets the
+cached prompt_embeds and pooled_prompt_embeds instead of the prompts.
+'''
+
+import logging
+import queue
+import threading
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItemOutput(object):
+    '''
+    Output of the pipeline for one item, with the `images` attribute used by the handlers.
+    '''
+    __slots__ = ("images",)
+
+    def __init__(self, image):
+        self.images = [image]
+
+
+class BatchRequest(object):
+    __slots__ = ("prompt", "image", "generator", "kwargs", "done", "result", "error")
+
+    def __init__(self, prompt, image, generator, kwargs):
+        self.prompt = prompt
+        self.image = image
+        self.generator = generator
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def key(self):
+        '''
+        Only the requests with the same parameters and mask shape can share a pipeline call.
+        '''
+        return tuple(sorted(self.kwargs.items())), tuple(self.image.shape), self.image.dtype, self.image.device
+
+
+class BatchedModel(object):
+    '''
+    Wrap a diffusers image to image pipeline and batch the concurrent calls.
+
+    It also serializes the calls to the pipeline, which is not thread safe.
+    embeddings: optional PromptEmbeddingCache of the pipeline.
+    '''
+
+    def __init__(self, model, max_batch_size=4, max_wait=0.05, embeddings=None):
+        self.model = model
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="oracle-batching", daemon=True)
+        self.thread.start()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    @property
+    def dtype(self):
+        return self.model.dtype
+
+    def __call__(self, prompt, image, generator, **kwargs):
+        '''
+        Same signature as the pipeline, for a single prompt and mask (1, C, H, W).
+        '''
+        request = BatchRequest(prompt, image, generator, kwargs)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return BatchItemOutput(request.result)
+
+    def collect(self):
+        '''
+        Wait for a request, then for up to max_batch_size - 1 more within max_wait seconds.
+        '''
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            groups = {}
+            for request in self.collect():
+                groups.setdefault(request.key(), []).append(request)
+            for group in groups.values():
+                self.generate(group)
+
+    def generate(self, group):
+        try:
+            prompts = [request.prompt for request in group]
+            if self.embeddings is not None:
+                prompt_embeds, pooled_prompt_embeds = self.embeddings.encode(prompts)
+                inputs = {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds}
+            else:
+                inputs = {"prompt": prompts}
+            output = self.model(image=torch.cat([request.image for request in group]),
+                                generator=[request.generator for request in group],
+                                **inputs,
+                                **group[0].kwargs)
+            logger.info(f"Generated a batch of {len(group)} images.")
+            for request, image in zip(group, output.images):
+                request.result = image
+        except Exception as e:
+            for request in group:
+                request.error = e
+        for request in group:
+            request.done.set()
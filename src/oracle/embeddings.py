@@ -0,0 +1,110 @@
+'''
+Cache of the text embeddings of the prompts.
+
+The prompts of the cards are built from the small vocabulary of the
+collections, so the same prompt is encoded again and again by the two text
+encoders of SDXL. The cache keeps the prompt_embeds and pooled_prompt_embeds
+of the last max_entries prompts on the device of the model, and a copy of
+each of them in directory, so the oracle starts warm after a restart.
+
+It is used by the batching thread only, so it is not thread safe.
+'''
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class PromptEmbeddingCache(object):
+    '''
+    LRU cache prompt -> (prompt_embeds, pooled_prompt_embeds) of a SDXL pipeline.
+    '''
+
+    def __init__(self, pipeline, directory="./cache/embeddings/", max_entries=1024):
+        self.pipeline = pipeline
+        self.directory = directory
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def path(self, prompt: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(prompt.encode("utf-8")).hexdigest() + ".pt")
+
+    def load(self):
+        '''
+        Load the most recently used entries of the directory, delete the others.
+        '''
+        paths = [os.path.join(self.directory, file_name) for file_name in os.listdir(self.directory) if file_name.endswith(".pt")]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:-self.max_entries] if len(paths) > self.max_entries else []:
+            os.remove(path)
+        for path in paths[-self.max_entries:]:
+            try:
+                entry = torch.load(path, map_location=self.pipeline.device)
+            except Exception as e:
+                logger.warning(f"Discarding the cached embeddings {path}: {e}")
+                os.remove(path)
+                continue
+            self.entries[entry["prompt"]] = (entry["prompt_embeds"], entry["pooled_prompt_embeds"])
+        logger.info(f"Loaded the embeddings of {len(self.entries)} prompts.")
+
+    def get(self, prompt: str):
+        '''
+        Return the embeddings of prompt, or None.
+        An entry whose file is gone (e.g. deleted by hand) is a miss, it is encoded and saved again.
+        '''
+        entry = self.entries.get(prompt)
+        if entry is None:
+            return None
+        try:
+            # the modification time is the order of the entries on disk
+            os.utime(self.path(prompt))
+        except OSError as e:
+            logger.warning(f"Dropping the cached embeddings of {prompt!r}: {e}")
+            del self.entries[prompt]
+            return None
+        self.entries.move_to_end(prompt)
+        return entry
+
+    def put(self, prompt: str, prompt_embeds: torch.Tensor, pooled_prompt_embeds: torch.Tensor):
+        self.entries[prompt] = (prompt_embeds, pooled_prompt_embeds)
+        path = self.path(prompt)
+        temporary = path + ".tmp"
+        torch.save({"prompt": prompt,
+                    "prompt_embeds": prompt_embeds.cpu(),
+                    "pooled_prompt_embeds": pooled_prompt_embeds.cpu()}, temporary)
+        os.replace(temporary, path)
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            try:
+                os.remove(self.path(evicted))
+            except FileNotFoundError:
+                pass
+
+    def encode(self, prompts):
+        '''
+        Return the prompt_embeds and pooled_prompt_embeds of a list of prompts, stacked.
+        The prompts that are not in the cache are encoded with a single call to the text encoders.
+        '''
+        embeddings = {prompt: self.get(prompt) for prompt in prompts}
+        missing = [prompt for prompt, entry in embeddings.items() if entry is None]
+        self.hits += len(prompts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            with torch.no_grad():
+                prompt_embeds, _, pooled_prompt_embeds, _ = self.pipeline.encode_prompt(prompt=missing,
+                                                                                        device=self.pipeline.device,
+                                                                                        num_images_per_prompt=1,
+                                                                                        do_classifier_free_guidance=False)
+            for i, prompt in enumerate(missing):
+                embeddings[prompt] = (prompt_embeds[i:i + 1].clone(), pooled_prompt_embeds[i:i + 1].clone())
+                self.put(prompt, *embeddings[prompt])
+        return (torch.cat([embeddings[prompt][0] for prompt in prompts]),
+                torch.cat([embeddings[prompt][1] for prompt in prompts]))
@@ -1,4 +1,11 @@
 from .events import *
+from ..tracker.poller import LogPoller
+from ..utils.decoding import LogDecoderRegistry, DecodedLog
+
+ORACLE_EVENTS = [
+    "PacketOpened",
+    "CreateImage",
+]
 
 def initOracleFilters(contract):
     """
@@ -11,18 +18,32 @@ def initOracleFilters(contract):
 
     return filters
 
-def handle_event(event, provider, contract, IPFSClient, model, data, logger):
+def initOraclePoller(provider, contract, from_block="latest"):
+    """
+    Init a single log poller for the oracle events, decoded with the precompiled decoders
+    """
+    event_classes = {event_name: get_event_class(event_name) for event_name in ORACLE_EVENTS}
+    decoder = LogDecoderRegistry(contract.abi, event_classes)
+    return [LogPoller(provider, contract, ORACLE_EVENTS, from_block=from_block, decoder=decoder)]
+
+def handle_event(event, provider, contract, uploader, model, data, submitter, cache, logger):
     '''
     Handle an event.
     
     We used reflection to get the event class from the event name.
+    The logs decoded by the LogPoller's registry (DecodedLog) already carry their event object.
+    Return the futures of the transactions and uploads of the handler.
     '''
-    event_name = event.event
-    event_args = event.args
+    if isinstance(event, DecodedLog):
+        event_object = event.handler
+    else:
+        event_name = event.event
+        event_args = event.args
 
-    event_class = get_event_class(event_name)
-    kwargs = dict(event_args)
-    kwargs['event'] = event_name
-    event_object = event_class(**kwargs)
-    event_object.handle(contract, provider, IPFSClient, model, data)
+        event_class = get_event_class(event_name)
+        kwargs = dict(event_args)
+        kwargs['event'] = event_name
+        event_object = event_class(**kwargs)
+    futures = event_object.handle(contract, provider, uploader, model, data, submitter, cache)
     event_object.log(logger)
+    return futures
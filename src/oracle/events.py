@@ -3,22 +3,26 @@ This file contains the events that the oracle can handle.
 '''
 
 
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from abc import abstractmethod, ABC
 from typing import List
 import json
+import logging
 from torch import Generator
 from PIL import Image
-import numpy as np
-import torch
 
 from ..word_generator import Atlas
-from ..utils import utils
+from ..utils import utils, image_payload
 from ..db.data import Data
 from ..word_generator.prompt_builder import Prompt
+from .assets import MaskRegistry
+from .generation_cache import GenerationCacheEntry
+
+logger = logging.getLogger(__name__)
 
 PACKET_SIZE = 8
 word_generator = Atlas.WordExtractor()
+masks = MaskRegistry("data/masks")
 public_key = "0xf39Fd6e51aad88F6F4ce6aB8827279cffFb92266"   # testnet account
 private_key = "0xac0974bec39a17e36ba4a6b4d238ff944bacb478cbed5efcae784d7bf4f2ff80"  # testnet account
 
@@ -28,12 +32,17 @@ class Event(ABC):
     '''
     Basic class for events.
     '''
+    __slots__ = ("event",)
     event: str
 
     @abstractmethod
-    def handle(self, contract, provider, IPFSClient, model, data):
+    def handle(self, contract, provider, uploader, model, data, submitter, cache):
         '''
-        Handle the event
+        Handle the event.
+        The transactions are sent with the submitter, without waiting for the receipts,
+        the content is added to IPFS in the background by the uploader, with the CIDs computed locally.
+        cache: GenerationCache of the images, or None.
+        Return the futures of the transactions and of the uploads: the job of the event is done when all of them succeed.
         '''
         pass
 
@@ -41,7 +50,7 @@ class Event(ABC):
         '''
         Log the event
         '''
-        attributes = "\n".join([f"{k}: {v}" for k, v in self.__dict__.items()])
+        attributes = "\n".join([f"{field.name}: {getattr(self, field.name)}" for field in fields(self)])
         msg = f"""
                 ====================
                 {attributes}
@@ -53,14 +62,16 @@ class PacketOpened(Event):
     '''
     Handle the opening of a packet.
     '''
+    __slots__ = ("opener", "prompts")
 
     opener: str
     prompts: List[int]
 
-    def handle(self, contract, provider, IPFSClient, model, data):
+    def handle(self, contract, provider, uploader, model, data, submitter, cache):
         '''
         Generate and add prompt on IPFS
         '''
+        futures = []
         for prompt in self.prompts:
             _, packet, type_id, collection = utils.getInfoFromPromptId(prompt)
 
@@ -75,40 +86,29 @@ class PacketOpened(Event):
             }
 
             # push the prompt on IPFS
-            cid = IPFSClient.http_client.add_bytes(json.dumps(data).encode("utf-8"))
+            cid, upload = uploader.upload(json.dumps(data).encode("utf-8"))
+            futures.append(upload)
 
             cid_int = utils.cidToInt256(cid)
             
             # call the contract function to notify the blockchain.
-            call_func = contract.functions.promptMinted(**{
+            futures.append(submitter.submit(contract.functions.promptMinted(**{
                                         "IPFSCid": cid_int,
                                         "promptId": prompt,
                                         "to": self.opener,
-                                        })\
-                                    .build_transaction({
-                                        "from": public_key,
-                                        "nonce": provider.eth.get_transaction_count(public_key),
-                                    })
-            # sign the transaction
-            signed_tx = provider.eth.account.sign_transaction(call_func, private_key=private_key)
-
-            # send the transaction
-            send_tx = provider.eth.send_raw_transaction(signed_tx.rawTransaction)
-
-            # wait for transaction receipt
-            tx_receipt = provider.eth.wait_for_transaction_receipt(send_tx)
-                
-                
+                                        })))
+        return futures
 
 @dataclass
 class CreateImage(Event):
     '''
     Handle the creation of an image.
     '''
+    __slots__ = ("creator", "cardId")
     creator: str
     cardId: int
 
-    def handle(self, contract, provider, IPFSClient, model, data: Data):
+    def handle(self, contract, provider, uploader, model, data: Data, submitter, cache):
         '''
         Generate and image and add it to IPFS
         '''
@@ -131,59 +131,63 @@ class CreateImage(Event):
                     .set_style(style)
         prompt = prompt_obj.build()
         
-        if not tool:
-            mask = torch.from_numpy(np.array(Image.open("data/masks/test_2.png"))[:, :, :3]).to("cuda").unsqueeze(0).permute(0, 3, 1, 2).half() / 255.0
-        else:
-            mask = torch.from_numpy(np.array(Image.open(f"data/masks/test_3.png"))[:, :, :3]).to("cuda").unsqueeze(0).permute(0, 3, 1, 2).half() / 255.0
-
-        # instantiate the generator
-        generator = Generator().manual_seed(seed)
-
-        # generate the image
-        image: Image = model(prompt=prompt, image=mask, strength=0.8, generator=generator, guidance_scale=0.0, num_inference_steps=8).images[0]
-        
-        # save the image in a buffer
-        # img_byte_arr = io.BytesIO()
-        # image.save(img_byte_arr, format='PNG')
-        # img_byte = img_byte_arr.getvalue()
-
-
-        data = {
-            "image": json.dumps(np.array(image).tolist()),
-            "prompts": f'''character: {character.name if character else ''} 
+        prompts = f'''character: {character.name if character else ''} 
                             hats: {hat.name if hat else ''} 
                             handoff: {tool.name if tool else ""} 
                             colors: {color.name if color else ""} 
                             glasses: {eyes.name if eyes else ""} 
                             style: {style.name if style else ""}'''
-        }
 
-        # push the image on IPFS
-        cid = IPFSClient.http_client.add_json(data)
-
-        # img_byte_arr.flush()
-        # img_byte_arr.close()
+        mask_name = "test_2" if not tool else "test_3"
+        parameters = {"strength": 0.8, "guidance_scale": 0.0, "num_inference_steps": 8}
+
+        # an image with the same prompt, mask and seed may have been generated already (e.g. the card was destroyed and created again)
+        key = entry = None
+        futures = []
+        if cache is not None:
+            key = cache.key(prompt, masks.digest(mask_name), seed, **parameters)
+            entry = cache.get(key)
+        if entry is not None:
+            # add the content again, it may have been unpinned when the card was destroyed
+            _, image_upload = uploader.upload(entry.image)
+            cid, manifest_upload = uploader.upload(image_payload.encodeManifest(entry.manifest))
+            futures += [image_upload, manifest_upload]
+            logger.info(f"Generation cache hit for card {self.cardId} ({cache.stats()}).")
+        else:
+            entry = self.generate(uploader, model, prompt, prompts, mask_name, seed, parameters, futures)
+            cid = entry.cid
+            if cache is not None:
+                cache.put(key, entry)
 
         # publish the cid on the blockchain
         cid_int = utils.cidToInt256(cid)
 
-        call_func = contract.functions.imageMinted(**{
+        futures.append(submitter.submit(contract.functions.imageMinted(**{
                                         "IPFSCid": cid_int,
                                         "imageId": self.cardId,
                                         "to": self.creator, 
-                                        })\
-                                    .build_transaction({
-                                        "from": public_key,
-                                        "nonce": provider.eth.get_transaction_count(public_key),
-                                    })
-        # sign the transaction
-        signed_tx = provider.eth.account.sign_transaction(call_func, private_key=private_key)
-
-        # send the transaction
-        send_tx = provider.eth.send_raw_transaction(signed_tx.rawTransaction)
-
-        # wait for transaction receipt
-        tx_receipt = provider.eth.wait_for_transaction_receipt(send_tx)
+                                        })))
+        return futures
+
+    def generate(self, uploader, model, prompt, prompts, mask_name, seed, parameters, futures) -> GenerationCacheEntry:
+        '''
+        Generate the image and upload it with its manifest, the futures of the uploads are added to futures.
+        '''
+        mask = masks.get(mask_name, model.device, model.dtype)
+
+        # instantiate the generator
+        generator = Generator().manual_seed(seed)
+
+        # generate the image
+        image: Image = model(prompt=prompt, image=mask, generator=generator, **parameters).images[0]
+
+        # push the compressed image on IPFS, then the manifest that points at it
+        image_bytes, image_format = image_payload.encodeImage(image)
+        image_cid, image_upload = uploader.upload(image_bytes)
+        manifest = image_payload.buildManifest(image_cid, image_format, image, prompts)
+        cid, manifest_upload = uploader.upload(image_payload.encodeManifest(manifest))
+        futures += [image_upload, manifest_upload]
+        return GenerationCacheEntry(image_bytes, image_format, manifest, cid)
 
 
 def get_event_class(event_name):
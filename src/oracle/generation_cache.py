@@ -0,0 +1,146 @@
+'''
+Content addressed cache of the generated images.
+
+The id of a card fixes its seed and its prompts, so a card that is destroyed
+and created again, or a CreateImage job that is retried, asks for an image
+that was already generated. The cache maps a hash of everything the image
+depends on (model, dtype, prompt, mask, seed and sampling parameters) to the
+encoded image, its manifest and the CID of the manifest, so the oracle can
+publish it again without running the model.
+
+The entries are files in directory, the least recently used are evicted when
+they take more than max_bytes.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationCacheEntry(object):
+    __slots__ = ("image", "image_format", "manifest", "cid")
+
+    def __init__(self, image: bytes, image_format: str, manifest: dict, cid: str):
+        self.image = image
+        self.image_format = image_format
+        self.manifest = manifest
+        self.cid = cid
+
+
+class GenerationCache(object):
+    '''
+    Thread safe, shared by the image workers.
+    model_id: identifies the weights, the entries of other models are never hit.
+    dtype: of the weights, the same model gives slightly different images in float16 and float32.
+    '''
+
+    def __init__(self, model_id: str, dtype: str, directory="./cache/generations/", max_bytes=1 << 30):
+        self.model_id = model_id
+        self.dtype = dtype
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # key -> (image format, size of the files of the entry), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def key(self, prompt: str, mask: str, seed: int, **parameters) -> str:
+        '''
+        mask: digest of the mask (see MaskRegistry.digest).
+        parameters: the sampling parameters of the pipeline, e.g. num_inference_steps and strength.
+        '''
+        material = json.dumps([self.model_id, self.dtype, prompt, mask, seed, sorted(parameters.items())])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def load(self):
+        '''
+        Index the entries of the directory, in the order of their last use.
+        '''
+        entries = []
+        for file_name in os.listdir(self.directory):
+            key, extension = os.path.splitext(file_name)
+            if extension != ".json":
+                continue
+            try:
+                with open(self.path(key, "json")) as f:
+                    image_format = json.load(f)["format"]
+                size = os.path.getsize(self.path(key, "json")) + os.path.getsize(self.path(key, image_format))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Skipping the generation cache entry {key}: {e}")
+                continue
+            entries.append((os.path.getmtime(self.path(key, "json")), key, image_format, size))
+        for _, key, image_format, size in sorted(entries):
+            self.entries[key] = (image_format, size)
+            self.size += size
+        with self.lock:
+            self.evict()
+        logger.info(f"Generation cache: {len(self.entries)} images, {self.size} bytes.")
+
+    def get(self, key: str):
+        '''
+        Return the GenerationCacheEntry of key, or None.
+        An entry whose files can not be read (e.g. deleted by hand) is dropped, and is a miss.
+        '''
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self.path(key, "json")) as f:
+                    metadata = json.load(f)
+                with open(self.path(key, metadata["format"]), "rb") as f:
+                    image = f.read()
+                # the modification time is the order of the entries on disk
+                os.utime(self.path(key, "json"))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Dropping the generation cache entry {key}: {e}")
+                self.drop(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return GenerationCacheEntry(image, metadata["format"], metadata["manifest"], metadata["cid"])
+
+    def put(self, key: str, entry: GenerationCacheEntry):
+        metadata = json.dumps({"format": entry.image_format, "manifest": entry.manifest, "cid": entry.cid}).encode("utf-8")
+        with self.lock:
+            if key in self.entries:
+                return
+            # the image first: an entry exists once its json file does
+            for extension, content in ((entry.image_format, entry.image), ("json", metadata)):
+                temporary = self.path(key, extension) + ".tmp"
+                with open(temporary, "wb") as f:
+                    f.write(content)
+                os.replace(temporary, self.path(key, extension))
+            self.entries[key] = (entry.image_format, len(entry.image) + len(metadata))
+            self.size += len(entry.image) + len(metadata)
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, key: str):
+        image_format, size = self.entries.pop(key)
+        self.size -= size
+        # the json file first: an entry exists as long as its json file does
+        for extension in ("json", image_format):
+            try:
+                os.remove(self.path(key, extension))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} images, {self.size} bytes"
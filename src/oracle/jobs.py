@@ -0,0 +1,342 @@
+'''
+Persistent job queue of the oracle.
+
+The ingestion loop only stores the events in the OracleJobs table of a SQLite
+database next to the tracker's one, together with the last block read. A pool
+of workers, in this process or in other oracle processes sharing the file,
+claims the jobs with a lease, runs the handlers and marks them as done, or
+schedules a retry with exponential backoff. A job whose worker died is claimed
+again when its lease expires, so after a restart the unfinished work resumes.
+
+Every job belongs to a lane (e.g. "prompts" for PacketOpened, "images" for
+CreateImage) with its own workers, so the cheap jobs are never stuck behind
+the diffusion runs; the events of no lane go to the "default" lane. Inside a
+lane the jobs are claimed by the priority of their event, then in round robin
+across the users: the n-th pending job of a user is served after the (n-1)-th
+pending job of every other user.
+
+A job is done when the transactions sent by its handler are mined and its
+content is on IPFS; if one of them fails the job is retried. The handlers are run at least once: a job that
+crashes after sending its transactions is sent again.
+'''
+
+import fcntl
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from web3 import Web3
+
+from .event_handler import handle_event
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_LANE = "default"
+
+
+class Job(object):
+    __slots__ = ("id", "lane", "event", "args", "attempts")
+
+    def __init__(self, id: int, lane: str, event: str, args: dict, attempts: int):
+        self.id = id
+        self.lane = lane
+        self.event = event
+        self.args = args
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f"Job({self.id}, {self.lane}, {self.event}, attempts={self.attempts})"
+
+
+class JobQueue(object):
+    '''
+    Connection to the job database. Every thread must use its own JobQueue.
+
+    lanes: lane name -> {events, user}: the events of the lane and the argument
+    of the event that identifies its user. The events of no lane go to the "default" lane.
+    priorities: event name -> priority of its jobs in their lane (lower first), 0 by default.
+    lease: seconds a claimed job stays reserved to its worker.
+    max_attempts: claims after which a failing job is marked as 'failed'.
+    '''
+
+    def __init__(self, database="oracle_jobs.db", lanes=None, priorities=None, lease=600.0, max_attempts=5, backoff=5.0, max_backoff=600.0, busy_timeout=30.0):
+        # autocommit, the transactions are opened explicitly
+        self.con = sqlite3.connect(database, timeout=busy_timeout, isolation_level=None)
+        self.con.execute("PRAGMA journal_mode = WAL;")
+        # event name -> (lane, user argument)
+        self.routes = {}
+        for lane, lane_cfg in (lanes or {}).items():
+            for event_name in lane_cfg["events"]:
+                self.routes[event_name] = (lane, lane_cfg.get("user"))
+        self.priorities = dict(priorities or {})
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.create()
+        # the jobs enqueued before the lanes existed
+        for event_name, (lane, _) in self.routes.items():
+            self.con.execute("UPDATE OracleJobs SET lane = ?, priority = ? WHERE event = ? AND lane = ? AND status IN ('pending', 'running')",
+                             (lane, self.priorities.get(event_name, 0), event_name, DEFAULT_LANE))
+
+    def create(self):
+        self.con.execute('''CREATE TABLE IF NOT EXISTS OracleJobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                transactionHash TEXT NOT NULL,
+                                logIndex INTEGER NOT NULL,
+                                blockNumber INTEGER NOT NULL,
+                                event TEXT NOT NULL,
+                                args TEXT NOT NULL,
+                                status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'done', 'failed')),
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                nextAttempt REAL NOT NULL DEFAULT 0,
+                                leaseOwner TEXT,
+                                leaseExpires REAL,
+                                lastError TEXT,
+                                UNIQUE (transactionHash, logIndex)
+                            );''')
+        self.add_column("OracleJobs", "lane", f"TEXT NOT NULL DEFAULT '{DEFAULT_LANE}'")
+        self.add_column("OracleJobs", "priority", "INTEGER NOT NULL DEFAULT 0")
+        self.add_column("OracleJobs", "user", "TEXT")
+        # position of the job among the pending jobs of its user in the lane, for the round robin
+        self.add_column("OracleJobs", "fairSeq", "INTEGER NOT NULL DEFAULT 0")
+        self.add_column("OracleJobs", "createdAt", "REAL NOT NULL DEFAULT 0")
+        self.add_column("OracleJobs", "claimedAt", "REAL")
+        self.con.execute("DROP INDEX IF EXISTS OracleJobsDue;")
+        self.con.execute("CREATE INDEX IF NOT EXISTS OracleJobsLane ON OracleJobs(lane, status, priority, fairSeq, id);")
+        self.con.execute("CREATE INDEX IF NOT EXISTS OracleJobsUser ON OracleJobs(lane, user, status);")
+        self.con.execute('''CREATE TABLE IF NOT EXISTS OracleCheckpoints (
+                                name TEXT PRIMARY KEY,
+                                blockNumber INTEGER NOT NULL
+                            );''')
+
+    def add_column(self, table: str, column: str, definition: str):
+        '''
+        Add a column to a table created by an older version of the oracle.
+        '''
+        if column not in [row[1] for row in self.con.execute(f"PRAGMA table_info({table});")]:
+            self.con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
+    def route(self, event):
+        '''
+        Return the lane, the user and the priority of an event.
+        '''
+        lane, user_arg = self.routes.get(event.event, (DEFAULT_LANE, None))
+        user = event.args[user_arg].lower() if user_arg else None
+        return lane, user, self.priorities.get(event.event, 0)
+
+    def get_checkpoint(self, name="oracle"):
+        res = self.con.execute("SELECT blockNumber FROM OracleCheckpoints WHERE name = ?", (name,)).fetchone()
+        return None if res is None else res[0]
+
+    def enqueue(self, events, checkpoint=None, name="oracle"):
+        '''
+        Store the events as pending jobs, and the last block read, in one transaction.
+        An event already in the queue (same transactionHash and logIndex) is ignored.
+        '''
+        now = time.time()
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            for event in events:
+                lane, user, priority = self.route(event)
+                fair_seq = self.con.execute('''SELECT COUNT(*) FROM OracleJobs
+                                               WHERE lane = ? AND user IS ? AND status IN ('pending', 'running')''', (lane, user)).fetchone()[0]
+                self.con.execute('''INSERT OR IGNORE INTO OracleJobs(transactionHash, logIndex, blockNumber, event, args, lane, priority, user, fairSeq, createdAt)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                                 (Web3.to_hex(event.transactionHash), event.logIndex, event.blockNumber, event.event, json.dumps(dict(event.args)),
+                                  lane, priority, user, fair_seq, now))
+            if checkpoint is not None:
+                self.con.execute("INSERT OR REPLACE INTO OracleCheckpoints(name, blockNumber) VALUES (?, ?)", (name, checkpoint))
+            self.con.execute("COMMIT")
+        except BaseException:
+            self.con.execute("ROLLBACK")
+            raise
+
+    def claim(self, owner: str, lane: str = DEFAULT_LANE):
+        '''
+        Lease the next due job of the lane to owner, or return None.
+        A running job whose lease has expired is due again.
+        '''
+        now = time.time()
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            # the worker died with the last attempt
+            self.con.execute('''UPDATE OracleJobs SET status = 'failed', leaseOwner = NULL, leaseExpires = NULL, lastError = 'lease expired'
+                                WHERE lane = ? AND status = 'running' AND leaseExpires < ? AND attempts >= ?''', (lane, now, self.max_attempts))
+            res = self.con.execute('''SELECT id, event, args, attempts FROM OracleJobs
+                                      WHERE lane = ? AND ((status = 'pending' AND nextAttempt <= ?) OR (status = 'running' AND leaseExpires < ?))
+                                      ORDER BY priority, fairSeq, id LIMIT 1''', (lane, now, now)).fetchone()
+            if res is None:
+                self.con.execute("COMMIT")
+                return None
+            self.con.execute('''UPDATE OracleJobs SET status = 'running', attempts = attempts + 1, leaseOwner = ?, leaseExpires = ?,
+                                                     claimedAt = COALESCE(claimedAt, ?)
+                                WHERE id = ?''', (owner, now + self.lease, now, res[0]))
+            self.con.execute("COMMIT")
+        except BaseException:
+            self.con.execute("ROLLBACK")
+            raise
+        return Job(res[0], lane, res[1], json.loads(res[2]), res[3] + 1)
+
+    def lane_stats(self, window=300.0):
+        '''
+        Return, for every lane, the pending and running jobs, the wait of the oldest
+        pending job, and the average and max wait of the jobs claimed in the last `window` seconds.
+        '''
+        now = time.time()
+        stats = {}
+        for lane, pending, running, oldest in self.con.execute('''SELECT lane, SUM(status = 'pending'), SUM(status = 'running'),
+                                                                         MIN(CASE WHEN status = 'pending' THEN createdAt END)
+                                                                  FROM OracleJobs WHERE status IN ('pending', 'running') GROUP BY lane'''):
+            stats[lane] = {"pending": pending, "running": running, "oldest_wait": 0.0 if oldest is None else now - oldest,
+                           "avg_wait": 0.0, "max_wait": 0.0}
+        for lane, avg_wait, max_wait in self.con.execute('''SELECT lane, AVG(claimedAt - createdAt), MAX(claimedAt - createdAt)
+                                                           FROM OracleJobs WHERE claimedAt >= ? GROUP BY lane''', (now - window,)):
+            lane_stats = stats.setdefault(lane, {"pending": 0, "running": 0, "oldest_wait": 0.0})
+            lane_stats["avg_wait"] = avg_wait
+            lane_stats["max_wait"] = max_wait
+        return stats
+
+    def complete(self, job: Job, owner: str):
+        self.con.execute("UPDATE OracleJobs SET status = 'done', leaseOwner = NULL, leaseExpires = NULL WHERE id = ? AND leaseOwner = ?",
+                         (job.id, owner))
+
+    def fail(self, job: Job, owner: str, error: str):
+        '''
+        Schedule a retry with exponential backoff, or mark the job as failed after max_attempts.
+        '''
+        if job.attempts >= self.max_attempts:
+            logger.error(f"Giving up on {job} after {job.attempts} attempts: {error}")
+            self.con.execute('''UPDATE OracleJobs SET status = 'failed', leaseOwner = NULL, leaseExpires = NULL, lastError = ?
+                                WHERE id = ? AND leaseOwner = ?''', (error, job.id, owner))
+            return
+        delay = min(self.backoff * 2 ** (job.attempts - 1), self.max_backoff)
+        logger.warning(f"{job} failed, retrying in {delay}s: {error}")
+        self.con.execute('''UPDATE OracleJobs SET status = 'pending', nextAttempt = ?, leaseOwner = NULL, leaseExpires = NULL, lastError = ?
+                            WHERE id = ? AND leaseOwner = ?''', (time.time() + delay, error, job.id, owner))
+
+    def close(self):
+        self.con.close()
+
+
+def openJobQueue(jobs_cfg):
+    '''
+    Open the job database with the settings of conf/oracle_config.yaml.
+    '''
+    lanes = {lane: {"events": list(lane_cfg.events), "user": lane_cfg.user}
+             for lane, lane_cfg in jobs_cfg.lanes.items()}
+    return JobQueue(jobs_cfg.database, lanes=lanes, priorities=dict(jobs_cfg.priorities), lease=jobs_cfg.lease, max_attempts=jobs_cfg.max_attempts,
+                    backoff=jobs_cfg.backoff, max_backoff=jobs_cfg.max_backoff)
+
+
+def lockSigners(jobs_cfg, addresses):
+    '''
+    Take a lock, next to the job database, on every signer account of this process.
+    The submitter counts the nonces locally, so two processes sending with the same account
+    would reuse them. The locks are released when the process exits.
+    '''
+    locks = []
+    for address in addresses:
+        lock = open(f"{jobs_cfg.database}.{address.lower()}.lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise RuntimeError(f"The signer {address} is used by another oracle process: "
+                               f"every worker process needs its own public_key and submitter.signers.")
+        locks.append(lock)
+    return locks
+
+
+class WorkerPool(object):
+    '''
+    Threads that claim and run the oracle jobs, `workers` of them for every lane
+    and `default_workers` for the default lane.
+    A worker does not wait for the transactions and uploads of its jobs: it completes (or fails)
+    them between the claims, once their futures are resolved (the transactions by submitter.pump()).
+
+    init_data: function that opens the tracker database, every worker has its own connection.
+    model: shared by the workers, it must be thread safe (see src.oracle.batching.BatchedModel).
+    cache: GenerationCache shared by the workers, or None.
+    '''
+
+    def __init__(self, jobs_cfg, provider, contract, uploader, model, init_data, submitter, cache=None):
+        self.jobs_cfg = jobs_cfg
+        self.provider = provider
+        self.contract = contract
+        self.uploader = uploader
+        self.model = model
+        self.init_data = init_data
+        self.submitter = submitter
+        self.cache = cache
+        self.stopped = threading.Event()
+        lane_workers = {lane: lane_cfg.workers for lane, lane_cfg in jobs_cfg.lanes.items()}
+        lane_workers[DEFAULT_LANE] = jobs_cfg.default_workers
+        self.threads = [threading.Thread(target=self.work, args=(lane, idx), name=f"oracle-{lane}-{idx}", daemon=True)
+                        for lane, workers in lane_workers.items() for idx in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+    def work(self, lane: str, idx: int):
+        queue = openJobQueue(self.jobs_cfg)
+        data = self.init_data()
+        owner = f"{socket.gethostname()}:{os.getpid()}:{lane}:{idx}"
+        # (job, futures of its transactions and uploads) not resolved yet
+        in_flight = []
+        while not self.stopped.is_set():
+            in_flight = self.settle(queue, owner, in_flight)
+            job = queue.claim(owner, lane)
+            if job is None:
+                self.stopped.wait(self.jobs_cfg.poll_interval)
+                continue
+            try:
+                futures = self.run(job, data)
+            except Exception as e:
+                queue.fail(job, owner, str(e))
+                continue
+            in_flight.append((job, futures))
+        # the jobs still in flight are claimed again when their lease expires
+        queue.close()
+
+    def run(self, job: Job, data):
+        event = JobEvent(job.event, job.args)
+        return handle_event(event, self.provider, self.contract, self.uploader, self.model, data, self.submitter, self.cache, logger) or []
+
+    def settle(self, queue: JobQueue, owner: str, in_flight):
+        '''
+        Complete the jobs whose futures all succeeded, fail the ones with a failed future,
+        return the others.
+        '''
+        still_in_flight = []
+        for job, futures in in_flight:
+            if not all(future.done() for future in futures):
+                still_in_flight.append((job, futures))
+                continue
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                queue.fail(job, owner, str(errors[0]))
+            else:
+                queue.complete(job, owner)
+        return still_in_flight
+
+
+class JobEvent(object):
+    '''
+    The event of a job, with the attributes used by handle_event.
+    '''
+    __slots__ = ("event", "args")
+
+    def __init__(self, event: str, args: dict):
+        self.event = event
+        self.args = args
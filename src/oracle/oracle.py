@@ -12,7 +12,14 @@ import logging
 import time
 import json
 from .events import public_key, private_key
-from .event_handler import handle_event, initOracleFilters
+from .event_handler import initOracleFilters, initOraclePoller
+from .submitter import TransactionSubmitter
+from .jobs import WorkerPool, openJobQueue, lockSigners
+from .batching import BatchedModel
+from .embeddings import PromptEmbeddingCache
+from .generation_cache import GenerationCache
+from .uploads import IPFSUploader
+from ..tracker.poller import LogPoller
 import diffusers
 
 import sqlite3
@@ -29,13 +36,29 @@ logger = logging.getLogger(__name__)
 
 def initModel(model_cfg):
     '''
-    Initializes the diffusion model from the config file.
+    Initializes the diffusion model from the config file, on its device and dtype.
     '''
-    model = hydra.utils.call(model_cfg.from_pretrained, torch_dtype=torch.float16)
+    model = hydra.utils.call(model_cfg.from_pretrained, torch_dtype=getattr(torch, model_cfg.dtype))
     model.to(model_cfg.device)
     logger.info("Model instantiated.")
     return model
 
+def initEmbeddings(model, model_cfg):
+    '''
+    Initializes the cache of the text embeddings of the model, if it has one.
+    '''
+    if model_cfg.get("embeddings") is None:
+        return None
+    return PromptEmbeddingCache(model, **model_cfg.embeddings)
+
+def initGenerationCache(cfg):
+    '''
+    Initializes the cache of the generated images, keyed by the id and the dtype of the model.
+    '''
+    if cfg.generation_cache is None:
+        return None
+    return GenerationCache(cfg.model.id, cfg.model.dtype, **cfg.generation_cache)
+
 def instantiateProvider(provider_cfg):
     '''
     Instantiates the web3 provider from the config file.
@@ -93,18 +116,58 @@ def initContract(contract_cfg, provider):
     )
     return contract
 
-def loop(provider, contract, filters, IPFSClient, model, data, cfg):
+def initSubmitter(provider, cfg):
+    '''
+    Init the transaction submitter with the oracle account and the extra signers.
+    '''
+    signers = [(cfg.public_key, cfg.private_key)]
+    signers += [(signer.address, signer.private_key) for signer in cfg.submitter.signers]
+    return TransactionSubmitter(provider, signers, resubmit_after=cfg.submitter.resubmit_after,
+                                gas_bump=cfg.submitter.gas_bump, max_attempts=cfg.submitter.max_attempts)
+
+def initFilters(provider, contract, queue, cfg):
+    '''
+    Init the filters. The log poller restarts after the last block enqueued.
+    '''
+    if cfg.poller != "logs":
+        return initOracleFilters(contract)
+    checkpoint = queue.get_checkpoint()
+    from_block = "latest" if checkpoint is None else checkpoint + 1
+    logger.info(f"Reading the events from block {from_block}.")
+    return initOraclePoller(provider, contract, from_block=from_block)
+
+def logLaneStats(stats):
+    '''
+    Log the queue depth and the wait times of every lane.
+    '''
+    for lane, lane_stats in sorted(stats.items()):
+        logger.info(f"lane {lane}: {lane_stats['pending']} pending, {lane_stats['running']} running, "
+                    f"oldest wait {lane_stats['oldest_wait']:.1f}s, avg wait {lane_stats['avg_wait']:.1f}s, max wait {lane_stats['max_wait']:.1f}s")
+
+def loop(filters, queue, submitter, cfg):
     '''
-    Main loop of the oracle.
+    Main loop of the oracle: enqueue the new events and track the transactions.
+    The jobs are run by the worker pool.
     '''
+    last_stats = time.time()
     while True:
         for filter in filters:
-            for idx, event in enumerate(filter.get_new_entries()):
-                try:
-                    handle_event(event, provider, contract, IPFSClient, model, data, logger)
-                except Exception as e:
-                    logger.warning(f"Error handling event {idx}: {e}\nWhile handling event: {event}")
-                    traceback.print_exc()
+            try:
+                events = filter.get_new_entries()
+            except Exception as e:
+                logger.warning(f"Error reading the events: {e}")
+                traceback.print_exc()
+                continue
+            # if this fails the process stops, and restarts from the last checkpoint
+            queue.enqueue(events, checkpoint=filter.last_block if isinstance(filter, LogPoller) else None)
+        if submitter is not None:
+            try:
+                submitter.pump()
+            except Exception as e:
+                logger.warning(f"Error tracking the transactions: {e}")
+        if time.time() - last_stats >= cfg.jobs.stats_interval:
+            last_stats = time.time()
+            logLaneStats(queue.lane_stats(cfg.jobs.stats_interval))
         time.sleep(cfg.poll_interval)
         
 
@@ -119,13 +182,8 @@ def main(cfg):
     # set the public and private keys of the oracle
     public_key = cfg.public_key
     private_key = cfg.private_key
-    # create the model
-    model = initModel(cfg.model)
-
-    data = initData()
-
-    # connect to IPFS
-    IPFSClient = instantiateIPFS(cfg.ipfs)
+    # open the job queue
+    queue = openJobQueue(cfg.jobs)
 
     # Create web3 connection
     provider = instantiateProvider(cfg.provider)
@@ -134,10 +192,38 @@ def main(cfg):
     contract = initContract(cfg.contract, provider)
 
     # Initialize the filters
-    filters = initOracleFilters(contract)
+    filters = []
+    if cfg.role != "worker":
+        filters = initFilters(provider, contract, queue, cfg)
+
+    submitter = workers = None
+    if cfg.role != "ingest":
+        # the accounts of the submitter can not be used by the other worker processes
+        signer_locks = lockSigners(cfg.jobs, [cfg.public_key] + [signer.address for signer in cfg.submitter.signers])
+
+        # create the model, the image workers share it through the batching stage
+        pipeline = initModel(cfg.model)
+        model = BatchedModel(pipeline, embeddings=initEmbeddings(pipeline, cfg.model), **cfg.batching)
+
+        # connect to IPFS
+        IPFSClient = instantiateIPFS(cfg.ipfs)
+        uploader = IPFSUploader(IPFSClient.http_client, **cfg.uploads)
+
+        # Init the transaction submitter
+        submitter = initSubmitter(provider, cfg)
+
+        # Start the workers
+        workers = WorkerPool(cfg.jobs, provider, contract, uploader, model, initData, submitter, initGenerationCache(cfg))
+        workers.start()
 
     # Start the loop
-    loop(provider, contract, filters, IPFSClient, model, data, cfg)
+    try:
+        loop(filters, queue, submitter, cfg)
+    finally:
+        if workers is not None:
+            workers.stop()
+            # the CIDs of the pending uploads may already be on chain
+            uploader.shutdown()
 
 if __name__ == "__main__":
     main()
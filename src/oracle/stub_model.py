@@ -0,0 +1,63 @@
+'''
+Deterministic stand-in for the diffusion pipeline.
+
+It has the interface of the diffusers image to image pipeline used by the
+oracle, and draws the image from a hash of the prompt and of the seed of the
+generator, blended with the mask, so the same (prompt, mask, seed) always
+gives the same image, batched or not. It runs on CPU in a few milliseconds;
+`latency` and `latency_per_image` simulate the inference time.
+
+Select it with `model=stub`, e.g. to load test the oracle without a GPU:
+python3 -m src.oracle.oracle model=stub
+'''
+
+import hashlib
+import time
+import numpy as np
+import torch
+from PIL import Image
+
+
+class StubPipelineOutput(object):
+    __slots__ = ("images",)
+
+    def __init__(self, images):
+        self.images = images
+
+
+class StubPipeline(object):
+
+    def __init__(self, torch_dtype=torch.float32, latency=0.0, latency_per_image=0.0):
+        self.device = torch.device("cpu")
+        self.dtype = torch_dtype
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+
+    def to(self, device):
+        self.device = torch.device(device)
+        return self
+
+    def generate(self, prompt: str, mask: torch.Tensor, seed: int, strength: float):
+        '''
+        mask: (C, H, W) with values in [0, 1].
+        '''
+        digest = hashlib.sha256(f"{prompt}:{seed}".encode("utf-8")).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], "big"))
+        channels, height, width = mask.shape
+        # a smooth gradient between two colors of the prompt, plus the noise of the seed
+        colors = rng.integers(0, 256, size=(2, 3)).astype(np.float32)
+        ramp = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None, None]
+        noise = rng.normal(0.0, 16.0, size=(height, width, 3)).astype(np.float32)
+        generated = colors[0] * (1 - ramp) + colors[1] * ramp + noise
+        base = mask.detach().to("cpu", torch.float32).permute(1, 2, 0).numpy()[:, :, :3] * 255.0
+        pixels = base * (1 - strength) + generated * strength
+        return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    def __call__(self, prompt, image, generator, strength=0.8, **kwargs):
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+        generators = generator if isinstance(generator, list) else [generator]
+        images = [self.generate(item_prompt, mask, item_generator.initial_seed(), strength)
+                  for item_prompt, mask, item_generator in zip(prompts, image, generators)]
+        if self.latency or self.latency_per_image:
+            time.sleep(self.latency + self.latency_per_image * len(images))
+        return StubPipelineOutput(images)
@@ -0,0 +1,293 @@
+'''
+Transaction submitter of the oracle.
+
+The handlers used to build, sign and send one transaction at a time, asking
+the node for the nonce and waiting for the receipt before the next one, so a
+packet took 8 blocks to be published. The submitter keeps a local nonce
+counter for every signer account, sends the transactions back to back and
+tracks their receipts from the oracle loop (pump), resubmitting the ones that
+are dropped by the node, stuck or replaced. When a transaction is given up on
+its nonce is filled with a zero-value self-transfer, otherwise every later
+transaction of the signer would wait behind the gap.
+'''
+
+from concurrent.futures import Future
+from itertools import cycle
+import logging
+import threading
+import time
+from web3.exceptions import TransactionNotFound
+
+logger = logging.getLogger(__name__)
+
+
+class TransactionFailed(Exception):
+    pass
+
+
+class Signer(object):
+    '''
+    An oracle account with its local nonce counter.
+    '''
+    __slots__ = ("address", "private_key", "nonce")
+
+    def __init__(self, address: str, private_key: str, nonce: int):
+        self.address = address
+        self.private_key = private_key
+        self.nonce = nonce
+
+    def next_nonce(self) -> int:
+        nonce = self.nonce
+        self.nonce += 1
+        return nonce
+
+    def release_nonce(self, nonce: int):
+        # only the last nonce taken can be given back without leaving a gap
+        if self.nonce == nonce + 1:
+            self.nonce = nonce
+
+
+class PendingTransaction(object):
+    '''
+    A contract call sent with a given signer and nonce.
+    hashes has the hash of every version sent (the original and the gas bumps).
+    function_call is None for the self-transfers that fill the nonce of a failed transaction.
+    '''
+    __slots__ = ("function_call", "signer", "nonce", "tx", "raw", "hashes", "sent_at", "attempts", "future")
+
+    def __init__(self, function_call, signer: Signer, future: Future):
+        self.function_call = function_call
+        self.signer = signer
+        self.nonce = None
+        self.tx = None
+        self.raw = None
+        self.hashes = []
+        self.sent_at = None
+        self.attempts = 0
+        self.future = future
+
+
+class TransactionSubmitter(object):
+    '''
+    Sign and send contract calls without waiting for the receipts.
+
+    signers: list of (address, private key), used in rotation. All of them must
+    be allowed to call the oracle functions of the contract.
+    resubmit_after: seconds after which a transaction that is not mined is
+    sent again, with the fees multiplied by gas_bump if the node still has it.
+    After max_attempts sends the future of the transaction fails, and its
+    nonce is filled with a self-transfer that is sent until it is mined.
+    '''
+
+    def __init__(self, provider, signers, resubmit_after=30.0, gas_bump=1.125, max_attempts=5):
+        self.provider = provider
+        self.signers = [Signer(address, private_key, provider.eth.get_transaction_count(address, "pending"))
+                        for address, private_key in signers]
+        self.rotation = cycle(self.signers)
+        self.resubmit_after = resubmit_after
+        self.gas_bump = gas_bump
+        self.max_attempts = max_attempts
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def submit(self, function_call) -> Future:
+        '''
+        Build, sign and send a contract call (e.g. contract.functions.promptMinted(...)).
+        The returned future is resolved with the receipt by pump().
+        If the call cannot be built (e.g. it would revert) the exception is raised here.
+        '''
+        future = Future()
+        future.add_done_callback(self.log_failure)
+        with self.lock:
+            pending = PendingTransaction(function_call, next(self.rotation), future)
+            self.build(pending)
+            self.send(pending)
+            self.pending.append(pending)
+        return future
+
+    def build(self, pending: PendingTransaction):
+        '''
+        Build and sign the call with the next nonce of its signer.
+        On failure the nonce is given back and pending is left as it was.
+        '''
+        nonce = pending.signer.next_nonce()
+        try:
+            tx = pending.function_call.build_transaction({
+                "from": pending.signer.address,
+                "nonce": nonce,
+            })
+            signed_tx = self.provider.eth.account.sign_transaction(tx, private_key=pending.signer.private_key)
+        except Exception:
+            pending.signer.release_nonce(nonce)
+            raise
+        pending.nonce = nonce
+        pending.tx = tx
+        pending.raw = signed_tx.rawTransaction
+        pending.hashes = [signed_tx.hash]
+
+    def sign(self, pending: PendingTransaction):
+        signed_tx = self.provider.eth.account.sign_transaction(pending.tx, private_key=pending.signer.private_key)
+        pending.raw = signed_tx.rawTransaction
+        if signed_tx.hash not in pending.hashes:
+            pending.hashes.append(signed_tx.hash)
+
+    def send(self, pending: PendingTransaction):
+        pending.attempts += 1
+        pending.sent_at = time.time()
+        try:
+            self.provider.eth.send_raw_transaction(pending.raw)
+        except Exception as e:
+            message = str(e).lower()
+            if "already known" in message:
+                return
+            if "nonce too low" in message:
+                if pending.function_call is None:
+                    # the gap is already filled
+                    pending.future.set_result(None)
+                    return
+                # the nonce was used outside of the submitter, take a new one
+                self.resync(pending.signer)
+                try:
+                    self.build(pending)
+                except Exception as build_error:
+                    pending.future.set_exception(build_error)
+                    return
+            # sent again by pump()
+            logger.warning(f"Could not send transaction {pending.nonce} of {pending.signer.address}: {e}")
+            pending.sent_at = 0
+
+    def fill(self, pending: PendingTransaction) -> PendingTransaction:
+        '''
+        Send a zero-value self-transfer with the nonce of a transaction that was given up on.
+        Its fees are bumped, so that it replaces the transaction if the node still has it.
+        '''
+        address = pending.signer.address
+        tx = {"chainId": pending.tx["chainId"], "from": address, "to": address, "value": 0, "gas": 21000, "nonce": pending.nonce}
+        for key in ("gasPrice", "maxFeePerGas", "maxPriorityFeePerGas"):
+            if key in pending.tx:
+                tx[key] = int(pending.tx[key] * self.gas_bump) + 1
+        filler = PendingTransaction(None, pending.signer, Future())
+        filler.nonce = pending.nonce
+        filler.tx = tx
+        # the transaction can still be mined instead of the filler
+        filler.hashes = list(pending.hashes)
+        self.sign(filler)
+        self.send(filler)
+        return filler
+
+    def resync(self, signer: Signer):
+        signer.nonce = max(signer.nonce, self.provider.eth.get_transaction_count(signer.address, "pending"))
+
+    def bump(self, pending: PendingTransaction):
+        '''
+        Replace a stuck transaction with the same nonce and higher fees.
+        '''
+        for key in ("gasPrice", "maxFeePerGas", "maxPriorityFeePerGas"):
+            if key in pending.tx:
+                pending.tx[key] = int(pending.tx[key] * self.gas_bump) + 1
+        self.sign(pending)
+
+    def get_receipt(self, pending: PendingTransaction):
+        for tx_hash in pending.hashes:
+            try:
+                return self.provider.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                pass
+        return None
+
+    def is_known(self, pending: PendingTransaction) -> bool:
+        try:
+            self.provider.eth.get_transaction(pending.hashes[-1])
+            return True
+        except TransactionNotFound:
+            return False
+
+    def pump(self):
+        '''
+        Resolve the mined transactions and resubmit the dropped, stuck and replaced ones.
+        '''
+        with self.lock:
+            if not self.pending:
+                return
+            now = time.time()
+            # nonces mined by every signer: only the transactions below it can have a receipt
+            mined = {signer.address: self.provider.eth.get_transaction_count(signer.address, "latest")
+                     for signer in {pending.signer for pending in self.pending}}
+            # lowest nonce not mined of every signer: the transactions after it cannot be mined before it
+            blocking = {}
+            for pending in self.pending:
+                address = pending.signer.address
+                if not pending.future.done() and pending.nonce >= mined[address]:
+                    blocking[address] = min(blocking.get(address, pending.nonce), pending.nonce)
+            still_pending = []
+            for pending in self.pending:
+                if pending.future.done():
+                    # failed while it was sent again
+                    continue
+                if pending.nonce < mined[pending.signer.address]:
+                    receipt = self.get_receipt(pending)
+                    if receipt is not None:
+                        self.resolve(pending, receipt)
+                        continue
+                    if pending.function_call is None:
+                        # the gap was filled by a transaction that is not ours
+                        pending.future.set_result(None)
+                        continue
+                    # the nonce was taken by a transaction that is not ours: send the call again with a new nonce
+                    if pending.attempts >= self.max_attempts:
+                        # checked before taking a new nonce, which would be left unused
+                        self.give_up(pending)
+                        continue
+                    logger.warning(f"Transaction {pending.nonce} of {pending.signer.address} was replaced, resubmitting it.")
+                    pending.signer = next(self.rotation)
+                    try:
+                        self.build(pending)
+                    except Exception as e:
+                        pending.future.set_exception(e)
+                        continue
+                elif pending.nonce > blocking[pending.signer.address]:
+                    # queued behind a lower nonce: it is not stuck, its timer starts once that one is mined
+                    pending.sent_at = now
+                    still_pending.append(pending)
+                    continue
+                elif now - pending.sent_at < self.resubmit_after:
+                    still_pending.append(pending)
+                    continue
+                elif pending.hashes and self.is_known(pending):
+                    # stuck in the mempool
+                    self.bump(pending)
+
+                if pending.function_call is not None and pending.attempts >= self.max_attempts:
+                    self.give_up(pending)
+                    # the nonce is not mined yet: fill it
+                    still_pending.append(self.fill(pending))
+                    continue
+                self.send(pending)
+                still_pending.append(pending)
+            self.pending = still_pending
+
+    def give_up(self, pending: PendingTransaction):
+        pending.future.set_exception(TransactionFailed(f"Transaction {pending.nonce} of {pending.signer.address} "
+                                                       f"not mined after {pending.attempts} attempts."))
+
+    def resolve(self, pending: PendingTransaction, receipt):
+        if receipt["status"] == 1:
+            pending.future.set_result(receipt)
+        else:
+            pending.future.set_exception(TransactionFailed(f"Transaction {receipt['transactionHash'].hex()} reverted."))
+
+    def log_failure(self, future: Future):
+        if future.exception() is not None:
+            logger.error(f"{future.exception()}")
+
+    def wait(self, futures, timeout=None):
+        '''
+        Pump until all the futures are done, return their results.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while not all(future.done() for future in futures):
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("Transactions not mined in time.")
+            time.sleep(0.1)
+            self.pump()
+        return [future.result() for future in futures]
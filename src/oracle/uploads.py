@@ -0,0 +1,76 @@
+'''
+Background uploads to IPFS.
+
+The handlers compute the CIDs of their content locally (src/utils/cid.py) and
+submit the transactions right away; the uploader adds (and so pins) the
+content on the IPFS node from its own threads, retrying with a backoff, and
+checks that the node gives the content the CID that was published. Content
+larger than one chunk, whose CID is not computed locally, is added before
+returning.
+'''
+
+from concurrent.futures import ThreadPoolExecutor, Future
+import logging
+import time
+from ..utils.cid import computeCid, CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class UploadFailed(Exception):
+    pass
+
+
+class IPFSUploader(object):
+    '''
+    http_client: the IPFS http client (IPFSClient.http_client).
+    '''
+
+    def __init__(self, http_client, workers=4, max_attempts=5, backoff=2.0):
+        self.http_client = http_client
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="oracle-upload")
+
+    def upload(self, content: bytes) -> (str, Future):
+        '''
+        Return the CID of content and the future of its upload, resolved with the CID.
+        '''
+        if len(content) > CHUNK_SIZE:
+            cid = self.add(content)
+            future = Future()
+            future.set_result(cid)
+            return cid, future
+        cid = computeCid(content)
+        future = self.executor.submit(self.add, content, cid)
+        future.add_done_callback(self.log_failure)
+        return cid, future
+
+    def add(self, content: bytes, cid: str = None) -> str:
+        '''
+        Add content to IPFS, check that it gets cid if it is given, return its CID.
+        '''
+        name = cid or f"{len(content)} bytes"
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                added = self.http_client.add_bytes(content)
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise UploadFailed(f"Could not upload {name} after {attempt} attempts: {e}")
+                logger.warning(f"Upload of {name} failed ({e}), retrying.")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+            if cid is not None and added != cid:
+                # the node was configured with other chunking or CID options: the published CID does not resolve
+                raise UploadFailed(f"IPFS added the content of {cid} as {added}.")
+            return added
+
+    def log_failure(self, future: Future):
+        if future.exception() is not None:
+            logger.error(f"{future.exception()}")
+
+    def shutdown(self):
+        '''
+        Wait for the pending uploads.
+        '''
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,165 @@
+'''
+Asyncio version of the tracker.
+
+A websocket newHeads subscription wakes the tracker up as soon as a block is
+mined; the logs of the new blocks are then fetched with eth_getLogs, exactly
+like the synchronous tracker. If the websocket is not available the tracker
+falls back to HTTP polling, with an interval that grows while the chain is
+idle and resets when new blocks arrive.
+
+The database is only written by a single writer thread: follow() hands it
+the blocks and awaits them before the next fetch, so the events are applied
+strictly in chain order while the event loop stays free for the head
+subscription, and the IPFS fetches of the enrichment queue run concurrently in
+its worker threads.
+
+Select it with `mode: "async"` in conf/tracker_config.yaml.
+'''
+
+import asyncio
+import logging
+import hydra
+from concurrent.futures import ThreadPoolExecutor
+from web3 import AsyncWeb3
+
+from .event_handler import TRACKER_EVENTS, REORG_TOO_DEEP, applyBlocks, getStartBlock, initTrackerDecoder
+from .poller import AsyncLogPoller, ChainReorganization
+
+logger = logging.getLogger(__name__)
+
+
+class HeadSubscription(object):
+    '''
+    Keep a newHeads subscription open and set `wake` on every new block.
+    '''
+
+    def __init__(self, websocket_cfg, wake: asyncio.Event, max_backoff=30.0):
+        self.websocket_cfg = websocket_cfg
+        self.wake = wake
+        self.max_backoff = max_backoff
+        self.connected = False
+
+    async def run(self):
+        backoff = 1.0
+        while True:
+            try:
+                provider = hydra.utils.instantiate(self.websocket_cfg)
+                async with AsyncWeb3.persistent_websocket(provider) as w3:
+                    await w3.eth.subscribe("newHeads")
+                    self.connected = True
+                    backoff = 1.0
+                    logger.info("Subscribed to newHeads.")
+                    async for _ in w3.ws.process_subscriptions():
+                        self.wake.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Websocket subscription failed, polling over HTTP: {e}")
+            self.connected = False
+            # wake up the follower, so that it switches to polling right away
+            self.wake.set()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+
+def rollbackBlocks(data, block_number: int):
+    with data.unit_of_work():
+        data.rollback_blocks(block_number)
+
+async def rollbackReorg(reorg, poller, data, writer):
+    '''
+    Roll back the orphaned blocks and restart the poller from the newest journaled block still in the chain.
+    '''
+    for block_number, block_hash in data.get_journaled_blocks():
+        if await poller.get_block_hash(block_number) == block_hash:
+            break
+    else:
+        raise RuntimeError(REORG_TOO_DEEP)
+
+    logger.warning(f"{reorg} Rolling back to block {block_number}.")
+    await asyncio.get_running_loop().run_in_executor(writer, rollbackBlocks, data, block_number)
+    poller.reset(block_number, block_hash)
+
+
+async def follow(poller, IPFSClient, data, subscription, wake, writer, cfg):
+    '''
+    Apply the new blocks every time the subscription (or the polling timer) fires.
+    The blocks are applied in the writer thread, one fetch at a time.
+    '''
+    async_cfg = cfg.async_tracker
+    loop = asyncio.get_running_loop()
+    interval = async_cfg.min_poll_interval
+    # the block before the first one to read: nothing is recorded until the poller moves past it
+    checkpoint = poller.last_block
+    while True:
+        wake.clear()
+        try:
+            events = await poller.get_new_entries()
+        except ChainReorganization as reorg:
+            await rollbackReorg(reorg, poller, data, writer)
+            checkpoint = poller.last_block
+            continue
+        new_blocks = poller.last_block != checkpoint
+        if events or new_blocks:
+            await loop.run_in_executor(writer, applyBlocks, events, poller, poller.provider, poller.contract,
+                                       IPFSClient, data, cfg, logger)
+            checkpoint = poller.last_block
+
+        if not poller.caught_up:
+            # backfilling: let the other tasks run, then fetch the next chunk
+            await asyncio.sleep(0)
+            continue
+
+        if new_blocks:
+            interval = async_cfg.min_poll_interval
+        else:
+            interval = min(interval * 2, async_cfg.max_poll_interval)
+        # with a live subscription the timer is only a safety net
+        timeout = async_cfg.max_poll_interval if subscription.connected else interval
+        try:
+            await asyncio.wait_for(wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def enrich(enricher, writer, interval):
+    '''
+    Pump the enrichment queue. It runs in the writer thread like the blocks of
+    follow(), so the two never write to the database at the same time.
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(writer, enricher.pump)
+        await asyncio.sleep(interval)
+
+
+async def run(IPFSClient, data, enricher, abi, cfg):
+    '''
+    Entry point of the asyncio tracker.
+    '''
+    async_cfg = cfg.async_tracker
+    provider = AsyncWeb3(hydra.utils.instantiate(async_cfg.http))
+    address = provider.to_checksum_address(cfg.contract.contract_address)
+    contract = provider.eth.contract(address=address, abi=abi)
+
+    from_block = getStartBlock(data, cfg.start_block, logger)
+    poller = AsyncLogPoller(provider, contract, TRACKER_EVENTS, from_block=from_block, chunk_size=cfg.chunk_size,
+                            confirmations=cfg.confirmations, last_block_hash=data.get_block_hash(from_block - 1),
+                            decoder=initTrackerDecoder(abi))
+
+    wake = asyncio.Event()
+    subscription = HeadSubscription(async_cfg.websocket, wake)
+    # every write to the database, in the order it is submitted
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+    tasks = [
+        asyncio.create_task(subscription.run()),
+        asyncio.create_task(enrich(enricher, writer, async_cfg.min_poll_interval)),
+    ]
+    try:
+        await follow(poller, IPFSClient, data, subscription, wake, writer, cfg)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # a cancelled await does not stop the unit of work already running in the writer
+        writer.shutdown(wait=True)
+        enricher.shutdown()
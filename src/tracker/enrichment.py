@@ -0,0 +1,138 @@
+'''
+IPFS enrichment queue of the tracker.
+
+The event handlers only write the ownership and listing state and enqueue the
+IPFS work in the EnrichmentJobs table. The queue fetches the metadata with a
+bounded pool of worker threads and writes the results back from the tracker's
+thread, so a slow IPFS daemon never stalls the indexing of the chain.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import time
+
+from ..db.data import Data, Prompt, Image
+from ..utils.utils import from_int_to_hex_str
+from ..utils.image_payload import saveManifestImage, getImageCid
+
+logger = logging.getLogger(__name__)
+
+PROMPT_JOB = 1
+IMAGE_JOB = 2
+UNPIN_JOB = 3
+
+
+def fetchPrompt(IPFSClient, job):
+    '''
+    Return the name and the rarity of a prompt.
+    '''
+    prompt_json = json.loads(IPFSClient.http_client.cat(job["ipfsHash"]).decode("utf-8"))
+    return prompt_json['name'], prompt_json['rarity']
+
+def fetchImage(IPFSClient, job):
+    '''
+    Save the image of a card and return its prompts.
+    The manifest can be in the binary or in the legacy (JSON pixels) format.
+    '''
+    manifest = IPFSClient.http_client.get_json(job["ipfsHash"])
+
+    saveManifestImage(IPFSClient.http_client, manifest, f"ipfs/image/{from_int_to_hex_str(job['objId'])}.png")
+
+    return manifest["prompts"]
+
+def unpin(IPFSClient, job):
+    '''
+    Unpin the manifest of a card and the image blob it points at.
+    '''
+    image_cid = getImageCid(IPFSClient.http_client.get_json(job["ipfsHash"]))
+    if image_cid is not None:
+        IPFSClient.unpin(image_cid)
+    IPFSClient.unpin(job["ipfsHash"])
+
+
+class EnrichmentQueue(object):
+    '''
+    Drain the EnrichmentJobs table with at most `workers` concurrent IPFS requests.
+
+    A failed job is retried with exponential backoff, after max_attempts
+    the row is marked as 'failed'.
+    When a card image is saved, its resized copies are rendered by `derivatives`
+    (a src.utils.derivatives.DerivativePipeline), if any.
+    '''
+
+    fetchers = {
+        PROMPT_JOB: fetchPrompt,
+        IMAGE_JOB: fetchImage,
+        UNPIN_JOB: unpin,
+    }
+
+    def __init__(self, IPFSClient, data: Data, workers=4, max_attempts=10, backoff=1.0, max_backoff=300.0, derivatives=None):
+        self.IPFSClient = IPFSClient
+        self.data = data
+        self.derivatives = derivatives
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrichment")
+        # job id -> (job, future)
+        self.in_flight = {}
+
+    def pump(self):
+        '''
+        Apply the finished fetches and start the due ones.
+        It must be called from the thread that owns `data`.
+        '''
+        if self.derivatives is not None:
+            self.derivatives.pump()
+
+        done = [job_id for job_id, (_, future) in self.in_flight.items() if future.done()]
+        if done:
+            with self.data.unit_of_work():
+                for job_id in done:
+                    job, future = self.in_flight.pop(job_id)
+                    self.complete(job, future)
+
+        free = self.workers - len(self.in_flight)
+        if free <= 0:
+            return
+        for job in self.data.get_due_enrichment_jobs(time.time(), free, exclude=list(self.in_flight)):
+            future = self.executor.submit(self.fetchers[job["kind"]], self.IPFSClient, job)
+            self.in_flight[job["id"]] = (job, future)
+
+    def complete(self, job, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            self.retry(job, e)
+            return
+
+        if job["kind"] == PROMPT_JOB:
+            name, rarity = result
+            Prompt().addIPFSHash(job["objId"], job["ipfsHash"], name, rarity, self.data)
+        elif job["kind"] == IMAGE_JOB:
+            Image().addIPFSHash(job["objId"], job["ipfsHash"], result, self.data)
+            if self.derivatives is not None:
+                self.derivatives.submit(from_int_to_hex_str(job["objId"]))
+        self.data.remove_enrichment_job(job["id"])
+
+    def retry(self, job, error):
+        attempts = job["attempts"] + 1
+        if attempts >= self.max_attempts:
+            logger.error(f"Giving up on enrichment job {job} after {attempts} attempts: {error}")
+            if job["kind"] == PROMPT_JOB:
+                self.data.set_prompt_enrichment(job["objId"], "failed")
+            elif job["kind"] == IMAGE_JOB:
+                self.data.set_image_enrichment(job["objId"], "failed")
+            self.data.remove_enrichment_job(job["id"])
+            return
+
+        delay = min(self.backoff * 2 ** job["attempts"], self.max_backoff)
+        logger.warning(f"Enrichment job {job} failed, retrying in {delay}s: {error}")
+        self.data.retry_enrichment_job(job["id"], time.time() + delay, str(error))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.derivatives is not None:
+            self.derivatives.shutdown()
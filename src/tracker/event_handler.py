@@ -1,26 +1,62 @@
 from .events import *
+from .poller import LogPoller, ChainReorganization
+from ..utils.decoding import LogDecoderRegistry, DecodedLog
+from web3 import Web3
+from itertools import groupby
+import traceback
+
+TRACKER_EVENTS = [
+    "PacketForged",
+    "PacketOpened",
+    "CreateImage",
+    "PromptCreated",
+    "ImageCreated",
+    "DestroyImage",
+    "PromptTransfered",
+    "PacketTransfered",
+    "CardTransfered",
+    "UpdateListPrompt",
+    "UpdateListPacket",
+    "UpdateListImage",
+]
 
 def initTrackerFilters(contract):
     """
         Init the tracker's event filters
     """
     filters = [
-        contract.events.PacketForged.create_filter(fromBlock="latest"),
-        contract.events.PacketOpened.create_filter(fromBlock="latest"),
-        contract.events.CreateImage.create_filter(fromBlock="latest"),
-        contract.events.PromptCreated.create_filter(fromBlock="latest"),
-        contract.events.ImageCreated.create_filter(fromBlock="latest"),
-        contract.events.DestroyImage.create_filter(fromBlock="latest"),
-        contract.events.PromptTransfered.create_filter(fromBlock="latest"),
-        contract.events.PacketTransfered.create_filter(fromBlock="latest"),
-        contract.events.CardTransfered.create_filter(fromBlock="latest"),
-        contract.events.UpdateListPrompt.create_filter(fromBlock="latest"),
-        contract.events.UpdateListPacket.create_filter(fromBlock="latest"),
-        contract.events.UpdateListImage.create_filter(fromBlock="latest"),
+        contract.events[event_name].create_filter(fromBlock="latest")
+        for event_name in TRACKER_EVENTS
     ]
 
     return filters
 
+def initTrackerDecoder(abi):
+    """
+        Build the precompiled decoders of the tracker's events.
+        The handlers lowercase the addresses, so they are not checksummed.
+    """
+    event_classes = {event_name: get_event_class(event_name) for event_name in TRACKER_EVENTS}
+    return LogDecoderRegistry(abi, event_classes, checksum_addresses=False)
+
+def initTrackerPoller(provider, contract, from_block="latest", chunk_size=2000, confirmations=0, last_block_hash=None):
+    """
+        Init a single log poller that fetches all the tracker's events with one eth_getLogs
+    """
+    return [LogPoller(provider, contract, TRACKER_EVENTS, from_block=from_block, chunk_size=chunk_size,
+                      confirmations=confirmations, last_block_hash=last_block_hash, decoder=initTrackerDecoder(contract.abi))]
+
+def getStartBlock(data, start_block, logger):
+    """
+        Return the block after the last checkpoint, or start_block if there is none
+    """
+    checkpoint = data.get_checkpoint()
+    if checkpoint is not None:
+        logger.info(f"Resuming from block {checkpoint + 1}.")
+        return checkpoint + 1
+    logger.info(f"No checkpoint found, starting from block {start_block}.")
+    return start_block
+
 def handle_event(event, provider, contract, IPFSClient, data, logger):
     '''
     New event: AttributeDict({
@@ -36,13 +72,77 @@ def handle_event(event, provider, contract, IPFSClient, data, logger):
                 'blockHash': HexBytes('0x3cc6db0d32783b2bb5de4c97d19d63f7ba72db81e6e4c249256bd45850cb2a93'), 
                 'blockNumber': 13}
                 )
+
+    The logs decoded by the LogPoller's registry (DecodedLog) already carry their event object.
     '''
-    event_name = event.event
-    event_args = event.args
+    if isinstance(event, DecodedLog):
+        event_object = event.handler
+    else:
+        event_name = event.event
+        event_args = event.args
 
-    event_class = get_event_class(event_name)
-    kwargs = dict(event_args)
-    kwargs['event'] = event_name
-    event_object = event_class(**kwargs)
+        event_class = get_event_class(event_name)
+        kwargs = dict(event_args)
+        kwargs['event'] = event_name
+        event_object = event_class(**kwargs)
     event_object.handle(contract, provider, IPFSClient, data)
     event_object.log(logger)
+
+def handleEvents(events, provider, contract, IPFSClient, data, logger):
+    for idx, event in enumerate(events):
+        try:
+            # a failing event leaves no partial writes behind
+            with data.savepoint():
+                # the ledger is written in the same transaction as the event, so replays are a no-op
+                if not data.mark_log_processed(Web3.to_hex(event.transactionHash), event.logIndex, event.blockNumber):
+                    logger.debug(f"Skipping the already applied event {event.event} {Web3.to_hex(event.transactionHash)}:{event.logIndex}")
+                    continue
+                handle_event(event, provider, contract, IPFSClient, data, logger)
+        except Exception as e:
+            logger.warning(f"Error handling event {idx}: {e}\nWhile handling event: {event}")
+            traceback.print_exc()
+
+def applyBlocks(events, poller, provider, contract, IPFSClient, data, cfg, logger):
+    '''
+    Apply the events returned by a LogPoller with one transaction every
+    cfg.blocks_per_transaction blocks. The checkpoint is written in the same
+    transaction, so the effects of each batch of blocks are atomic.
+
+    The changes of every block are recorded in the undo journal, which keeps
+    the last cfg.journal_blocks blocks.
+    '''
+    blocks = [list(block) for _, block in groupby(events, key=lambda event: event.blockNumber)]
+    batches = [blocks[start:start + cfg.blocks_per_transaction] for start in range(0, len(blocks), cfg.blocks_per_transaction)]
+    if not batches:
+        batches = [[]]
+
+    for idx, batch in enumerate(batches):
+        with data.unit_of_work():
+            for block in batch:
+                data.begin_block(block[0].blockNumber, Web3.to_hex(block[0].blockHash))
+                handleEvents(block, provider, contract, IPFSClient, data, logger)
+                data.end_block()
+            if idx == len(batches) - 1:
+                # the poller also covered the blocks without events after the last one
+                data.record_block(poller.last_block, poller.last_block_hash)
+                data.set_checkpoint(poller.last_block)
+                data.prune_journal(poller.last_block - cfg.journal_blocks)
+            else:
+                data.set_checkpoint(batch[-1][0].blockNumber)
+
+REORG_TOO_DEEP = "The chain reorganization is deeper than the undo journal, the database must be rebuilt (resume: false)."
+
+def rollbackReorg(reorg: ChainReorganization, poller, data, logger):
+    """
+        Roll back the orphaned blocks and restart the poller from the newest journaled block still in the chain
+    """
+    for block_number, block_hash in data.get_journaled_blocks():
+        if poller.get_block_hash(block_number) == block_hash:
+            break
+    else:
+        raise RuntimeError(REORG_TOO_DEEP)
+
+    logger.warning(f"{reorg} Rolling back to block {block_number}.")
+    with data.unit_of_work():
+        data.rollback_blocks(block_number)
+    poller.reset(block_number, block_hash)
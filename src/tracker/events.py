@@ -1,14 +1,13 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from abc import abstractmethod, ABC
 import ipfs_api
 from ..db.data import Data, Packet, Image, Prompt
 from typing import List
 from ..db.data import Data
 from ..utils.utils import *
+from .enrichment import PROMPT_JOB, IMAGE_JOB, UNPIN_JOB
 import json
 import ipfs_api
-import numpy as np
-from PIL import Image as Img
 
 PACKET_SIZE = 8
 NUM_PROMPT_TYPES = 6
@@ -28,6 +27,7 @@ NUM_PROMPT_TYPES = 6
 
 @dataclass
 class Event(ABC):
+    __slots__ = ("event",)
     event: str
 
     @abstractmethod
@@ -35,7 +35,7 @@ class Event(ABC):
         pass
 
     def log(self, logger):
-        attributes = "\n".join([f"{k}: {v}" for k, v in self.__dict__.items()])
+        attributes = "\n".join([f"{field.name}: {getattr(self, field.name)}" for field in fields(self)])
         msg = f"""
                 ====================
                 {attributes}
@@ -44,6 +44,7 @@ class Event(ABC):
 
 @dataclass
 class PacketForged(Event):
+    __slots__ = ("blacksmith", "packetId")
     blacksmith: str
     packetId: int
 
@@ -57,6 +58,7 @@ class PacketForged(Event):
 
 @dataclass
 class PacketOpened(Event):
+    __slots__ = ("opener", "prompts")
     opener: str
     prompts: List[int]
 
@@ -68,31 +70,34 @@ class PacketOpened(Event):
         packet_id = getPackedIdFromPromptId(prompt)
         data.remove_packet_from(packet_id=packet_id, user_id=self.opener)
 
+        prompts = []
         for prompt in self.prompts:
             p = Prompt()
             p.initWithParams(id = prompt, 
-                             userIdHex = self.opener, 
-                             data = data)
+                             userIdHex = self.opener)
+            prompts.append(p)
+        data.write_prompts(prompts)
 
 @dataclass
 class PromptCreated(Event):
+    __slots__ = ("to", "promptId", "IPFSCid")
     to: str
     promptId: int
     IPFSCid: int
 
     def handle(self, contract, provider, IPFSClient, data: Data):
         '''
-        Add the IPFS hash to the prompt in the database and the "name" of the prompt
+        Add the IPFS hash to the prompt in the database.
+        The "name" and the rarity of the prompt are fetched by the enrichment queue.
         '''
         prompt = Prompt()
         promptCid = int256ToCid(self.IPFSCid)
-        prompt_json = json.loads(IPFSClient.http_client.cat(promptCid).decode("utf-8"))
-        name = prompt_json['name']
-        rarity = prompt_json['rarity']
-        prompt.addIPFSHash(self.promptId, promptCid, name, rarity, data)
+        prompt.setIPFSHash(self.promptId, promptCid, data)
+        data.add_enrichment_job(PROMPT_JOB, self.promptId, promptCid)
 
 @dataclass
 class CreateImage(Event):
+    __slots__ = ("creator", "cardId")
     creator: str
     cardId: int
 
@@ -108,6 +113,7 @@ class CreateImage(Event):
 
 @dataclass
 class ImageCreated(Event):
+    __slots__ = ("creator", "imageId", "IPFSCid")
     creator: str
     imageId: int
     IPFSCid: int
@@ -115,23 +121,17 @@ class ImageCreated(Event):
     def handle(self, contract, provider, IPFSClient, data: Data):
         '''
         address indexed creator, uint256 prompts
+
+        The image and its prompts are fetched by the enrichment queue.
         '''
         image = Image()
         imageCid = int256ToCid(self.IPFSCid)
-        
-        # IPFSClient.download(imageCid, path=f"ipfs/image/{from_int_to_hex_str(self.imageId)}.png")
-        ipfs_data = IPFSClient.http_client.get_json(imageCid)
-
-        card_image = Img.fromarray(np.array(json.loads(ipfs_data["image"]), dtype='uint8'))
-
-        card_image.save(f"ipfs/image/{from_int_to_hex_str(self.imageId)}.png")
-        
-        prompts = ipfs_data["prompts"]
-
-        image.addIPFSHash(self.imageId, imageCid, prompts, data)
+        image.setIPFSHash(self.imageId, imageCid, data)
+        data.add_enrichment_job(IMAGE_JOB, self.imageId, imageCid)
 
 @dataclass
 class DestroyImage(Event):
+    __slots__ = ("imageId", "userId")
     imageId: int
     userId: str
 
@@ -142,12 +142,14 @@ class DestroyImage(Event):
         # delete the image from the db
         image = data.get_image(self.imageId)
         image.unfreezePrompts(data)
-        IPFSClient.unpin(image.hash)
+        if image.hash:
+            data.add_enrichment_job(UNPIN_JOB, self.imageId, image.hash)
         image.deleteFromDb(data)
 
 
 @dataclass
 class TransferEvent(Event):
+    __slots__ = ("buyer", "seller", "id", "value")
     buyer: str
     seller: str
     id: int
@@ -155,12 +157,14 @@ class TransferEvent(Event):
 
 @dataclass
 class PacketTransfered(TransferEvent):
+    __slots__ = ()
 
     def handle(self, contract, provider, IPFSClient, data: Data):
         data.transfer_packet(self.id, self.seller, self.buyer, self.value)
 
 @dataclass
 class PromptTransfered(TransferEvent):
+    __slots__ = ()
 
     def handle(self, contract, provider, IPFSClient, data: Data):
         data.transfer_prompt(self.id, self.seller, self.buyer, self.value)
@@ -168,6 +172,7 @@ class PromptTransfered(TransferEvent):
 
 @dataclass
 class CardTransfered(TransferEvent):
+    __slots__ = ()
 
     def handle(self, contract, provider, IPFSClient, data: Data):
         data.transfer_image(self.id, self.seller, self.buyer, self.value)
@@ -175,6 +180,7 @@ class CardTransfered(TransferEvent):
 
 @dataclass 
 class UpdateNFT(Event):
+    __slots__ = ("id", "isListed", "price", "tokenOwner")
     id: int
     isListed: bool
     price: int
@@ -182,6 +188,7 @@ class UpdateNFT(Event):
 
 @dataclass
 class UpdateListPrompt(UpdateNFT):
+    __slots__ = ()
     def handle(self, contract, provider, IPFSClient, data: Data):
         if self.isListed:
             data.list_prompt(prompt_id=self.id, price=self.price, token_owner=self.tokenOwner.lower())
@@ -190,6 +197,7 @@ class UpdateListPrompt(UpdateNFT):
 
 @dataclass
 class UpdateListPacket(UpdateNFT):
+    __slots__ = ()
     def handle(self, contract, provider, IPFSClient, data: Data):
         if self.isListed:
             data.list_packet(self.id, self.price, token_owner=self.tokenOwner.lower())
@@ -198,6 +206,7 @@ class UpdateListPacket(UpdateNFT):
 
 @dataclass
 class UpdateListImage(UpdateNFT):
+    __slots__ = ()
     def handle(self, contract, provider, IPFSClient, data: Data):
         if self.isListed:
             data.list_image(self.id, self.price, token_owner=self.tokenOwner.lower())
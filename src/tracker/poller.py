@@ -0,0 +1,176 @@
+'''
+Batched log poller for the tracker.
+
+Instead of polling one filter per event type, the poller fetches the logs of
+every tracked event with a single eth_getLogs call filtered by contract address
+and topic set, and returns them in chain order.
+'''
+
+from eth_utils import event_abi_to_log_topic
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+
+class ChainReorganization(Exception):
+    '''
+    The last block returned by the poller is no longer part of the canonical chain.
+    '''
+
+    def __init__(self, block_number: int):
+        super().__init__(f"Block {block_number} was orphaned by a chain reorganization.")
+        self.block_number = block_number
+
+
+class LogPoller(object):
+    '''
+    Poll the logs of a set of contract events with one eth_getLogs per block range.
+
+    It exposes the same `get_new_entries` method as a web3 filter, so the
+    tracker loop can use it in place of the per-event filters.
+    When it is behind the chain head it catches up in ranges of at most
+    `chunk_size` blocks, and `last_block` is the last block covered by the
+    latest batch.
+
+    Only the blocks with at least `confirmations` blocks on top of them are
+    fetched. If the block before a new range is not the last one returned,
+    get_new_entries raises ChainReorganization.
+
+    With a `decoder` (src.utils.decoding.LogDecoderRegistry) the logs are
+    decoded with the precompiled decoders into DecodedLog entries instead of
+    going through web3's process_log.
+    '''
+
+    def __init__(self, provider, contract, event_names, from_block="latest", chunk_size=2000, confirmations=0, last_block_hash=None, decoder=None):
+        self.provider = provider
+        self.contract = contract
+        self.decoder = decoder
+        self.events = {}
+        for event_name in event_names:
+            event = contract.events[event_name]()
+            self.events[event_abi_to_log_topic(event.abi)] = event
+        self.topics = [Web3.to_hex(topic) for topic in self.events]
+
+        if from_block == "latest":
+            from_block = provider.eth.block_number + 1
+        self.next_block = from_block
+        self.chunk_size = chunk_size
+        self.last_block = from_block - 1
+        self.last_block_hash = last_block_hash
+        self.confirmations = confirmations
+        self.caught_up = False
+
+    def log_filter(self, from_block: int, to_block: int):
+        '''
+        Parameters of the eth_getLogs call for a block range.
+        '''
+        return {
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "address": self.contract.address,
+            "topics": [self.topics],
+        }
+
+    def get_logs(self, from_block: int, to_block: int):
+        '''
+        Fetch and decode the tracked events between from_block and to_block (inclusive).
+
+        The events are returned sorted by (blockNumber, logIndex).
+        '''
+        logs = self.provider.eth.get_logs(self.log_filter(from_block, to_block))
+        return self.decode_all(logs)
+
+    def decode_all(self, logs):
+        events = [self.decode(log) for log in logs]
+        events.sort(key=lambda event: (event.blockNumber, event.logIndex))
+        return events
+
+    def decode(self, log):
+        '''
+        Decode a raw log with the ABI of the event that emitted it.
+
+        The result has the same shape as the entries returned by a web3 filter.
+        '''
+        if self.decoder is not None:
+            return self.decoder.decode(log)
+        topic = bytes(log["topics"][0])
+        return AttributeDict.recursive(self.events[topic].process_log(log))
+
+    def next_range(self, head: int):
+        '''
+        Return the next block range to fetch, or None if the poller is at the head.
+        '''
+        head -= self.confirmations
+        if head < self.next_block:
+            self.caught_up = True
+            return None
+        return self.next_block, min(head, self.next_block + self.chunk_size - 1)
+
+    def check_parent(self, first_block):
+        '''
+        Raise ChainReorganization if the first block of the range does not follow the last one returned.
+        '''
+        if self.last_block_hash is not None and Web3.to_hex(first_block["parentHash"]) != self.last_block_hash:
+            raise ChainReorganization(self.last_block)
+
+    def advance(self, to_block, head: int):
+        self.last_block = to_block["number"]
+        self.last_block_hash = Web3.to_hex(to_block["hash"])
+        self.next_block = self.last_block + 1
+        self.caught_up = self.last_block == head - self.confirmations
+
+    def reset(self, block_number: int, block_hash: str):
+        '''
+        Continue after block_number, e.g. after the orphaned blocks have been rolled back.
+        '''
+        self.last_block = block_number
+        self.last_block_hash = block_hash
+        self.next_block = block_number + 1
+        self.caught_up = False
+
+    def get_block_hash(self, block_number: int):
+        return Web3.to_hex(self.provider.eth.get_block(block_number)["hash"])
+
+    def get_new_entries(self):
+        '''
+        Return the events emitted since the last call, up to chunk_size blocks at a time.
+        '''
+        head = self.provider.eth.block_number
+        block_range = self.next_range(head)
+        if block_range is None:
+            return []
+        from_block, to_block = block_range
+        first_block = self.provider.eth.get_block(from_block)
+        self.check_parent(first_block)
+        # the last block is read before the logs: if the chain reorganizes in between, the next call detects it
+        last_block = first_block if to_block == from_block else self.provider.eth.get_block(to_block)
+        events = self.get_logs(from_block, to_block)
+        self.advance(last_block, head)
+        return events
+
+
+class AsyncLogPoller(LogPoller):
+    '''
+    LogPoller for an AsyncWeb3 provider.
+
+    from_block must be a block number, "latest" can not be resolved in the constructor.
+    '''
+
+    async def get_logs(self, from_block: int, to_block: int):
+        logs = await self.provider.eth.get_logs(self.log_filter(from_block, to_block))
+        return self.decode_all(logs)
+
+    async def get_block_hash(self, block_number: int):
+        return Web3.to_hex((await self.provider.eth.get_block(block_number))["hash"])
+
+    async def get_new_entries(self):
+        head = await self.provider.eth.block_number
+        block_range = self.next_range(head)
+        if block_range is None:
+            return []
+        from_block, to_block = block_range
+        first_block = await self.provider.eth.get_block(from_block)
+        self.check_parent(first_block)
+        last_block = first_block if to_block == from_block else await self.provider.eth.get_block(to_block)
+        events = await self.get_logs(from_block, to_block)
+        self.advance(last_block, head)
+        return events
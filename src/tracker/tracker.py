@@ -4,7 +4,11 @@ import asyncio
 import logging
 import time
 import json
-from .event_handler import handle_event, initTrackerFilters
+from .event_handler import handleEvents, applyBlocks, rollbackReorg, getStartBlock, initTrackerFilters, initTrackerPoller
+from .poller import LogPoller, ChainReorganization
+from .enrichment import EnrichmentQueue
+from ..utils.derivatives import DerivativePipeline
+from . import async_tracker
 import ipfs_api
 import os
 import multiaddr
@@ -55,26 +59,61 @@ def getABI():
 
 def initContract(contract_cfg, provider):
     ABI = getABI()
+    address = provider.to_checksum_address(contract_cfg.contract_address)
     contract = provider.eth.contract(
-        # address = contract_cfg.contract_address,
+        address = address,
         abi = ABI
     )
     return contract
 
-def initData(contract, filters):
-    return Data(create_db=True)
+def initData(cfg):
+    # keep the database when resuming, so that the tracker continues from its checkpoint
+    data: Data = hydra.utils.instantiate(cfg.db, create_db=True, wipe_db=not cfg.resume)
+    return data
 
+def initFilters(provider, contract, data, cfg):
+    if cfg.poller != "logs":
+        return initTrackerFilters(contract)
 
-def loop(provider, contract, filters, IPFSClient, data, cfg):
+    from_block = getStartBlock(data, cfg.start_block, logger)
+    return initTrackerPoller(provider, contract, from_block=from_block, chunk_size=cfg.chunk_size,
+                             confirmations=cfg.confirmations, last_block_hash=data.get_block_hash(from_block - 1))
+
+
+def initDerivatives(images_cfg):
+    if images_cfg.workers <= 0:
+        return None
+    return DerivativePipeline(images_cfg.directory, images_cfg.workers, images_cfg.sizes, images_cfg.formats)
+
+def initEnrichment(IPFSClient, data, cfg):
+    return EnrichmentQueue(IPFSClient, data, derivatives=initDerivatives(cfg.images), **cfg.enrichment)
+
+
+def loop(provider, contract, filters, IPFSClient, data, enricher, cfg):
+    # the block before the first one to read: nothing is recorded until the poller moves past it
+    checkpoint = next((filter.last_block for filter in filters if isinstance(filter, LogPoller)), None)
     while True:
+        caught_up = True
         for filter in filters:
-            for idx, event in enumerate(filter.get_new_entries()):
-                try:
-                    handle_event(event, provider, contract, IPFSClient, data, logger)
-                except Exception as e:
-                    logger.warning(f"Error handling event {idx}: {e}\nWhile handling event: {event}")
-                    traceback.print_exc()
-        time.sleep(cfg.poll_interval)
+            try:
+                events = filter.get_new_entries()
+            except ChainReorganization as reorg:
+                rollbackReorg(reorg, filter, data, logger)
+                checkpoint = filter.last_block
+                caught_up = False
+                continue
+            if isinstance(filter, LogPoller):
+                if events or filter.last_block != checkpoint:
+                    applyBlocks(events, filter, provider, contract, IPFSClient, data, cfg, logger)
+                    checkpoint = filter.last_block
+                caught_up = caught_up and filter.caught_up
+            else:
+                handleEvents(events, provider, contract, IPFSClient, data, logger)
+        # the IPFS metadata is fetched in the background
+        enricher.pump()
+        # do not wait while backfilling
+        if caught_up:
+            time.sleep(cfg.poll_interval)
 
 
 @hydra.main(config_path="../../conf", config_name="tracker_config")
@@ -82,16 +121,22 @@ def main(cfg):
     # connect to IPFS
     IPFSClient = instantiateIPFS(cfg.ipfs)
 
+    data = initData(cfg)
+
+    enricher = initEnrichment(IPFSClient, data, cfg)
+
+    if cfg.mode == "async":
+        asyncio.run(async_tracker.run(IPFSClient, data, enricher, getABI(), cfg))
+        return
+
     # Create web3 connection
     provider = instantiateProvider(cfg.provider)
 
     contract = initContract(cfg.contract, provider)
 
-    filters = initTrackerFilters(contract)
-
-    data = initData(contract, filters)
+    filters = initFilters(provider, contract, data, cfg)
 
-    loop(provider, contract, filters, IPFSClient, data, cfg)
+    loop(provider, contract, filters, IPFSClient, data, enricher, cfg)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,55 @@
+'''
+Local computation of the CIDv0 that IPFS gives to some content.
+
+`ipfs add` (with its defaults: CIDv0, 256 KiB chunks, no raw leaves) stores
+content of up to one chunk as a single UnixFS file node encoded as dag-pb.
+The CID is the base58 sha256 multihash of that node, the format expected by
+cidToInt256, so the oracle can publish a CID before the upload ends.
+Larger content is split in a tree of nodes whose exact layout is not
+reproduced here: its CID must be taken from the node.
+'''
+
+import hashlib
+import base58
+
+CHUNK_SIZE = 262144
+# UnixFS Data.DataType
+UNIXFS_FILE = 2
+
+
+def encodeVarint(value: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+def encodeField(number: int, value) -> bytes:
+    '''
+    Protobuf field: varint for int values, length delimited for bytes.
+    '''
+    if isinstance(value, int):
+        return encodeVarint(number << 3) + encodeVarint(value)
+    return encodeVarint(number << 3 | 2) + encodeVarint(len(value)) + value
+
+def multihash(block: bytes) -> bytes:
+    return b"\x12\x20" + hashlib.sha256(block).digest()
+
+
+def computeCid(content: bytes, chunk_size: int = CHUNK_SIZE) -> str:
+    '''
+    Return the CIDv0 of content, as returned by add_bytes.
+    Only content that fits in one chunk is supported: raise ValueError for larger content.
+    '''
+    if len(content) > chunk_size:
+        raise ValueError(f"{len(content)} bytes do not fit in one chunk of {chunk_size} bytes.")
+    data = encodeField(1, UNIXFS_FILE)
+    if content:
+        data += encodeField(2, content)
+    data += encodeField(3, len(content))
+    block = encodeField(1, data)
+    return base58.b58encode(multihash(block)).decode("utf-8")
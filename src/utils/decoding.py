@@ -0,0 +1,175 @@
+'''
+Precompiled decoding of raw contract logs.
+
+The registry is built once from the contract ABI. It maps the topic0 of every
+event to an EventDecoder, which turns a raw log into the handler object of the
+event (tracker or oracle dataclass) without going through web3's generic
+decoding, AttributeDicts and the reflection of get_event_class.
+'''
+
+from eth_abi.decoding import ContextFramesBytesIO
+from eth_abi.registry import registry
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+
+
+def decodeUint(word: bytes):
+    return int.from_bytes(word, "big")
+
+def decodeInt(word: bytes):
+    return int.from_bytes(word, "big", signed=True)
+
+def decodeBool(word: bytes):
+    return word != b"\x00" * 32
+
+def decodeAddress(word: bytes):
+    return "0x" + word[12:].hex()
+
+def decodeChecksumAddress(word: bytes):
+    return to_checksum_address(word[12:])
+
+def toList(value):
+    '''
+    eth_abi returns the arrays as tuples, web3's entries as lists.
+    '''
+    if isinstance(value, tuple):
+        return [toList(item) for item in value]
+    return value
+
+def wordDecoder(abi_type: str, checksum_addresses: bool):
+    '''
+    Return a function that decodes a static type from its 32 bytes word, or None.
+    '''
+    if "[" in abi_type or "(" in abi_type:
+        return None
+    if abi_type.startswith("uint"):
+        return decodeUint
+    if abi_type.startswith("int"):
+        return decodeInt
+    if abi_type == "bool":
+        return decodeBool
+    if abi_type == "address":
+        return decodeChecksumAddress if checksum_addresses else decodeAddress
+    if abi_type.startswith("bytes") and abi_type != "bytes":
+        size = int(abi_type[5:])
+        return lambda word: word[:size]
+    return None
+
+
+class DecodedLog(object):
+    '''
+    A raw log decoded into the handler object of its event.
+
+    It has the attributes of the web3 entries used by the tracker and the oracle
+    (event, args, blockNumber, logIndex, transactionHash, blockHash).
+    '''
+    __slots__ = ("event", "handler", "blockNumber", "logIndex", "transactionHash", "blockHash")
+
+    def __init__(self, event, handler, blockNumber, logIndex, transactionHash, blockHash):
+        self.event = event
+        self.handler = handler
+        self.blockNumber = blockNumber
+        self.logIndex = logIndex
+        self.transactionHash = transactionHash
+        self.blockHash = blockHash
+
+    @property
+    def args(self):
+        return {name: getattr(self.handler, name) for name in self.handler.__dataclass_fields__ if name != "event"}
+
+    def __repr__(self):
+        return f"DecodedLog({self.event}, {self.args}, blockNumber={self.blockNumber}, logIndex={self.logIndex})"
+
+
+class EventDecoder(object):
+    '''
+    Decoder of one event, compiled from its ABI.
+    '''
+    __slots__ = ("name", "topic", "event_class", "indexed", "names", "data_words", "data_decoder")
+
+    def __init__(self, event_abi, event_class, checksum_addresses=True):
+        self.name = event_abi["name"]
+        self.topic = bytes(event_abi_to_log_topic(event_abi))
+        self.event_class = event_class
+
+        # (position of the topic, decoder) of the indexed arguments, in ABI order
+        self.indexed = []
+        data_types = []
+        self.names = []
+        indexed_names = []
+        for abi_input in event_abi["inputs"]:
+            if abi_input["indexed"]:
+                decoder = wordDecoder(abi_input["type"], checksum_addresses)
+                if decoder is None:
+                    # dynamic indexed arguments are only available as their hash
+                    decoder = bytes
+                self.indexed.append((len(self.indexed) + 1, decoder))
+                indexed_names.append(abi_input["name"])
+            else:
+                data_types.append(abi_input["type"])
+        self.names = indexed_names + [abi_input["name"] for abi_input in event_abi["inputs"] if not abi_input["indexed"]]
+
+        # only static types: every argument is one word of the data
+        self.data_words = [wordDecoder(abi_type, checksum_addresses) for abi_type in data_types]
+        self.data_decoder = None
+        if None in self.data_words:
+            self.data_words = None
+            self.data_decoder = registry.get_decoder("(" + ",".join(data_types) + ")")
+            if checksum_addresses:
+                # eth_abi returns lowercase addresses
+                self.data_decoder = ChecksumTupleDecoder(self.data_decoder, data_types)
+
+    def decode_args(self, topics, data: bytes):
+        values = [decoder(bytes(topics[position])) for position, decoder in self.indexed]
+        if self.data_words is not None:
+            values.extend(decoder(data[32 * idx:32 * idx + 32]) for idx, decoder in enumerate(self.data_words))
+        else:
+            values.extend(toList(value) for value in self.data_decoder(ContextFramesBytesIO(data)))
+        return values
+
+    def decode(self, log):
+        topics = log["topics"]
+        values = self.decode_args(topics, bytes(log["data"]))
+        handler = self.event_class(self.name, **dict(zip(self.names, values)))
+        return DecodedLog(self.name, handler, log["blockNumber"], log["logIndex"], log["transactionHash"], log["blockHash"])
+
+
+class ChecksumTupleDecoder(object):
+    '''
+    Checksum the addresses returned by an eth_abi TupleDecoder.
+    '''
+    __slots__ = ("decoder", "addresses")
+
+    def __init__(self, decoder, data_types):
+        self.decoder = decoder
+        self.addresses = [idx for idx, abi_type in enumerate(data_types) if abi_type == "address"]
+
+    def __call__(self, stream):
+        values = list(self.decoder(stream))
+        for idx in self.addresses:
+            values[idx] = to_checksum_address(values[idx])
+        return values
+
+
+class LogDecoderRegistry(object):
+    '''
+    Map the topic0 of the events in `event_classes` to their precompiled decoder.
+
+    event_classes: event name -> handler class, constructed as cls(event_name, **args).
+    checksum_addresses: return the addresses checksummed like web3 does; the
+    tracker lowercases them anyway and can skip the cost.
+    '''
+
+    def __init__(self, abi, event_classes, checksum_addresses=True):
+        self.decoders = {}
+        for entry in abi:
+            if entry.get("type") != "event" or entry.get("anonymous") or entry["name"] not in event_classes:
+                continue
+            decoder = EventDecoder(entry, event_classes[entry["name"]], checksum_addresses)
+            self.decoders[decoder.topic] = decoder
+
+    @property
+    def topics(self):
+        return list(self.decoders)
+
+    def decode(self, log):
+        return self.decoders[bytes(log["topics"][0])].decode(log)
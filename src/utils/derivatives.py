@@ -0,0 +1,107 @@
+'''
+Resized and re-encoded copies of the card images.
+
+The tracker saves the full-size PNG of every card in ipfs/image/{id}.png. The
+DerivativePipeline renders, in a pool of processes, one file per configured
+size and format in ipfs/image/{size}/{id}.{format}, which the web api serves
+to the clients that ask for a smaller image (see conf/images/derivatives.yaml).
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+ORIGINAL = "original"
+
+# encoder options, the derivatives are lossy except for PNG
+SAVE_OPTIONS = {
+    "avif": {"format": "AVIF", "quality": 60},
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "png": {"format": "PNG", "optimize": True},
+}
+
+MIME_TYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+
+def availableFormats(formats):
+    '''
+    Keep the formats that this Pillow build can encode, in the same order.
+    '''
+    return [image_format for image_format in formats if image_format == "png" or features.check(image_format)]
+
+def originalPath(directory: str, card_hex: str) -> str:
+    return os.path.join(directory, card_hex + ".png")
+
+def derivativePath(directory: str, card_hex: str, size: str, image_format: str) -> str:
+    '''
+    Path of a derivative. The original PNG is the file saved by the tracker.
+    '''
+    if size == ORIGINAL and image_format == "png":
+        return originalPath(directory, card_hex)
+    return os.path.join(directory, size, f"{card_hex}.{image_format}")
+
+def renderDerivatives(directory: str, card_hex: str, sizes: dict, formats: list):
+    '''
+    Render the derivatives of a card. It runs in the worker processes.
+
+    sizes: size name -> longest side in pixels, None to keep the original size.
+    The files are written to a temporary name and then renamed, so the web api
+    never serves a partial file.
+    '''
+    with Image.open(originalPath(directory, card_hex)) as original:
+        original.load()
+        for size, side in sizes.items():
+            image = original
+            if side is not None:
+                image = original.copy()
+                image.thumbnail((side, side), Image.LANCZOS)
+            for image_format in formats:
+                if size == ORIGINAL and image_format == "png":
+                    continue
+                path = derivativePath(directory, card_hex, size, image_format)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.tmp"
+                image.save(tmp_path, **SAVE_OPTIONS[image_format])
+                os.replace(tmp_path, path)
+    return card_hex
+
+
+class DerivativePipeline(object):
+    '''
+    Render the derivatives of the cards in a pool of `workers` processes.
+
+    submit() returns immediately; pump() logs the finished renders and must be
+    called periodically by the owner (the enrichment queue).
+    '''
+
+    def __init__(self, directory="ipfs/image", workers=2, sizes=None, formats=("webp", "png")):
+        self.directory = directory
+        self.workers = workers
+        self.sizes = dict(sizes or {ORIGINAL: None})
+        self.formats = availableFormats(formats)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        # card hex -> future
+        self.in_flight = {}
+
+    def submit(self, card_hex: str):
+        self.in_flight[card_hex] = self.executor.submit(renderDerivatives, self.directory, card_hex, self.sizes, self.formats)
+
+    def pump(self):
+        done = [card_hex for card_hex, future in self.in_flight.items() if future.done()]
+        for card_hex in done:
+            future = self.in_flight.pop(card_hex)
+            try:
+                future.result()
+            except Exception as e:
+                # the web api falls back to the original image
+                logger.warning(f"Could not render the derivatives of card {card_hex}: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
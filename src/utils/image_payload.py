@@ -0,0 +1,85 @@
+'''
+Format of the card images published on IPFS.
+
+The oracle uploads the image as a compressed binary blob (lossless WebP, or PNG
+when Pillow has no WebP support) and a small JSON manifest that points at it:
+
+    {
+        "version": 1,
+        "image": {"cid": "Qm...", "format": "webp", "width": 512, "height": 512},
+        "prompts": "character: ... style: ..."
+    }
+
+The cid of the manifest is the one published on the blockchain. Cards created
+before this format have the pixels in the manifest itself, as a JSON encoded
+list in "image".
+'''
+
+import io
+import json
+import numpy as np
+from PIL import Image, features
+
+MANIFEST_VERSION = 1
+
+
+def preferredImageFormat() -> str:
+    return "webp" if features.check("webp") else "png"
+
+def encodeImage(image: Image.Image, image_format: str = None) -> (bytes, str):
+    '''
+    Encode an image losslessly, return the bytes and the format.
+    '''
+    image_format = image_format or preferredImageFormat()
+    buffer = io.BytesIO()
+    if image_format == "webp":
+        image.save(buffer, format="WEBP", lossless=True, method=4)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue(), image_format
+
+def buildManifest(image_cid: str, image_format: str, image: Image.Image, prompts: str) -> dict:
+    return {
+        "version": MANIFEST_VERSION,
+        "image": {
+            "cid": image_cid,
+            "format": image_format,
+            "width": image.width,
+            "height": image.height,
+        },
+        "prompts": prompts,
+    }
+
+def encodeManifest(manifest: dict) -> bytes:
+    '''
+    The bytes of the manifest as add_json uploads them, to compute its cid locally.
+    '''
+    return json.dumps(manifest, sort_keys=True, indent=None, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def isLegacyManifest(manifest: dict) -> bool:
+    return not isinstance(manifest["image"], dict)
+
+def getImageCid(manifest: dict):
+    '''
+    Return the cid of the image blob, or None for the legacy format.
+    '''
+    if isLegacyManifest(manifest):
+        return None
+    return manifest["image"]["cid"]
+
+def saveManifestImage(http_client, manifest: dict, path: str):
+    '''
+    Save the image of a manifest (new or legacy format) as a PNG file.
+    A PNG blob is written as it is, without decoding it.
+    '''
+    if isLegacyManifest(manifest):
+        Image.fromarray(np.array(json.loads(manifest["image"]), dtype='uint8')).save(path)
+        return
+
+    blob = http_client.cat(manifest["image"]["cid"])
+    if manifest["image"]["format"] == "png":
+        with open(path, "wb") as f:
+            f.write(blob)
+    else:
+        with Image.open(io.BytesIO(blob)) as image:
+            image.save(path, format="PNG")
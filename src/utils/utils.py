@@ -28,6 +28,37 @@ def from_str_hex_to_int(hex_string: str):
     '''
     return int(hex_string, 16)
 
+def from_int_to_uint256(integer: int):
+    '''
+    Convert an uint256 to its value in the database: an INTEGER if it fits in a signed 64 bit integer,
+    else its 32 bytes big endian encoding as a BLOB.
+    SQLite orders every INTEGER before every BLOB and compares the BLOBs with memcmp, so the
+    values are ordered like the integers, in indexes, ORDER BY and range queries.
+    '''
+    if integer < 2 ** 63:
+        return integer
+    return integer.to_bytes(32, "big")
+
+def from_uint256_to_int(value):
+    '''
+    Convert a value written by from_int_to_uint256 back to an integer.
+    '''
+    if isinstance(value, bytes):
+        return int.from_bytes(value, "big")
+    return value
+
+def from_id_to_int(token_id):
+    '''
+    Convert the id of a token, an integer or a hex string as returned by the API, to an integer.
+    Return None if it is not a valid id.
+    '''
+    if isinstance(token_id, int):
+        return token_id
+    try:
+        return from_str_hex_to_int(token_id)
+    except (TypeError, ValueError):
+        return None
+
 
 def getInfoFromPacketId(packet_id: int) -> (int, int):
     '''
@@ -7,8 +7,10 @@ Check src/web_api/docs/openapi.yaml for the documentation.
 import os
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from src.db.data import Data, Image
+from fastapi.responses import FileResponse, JSONResponse
+from src.db.data import Image
+from src.db.async_data import AsyncData
+from src.utils.derivatives import ORIGINAL, MIME_TYPES, derivativePath
 from hydra.utils import instantiate
 from hydra import initialize, compose
 from omegaconf import OmegaConf
@@ -18,7 +20,13 @@ with initialize(version_base=None, config_path="../../conf", job_name="web_api")
     cfg = compose(config_name="webapi_config")
     print(OmegaConf.to_yaml(cfg))
 
-database: Data = instantiate(cfg.db)
+# the queries run in threads, not on the event loop
+database = AsyncData(instantiate(cfg.db), readers=cfg.db_readers)
+# the endpoints return the rows, plain dicts and lists, as a JSONResponse:
+# FastAPI's jsonable_encoder would walk them again on the event loop
+
+# cursor of the next page of /packets/, /prompts/ and /cards/, absent on the last page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
 
 app = FastAPI()
 app.add_middleware(
@@ -27,53 +35,75 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 
 @app.middleware("http")
 async def set_response_content_type(request: Request, call_next):
     response = await call_next(request)
-    response.headers["Content-Type"] = "application/json"
+    # the card images keep their own content type
+    if not response.headers.get("Content-Type", "").startswith("image/"):
+        response.headers["Content-Type"] = "application/json"
     return response
 
 
 
+async def list_page(get_all, limit: int, **filters):
+    '''
+    Return a page of the listed rows of a get_all_* method of the database, with the cursor of the next page.
+    '''
+    if limit is None:
+        limit = cfg.pagination.page_size
+    if not 0 < limit <= cfg.pagination.max_page_size:
+        raise HTTPException(400, detail=f'limit should be between 1 and {cfg.pagination.max_page_size}')
+    try:
+        rows, next_cursor = await get_all(only_listed=True, limit=limit, **filters)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    return JSONResponse(rows, headers={NEXT_CURSOR_HEADER: next_cursor} if next_cursor is not None else None)
+
+
 @app.get('/user/{publicKey}')
 async def get_user(publicKey: str):
     '''
     Get all the data of an user.
     '''
-    packet, prompt, card, trans = database.get_user(publicKey)
+    packet, prompt, card, trans = await database.get_user(publicKey)
     dataj = {'packets': packet, 'prompts': prompt, 'cards': card, 'transactions': trans}
-    return dataj
+    return JSONResponse(dataj)
 
 @app.get("/packet/{packetid}")
 async def get_packet(packetid: str, r: Request):
     '''
     Get all the data of a packet.
     '''
-    packet = database.get_packet(packetid, as_json=True)
+    packet = await database.get_packet(packetid, as_json=True)
     if packet is None:
         raise HTTPException(404, detail='packet not found')
-    return packet
+    return JSONResponse(packet)
 
 @app.get("/packet/{packetid}/transactions")
 async def get_packet_transactions(packetid: str, r: Request):
     '''
     Get all the transactions of a packet.
     '''
-    trans  = database.get_token_transfer_events(packetid)
+    trans  = await database.get_token_transfer_events(packetid)
     if trans is None:
         raise HTTPException(404, detail='packet transactions not found')
-    return trans
+    return JSONResponse(trans)
 
 @app.get("/packets/")
-async def get_packets(r: Request):
+async def get_packets(r: Request, collectionId: int = None, owner: str = None, minPrice: int = None, maxPrice: int = None,
+                      sort: str = "-created", limit: int = None, cursor: str = None):
     '''
-    Get all the packets.
+    Get a page of the listed packets.
+
+    sort: created or price, descending with a "-" prefix.
+    cursor: the X-Next-Cursor header of the previous page.
     '''
-    packets = database.get_all_packets(only_listed=True)
-    return packets
+    return await list_page(database.get_all_packets, limit, collection_id=collectionId, owner=owner,
+                           min_price=minPrice, max_price=maxPrice, sort=sort, cursor=cursor)
 
 
 
@@ -82,28 +112,34 @@ async def get_prompt(promptid: str, r: Request):
     '''
     Get all the data of a prompt.
     '''
-    prompt = database.get_prompt(promptid, as_json=True)
+    prompt = await database.get_prompt(promptid, as_json=True)
     if prompt is None:
         raise HTTPException(404, detail='prompt not found')
-    return prompt
+    return JSONResponse(prompt)
 
 @app.get("/prompt/{promptid}/transactions")
 async def get_prompt_transactions(promptid: str, r: Request):
     '''
     Get all the transactions of a prompt.
     '''
-    prompt = database.get_token_transfer_events(promptid)
+    prompt = await database.get_token_transfer_events(promptid)
     if prompt is None:
         raise HTTPException(404, detail='prompt not found')
-    return prompt
+    return JSONResponse(prompt)
 
 @app.get("/prompts/")
-async def get_prompts(r: Request):
+async def get_prompts(r: Request, collectionId: int = None, owner: str = None, minPrice: int = None, maxPrice: int = None,
+                      category: int = None, minRarity: float = None, maxRarity: float = None,
+                      sort: str = "-created", limit: int = None, cursor: str = None):
     '''
-    Get all the prompts.
+    Get a page of the listed prompts.
+
+    sort: created, price or rarity, descending with a "-" prefix.
+    cursor: the X-Next-Cursor header of the previous page.
     '''
-    prompts = database.get_all_prompts(only_listed=True)
-    return prompts
+    return await list_page(database.get_all_prompts, limit, collection_id=collectionId, owner=owner,
+                           min_price=minPrice, max_price=maxPrice, category=category,
+                           min_rarity=minRarity, max_rarity=maxRarity, sort=sort, cursor=cursor)
 
 def extract_card_info(card: Image):
     '''
@@ -121,46 +157,68 @@ async def get_card(cardid: str, r: Request):
     '''
     Get all the data of a card.
     '''
-    card = database.get_image(cardid, as_json=True)
-    return card
+    card = await database.get_image(cardid, as_json=True)
+    return JSONResponse(card)
 
 @app.get("/card/{cardid}/transactions")
 async def get_card_transactions(cardid: str, r: Request):
     '''
     Get all the transactions of a card.
     '''
-    trans = database.get_token_transfer_events(cardid)
+    trans = await database.get_token_transfer_events(cardid)
     if trans is None:
         raise HTTPException(404, detail='trans not found')
-    return trans
+    return JSONResponse(trans)
 
 @app.get("/card/{cardid}/image")
-async def get_card_image(cardid: str, r: Request):
+async def get_card_image(cardid: str, r: Request, size: str = ORIGINAL, format: str = None):
     '''
     Get the image of a card.
+
+    size: one of the sizes in conf/images/derivatives.yaml (e.g. thumbnail, medium, original).
+    format: avif, webp or png. Without it the best format accepted by the client is served.
+    If the requested derivative has not been rendered, the original png is served.
     '''
     # first check if the user is not trying to do something malicious
     # by checking if the cardid is in the right format
     if len(cardid) > 66:
         raise HTTPException(404, detail='card not found - length should be 66')
-    if not re.match(r'[a-z0-9]', cardid):
+    if not re.fullmatch(r'[a-z0-9]+', cardid):
         raise HTTPException(404, detail='card not found - wrong format')
-
-    base_url: str = "ipfs/image/"
-    card_url = os.path.join(base_url, cardid + ".png")
-    print(card_url)
+    if size not in cfg.images.sizes:
+        raise HTTPException(400, detail=f'size should be one of {list(cfg.images.sizes)}')
+    if format is not None and format not in MIME_TYPES:
+        raise HTTPException(400, detail=f'format should be one of {list(MIME_TYPES)}')
+
+    if format is not None:
+        formats = [format]
+    else:
+        accept = r.headers.get("accept", "")
+        formats = [image_format for image_format in cfg.images.formats if MIME_TYPES[image_format] in accept]
+    headers = {"Vary": "Accept"} if format is None else None
+
+    for image_format in formats + ["png"]:
+        card_url = derivativePath(cfg.images.directory, cardid, size, image_format)
+        if os.path.exists(card_url):
+            return FileResponse(card_url, media_type=MIME_TYPES[image_format], headers=headers)
+
+    card_url = derivativePath(cfg.images.directory, cardid, ORIGINAL, "png")
     if os.path.exists(card_url):
-        return FileResponse(card_url)
+        return FileResponse(card_url, media_type=MIME_TYPES["png"], headers=headers)
     raise HTTPException(404, detail='card not found')
 
 
 @app.get("/cards/")
-async def get_cards(r: Request):
+async def get_cards(r: Request, collectionId: int = None, owner: str = None, minPrice: int = None, maxPrice: int = None,
+                    sort: str = "-created", limit: int = None, cursor: str = None):
     '''
-    Get all the cards.
+    Get a page of the listed cards.
+
+    sort: created or price, descending with a "-" prefix.
+    cursor: the X-Next-Cursor header of the previous page.
     '''
-    cards = database.get_all_images(only_listed=True)
-    return cards
+    return await list_page(database.get_all_images, limit, collection_id=collectionId, owner=owner,
+                           min_price=minPrice, max_price=maxPrice, sort=sort, cursor=cursor)
 
 
 @app.get("/user/{userId}/name")
@@ -168,16 +226,16 @@ async def get_username(userId: str, r: Request):
     '''
     Get the name of a user.
     '''
-    name = database.get_username(userId)
-    return {"userName": name}
+    name = await database.get_username(userId)
+    return JSONResponse({"userName": name})
 
 @app.post("/user/{userId}/name")
 async def set_username(userId: str, name: str, r: Request):
     '''
     Set the name of a user.
     '''
-    database.set_username(userId, name)
-    return {"userName": name}
+    await database.set_username(userId, name)
+    return JSONResponse({"userName": name})
 
 
 
@@ -186,8 +244,8 @@ async def get_remainig_number_of_packets(collectionId: int, r: Request):
     '''
     Get the name of a user.
     '''
-    num_packets = database.get_remainig_number_of_packets(collectionId)
-    return {"remaining": num_packets}
+    num_packets = await database.get_remainig_number_of_packets(collectionId)
+    return JSONResponse({"remaining": num_packets})
 
 
 